@@ -0,0 +1,46 @@
+"""create stage history tables
+
+Revision ID: 4a8e6c2d1f57
+Revises: b2f04d6a8e11
+Create Date: 2026-10-19 13:26:05.664910
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = '4a8e6c2d1f57'
+down_revision: Union[str, None] = 'b2f04d6a8e11'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE TABLE stage_history(
+            uuid            UUID NOT NULL REFERENCES queue(uuid) ON DELETE CASCADE,
+            stage           status_enum NOT NULL,
+            started_at      TIMESTAMP NOT NULL,
+            ended_at        TIMESTAMP NOT NULL
+        )
+    """)
+    op.execute("""
+        CREATE INDEX stage_history_uuid_idx ON stage_history(uuid)
+    """)
+    op.execute("""
+        CREATE TABLE stage_model(
+            synth           synth_enum NOT NULL,
+            stage           status_enum NOT NULL,
+            weight          DOUBLE PRECISION NOT NULL,
+            sum_x           DOUBLE PRECISION NOT NULL,
+            sum_y           DOUBLE PRECISION NOT NULL,
+            sum_xx          DOUBLE PRECISION NOT NULL,
+            sum_xy          DOUBLE PRECISION NOT NULL,
+            updated_at      TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (synth, stage)
+        )
+    """)
+
+def downgrade() -> None:
+    op.drop_table('stage_model')
+    op.drop_table('stage_history')
@@ -0,0 +1,25 @@
+"""add queue artifacts column
+
+Revision ID: 5f3a9c1e7d28
+Revises: c81f4e2a9b63
+Create Date: 2026-10-20 16:41:07.219364
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = '5f3a9c1e7d28'
+down_revision: Union[str, None] = 'c81f4e2a9b63'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.execute("""
+        ALTER TABLE queue
+        ADD COLUMN artifacts JSONB NOT NULL DEFAULT '{}'
+    """)
+
+def downgrade() -> None:
+    op.execute("""ALTER TABLE queue DROP COLUMN artifacts""")
@@ -0,0 +1,100 @@
+"""create midi_blob table
+
+Revision ID: 7c1d5e0f9a24
+Revises: 3e112e2b2014
+Create Date: 2026-10-19 09:12:31.402118
+
+"""
+import hashlib
+from os import environ, path
+from typing import Sequence, Union
+
+from alembic import op
+from sqlalchemy import text
+
+
+revision: str = '7c1d5e0f9a24'
+down_revision: Union[str, None] = '3e112e2b2014'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE TABLE midi_blob(
+            hash            CHAR(64) PRIMARY KEY,
+            data            BYTEA NOT NULL,
+            refcount        INT NOT NULL DEFAULT '0',
+            created_at      TIMESTAMP NOT NULL DEFAULT NOW(),
+            updated_at      TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+    op.execute("""
+        ALTER TABLE queue
+        ADD COLUMN midi_hash CHAR(64) REFERENCES midi_blob(hash) ON DELETE SET NULL
+    """)
+    op.execute("""
+        CREATE INDEX midi_blob_unreferenced_idx ON midi_blob(updated_at) WHERE refcount = 0
+    """)
+    # a blob is referenced by every queue row that still needs it, i.e. until
+    # the row reaches a terminal status
+    op.execute("""
+        CREATE FUNCTION midi_blob_refcount() RETURNS TRIGGER AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE')
+                    AND OLD.midi_hash IS NOT NULL
+                    AND OLD.status NOT IN ('done', 'failed') THEN
+                UPDATE midi_blob
+                SET refcount = refcount - 1, updated_at = NOW()
+                WHERE hash = OLD.midi_hash;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE')
+                    AND NEW.midi_hash IS NOT NULL
+                    AND NEW.status NOT IN ('done', 'failed') THEN
+                UPDATE midi_blob
+                SET refcount = refcount + 1, updated_at = NOW()
+                WHERE hash = NEW.midi_hash;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER midi_blob_refcount_trigger
+        AFTER INSERT OR UPDATE OF status, midi_hash OR DELETE ON queue
+        FOR EACH ROW EXECUTE FUNCTION midi_blob_refcount()
+    """)
+    # queue rows still in flight have their MIDI in {MEDIA_PATH}/{uuid}.mid,
+    # move it into midi_blob so the worker can still record them
+    media_path = environ.get('MEDIA_PATH')
+    if media_path is None:
+        return
+    con = op.get_bind()
+    rows = con.execute(text("""
+        SELECT uuid
+        FROM queue
+        WHERE midi_hash IS NULL
+        AND status NOT IN ('done', 'failed')
+    """)).fetchall()
+    for (uuid,) in rows:
+        midi_path = path.join(media_path, f'{uuid}.mid')
+        if not path.exists(midi_path):
+            continue
+        with open(midi_path, 'rb') as fp:
+            midi_data = fp.read()
+        midi_hash = hashlib.sha256(midi_data).hexdigest()
+        con.execute(text("""
+            INSERT INTO midi_blob(hash, data)
+            VALUES (:hash, :data)
+            ON CONFLICT (hash) DO NOTHING
+        """), {'hash': midi_hash, 'data': midi_data})
+        con.execute(text("""
+            UPDATE queue
+            SET midi_hash = :hash
+            WHERE uuid = :uuid
+        """), {'hash': midi_hash, 'uuid': uuid})
+
+def downgrade() -> None:
+    op.execute("""DROP TRIGGER midi_blob_refcount_trigger ON queue""")
+    op.execute("""DROP FUNCTION midi_blob_refcount""")
+    op.execute("""ALTER TABLE queue DROP COLUMN midi_hash""")
+    op.drop_table('midi_blob')
@@ -0,0 +1,26 @@
+"""add queue xrun columns
+
+Revision ID: 8b4d2f7e1c93
+Revises: f3c8a1d6b402
+Create Date: 2026-10-22 15:27:53.604117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = '8b4d2f7e1c93'
+down_revision: Union[str, None] = 'f3c8a1d6b402'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.execute("""
+        ALTER TABLE queue
+        ADD COLUMN xruns INTEGER NOT NULL DEFAULT 0,
+        ADD COLUMN recaptures INTEGER NOT NULL DEFAULT 0
+    """)
+
+def downgrade() -> None:
+    op.execute("""ALTER TABLE queue DROP COLUMN xruns, DROP COLUMN recaptures""")
@@ -0,0 +1,29 @@
+"""create mailbox_state table
+
+Revision ID: 9d27f1b8c3e6
+Revises: e5b93a7c0d42
+Create Date: 2026-10-20 09:18:52.730415
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = '9d27f1b8c3e6'
+down_revision: Union[str, None] = 'e5b93a7c0d42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE TABLE mailbox_state(
+            mailbox         VARCHAR(80) PRIMARY KEY,
+            uidvalidity     BIGINT NOT NULL,
+            last_uid        BIGINT NOT NULL,
+            updated_at      TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+
+def downgrade() -> None:
+    op.drop_table('mailbox_state')
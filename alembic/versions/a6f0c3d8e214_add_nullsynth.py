@@ -0,0 +1,36 @@
+"""add nullsynth
+
+Revision ID: a6f0c3d8e214
+Revises: d4e7b2a6c915
+Create Date: 2026-10-22 09:12:31.407265
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = 'a6f0c3d8e214'
+down_revision: Union[str, None] = 'd4e7b2a6c915'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.execute("""ALTER TYPE synth_enum ADD VALUE 'nullsynth'""")
+
+def downgrade() -> None:
+    # enum values cannot be dropped, so recreate the type without it
+    op.execute("""DELETE FROM queue WHERE synth='nullsynth'""")
+    op.execute("""DELETE FROM stage_model WHERE synth='nullsynth'""")
+    op.execute("""ALTER TYPE synth_enum RENAME TO synth_enum_old""")
+    op.execute("""
+        CREATE TYPE synth_enum AS ENUM(
+            'sc55mk2'
+        )
+    """)
+    for table in ('queue', 'stage_model'):
+        op.execute(f"""
+            ALTER TABLE {table}
+            ALTER COLUMN synth TYPE synth_enum USING synth::TEXT::synth_enum
+        """)
+    op.execute("""DROP TYPE synth_enum_old""")
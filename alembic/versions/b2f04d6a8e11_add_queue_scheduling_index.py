@@ -0,0 +1,25 @@
+"""add queue scheduling index
+
+Revision ID: b2f04d6a8e11
+Revises: 7c1d5e0f9a24
+Create Date: 2026-10-19 11:03:47.118532
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = 'b2f04d6a8e11'
+down_revision: Union[str, None] = '7c1d5e0f9a24'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE INDEX queue_pending_idx ON queue(synth, created_at)
+        WHERE status NOT IN ('done', 'failed')
+    """)
+
+def downgrade() -> None:
+    op.execute("""DROP INDEX queue_pending_idx""")
@@ -0,0 +1,46 @@
+"""add outbox discord columns
+
+Revision ID: b7e2d94c1a58
+Revises: 8b4d2f7e1c93
+Create Date: 2026-10-23 10:41:26.317582
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = 'b7e2d94c1a58'
+down_revision: Union[str, None] = '8b4d2f7e1c93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.execute("""
+        ALTER TABLE outbox
+        ADD COLUMN channel VARCHAR(16) NOT NULL DEFAULT 'email',
+        ADD COLUMN discord_channel_id BIGINT,
+        ADD COLUMN discord_user_id BIGINT,
+        ALTER COLUMN to_email DROP NOT NULL,
+        ALTER COLUMN subject DROP NOT NULL
+    """)
+    op.execute("""DROP INDEX outbox_pending_idx""")
+    op.execute("""
+        CREATE INDEX outbox_pending_idx ON outbox(channel, next_attempt_at, id)
+        WHERE sent_at IS NULL
+    """)
+
+def downgrade() -> None:
+    op.execute("""DROP INDEX outbox_pending_idx""")
+    op.execute("""DELETE FROM outbox WHERE channel != 'email'""")
+    op.execute("""
+        ALTER TABLE outbox
+        DROP COLUMN channel,
+        DROP COLUMN discord_channel_id,
+        DROP COLUMN discord_user_id,
+        ALTER COLUMN to_email SET NOT NULL,
+        ALTER COLUMN subject SET NOT NULL
+    """)
+    op.execute("""
+        CREATE INDEX outbox_pending_idx ON outbox(next_attempt_at, id) WHERE sent_at IS NULL
+    """)
@@ -0,0 +1,25 @@
+"""add queue notified column
+
+Revision ID: c5a8e3f17d90
+Revises: b7e2d94c1a58
+Create Date: 2026-10-24 11:08:41.272905
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = 'c5a8e3f17d90'
+down_revision: Union[str, None] = 'b7e2d94c1a58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.execute("""
+        ALTER TABLE queue
+        ADD COLUMN notified INTEGER NOT NULL DEFAULT 0
+    """)
+
+def downgrade() -> None:
+    op.execute("""ALTER TABLE queue DROP COLUMN notified""")
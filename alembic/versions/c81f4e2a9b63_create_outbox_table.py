@@ -0,0 +1,52 @@
+"""create outbox table
+
+Revision ID: c81f4e2a9b63
+Revises: 9d27f1b8c3e6
+Create Date: 2026-10-20 14:03:11.582904
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = 'c81f4e2a9b63'
+down_revision: Union[str, None] = '9d27f1b8c3e6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE TABLE outbox(
+            id              BIGSERIAL PRIMARY KEY,
+            to_email        VARCHAR(254) NOT NULL,
+            subject         VARCHAR(255) NOT NULL,
+            content         TEXT NOT NULL,
+            attempts        INT NOT NULL DEFAULT '0',
+            error           TEXT,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            sent_at         TIMESTAMP,
+            created_at      TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+    op.execute("""
+        CREATE INDEX outbox_pending_idx ON outbox(next_attempt_at, id) WHERE sent_at IS NULL
+    """)
+    op.execute("""
+        CREATE FUNCTION outbox_notify() RETURNS TRIGGER AS $$
+        BEGIN
+            PERFORM pg_notify('outbox', NULL);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER outbox_notify_trigger
+        AFTER INSERT ON outbox
+        FOR EACH STATEMENT EXECUTE FUNCTION outbox_notify()
+    """)
+
+def downgrade() -> None:
+    op.execute("""DROP TRIGGER outbox_notify_trigger ON outbox""")
+    op.execute("""DROP FUNCTION outbox_notify""")
+    op.drop_table('outbox')
@@ -0,0 +1,63 @@
+"""add publishing status
+
+Revision ID: d4e7b2a6c915
+Revises: 5f3a9c1e7d28
+Create Date: 2026-10-21 10:27:45.803117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = 'd4e7b2a6c915'
+down_revision: Union[str, None] = '5f3a9c1e7d28'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.execute("""ALTER TYPE status_enum ADD VALUE 'publishing' AFTER 'notifying'""")
+
+def downgrade() -> None:
+    # enum values cannot be dropped, so recreate the type without it along
+    # with everything that depends on the status column
+    op.execute("""UPDATE queue SET status='done' WHERE status='publishing'""")
+    op.execute("""DELETE FROM stage_history WHERE stage='publishing'""")
+    op.execute("""DELETE FROM stage_model WHERE stage='publishing'""")
+    op.execute("""DROP TRIGGER midi_blob_refcount_trigger ON queue""")
+    op.execute("""DROP INDEX queue_pending_idx""")
+    op.execute("""DROP INDEX queue_pending_userdata_idx""")
+    op.execute("""ALTER TYPE status_enum RENAME TO status_enum_old""")
+    op.execute("""
+        CREATE TYPE status_enum AS ENUM(
+            'new',
+            'recording',
+            'encoding',
+            'uploading',
+            'notifying',
+            'done',
+            'failed'
+        )
+    """)
+    op.execute("""ALTER TABLE queue ALTER COLUMN status DROP DEFAULT""")
+    for table, column in (('queue', 'status'), ('stage_history', 'stage'),
+            ('stage_model', 'stage')):
+        op.execute(f"""
+            ALTER TABLE {table}
+            ALTER COLUMN {column} TYPE status_enum USING {column}::TEXT::status_enum
+        """)
+    op.execute("""ALTER TABLE queue ALTER COLUMN status SET DEFAULT 'new'""")
+    op.execute("""DROP TYPE status_enum_old""")
+    op.execute("""
+        CREATE INDEX queue_pending_idx ON queue(synth, created_at)
+        WHERE status NOT IN ('done', 'failed')
+    """)
+    op.execute("""
+        CREATE INDEX queue_pending_userdata_idx ON queue(userdata)
+        WHERE status NOT IN ('done', 'failed')
+    """)
+    op.execute("""
+        CREATE TRIGGER midi_blob_refcount_trigger
+        AFTER INSERT OR UPDATE OF status, midi_hash OR DELETE ON queue
+        FOR EACH ROW EXECUTE FUNCTION midi_blob_refcount()
+    """)
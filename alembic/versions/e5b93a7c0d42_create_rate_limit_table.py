@@ -0,0 +1,33 @@
+"""create rate_limit table
+
+Revision ID: e5b93a7c0d42
+Revises: 4a8e6c2d1f57
+Create Date: 2026-10-19 15:41:19.207733
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = 'e5b93a7c0d42'
+down_revision: Union[str, None] = '4a8e6c2d1f57'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE TABLE rate_limit(
+            userdata        JSONB PRIMARY KEY,
+            tokens          DOUBLE PRECISION NOT NULL,
+            updated_at      TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+    op.execute("""
+        CREATE INDEX queue_pending_userdata_idx ON queue(userdata)
+        WHERE status NOT IN ('done', 'failed')
+    """)
+
+def downgrade() -> None:
+    op.execute("""DROP INDEX queue_pending_userdata_idx""")
+    op.drop_table('rate_limit')
@@ -0,0 +1,40 @@
+"""create queue_subscriber table
+
+Revision ID: f3c8a1d6b402
+Revises: a6f0c3d8e214
+Create Date: 2026-10-22 09:14:37.518204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = 'f3c8a1d6b402'
+down_revision: Union[str, None] = 'a6f0c3d8e214'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE TABLE queue_subscriber(
+            uuid            UUID NOT NULL REFERENCES queue(uuid) ON DELETE CASCADE,
+            userdata        JSONB NOT NULL,
+            midi_file       VARCHAR(80) NOT NULL,
+            created_at      TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+    op.execute("""
+        CREATE INDEX queue_subscriber_uuid_idx ON queue_subscriber(uuid)
+    """)
+    op.execute("""
+        CREATE INDEX queue_subscriber_userdata_idx ON queue_subscriber(userdata)
+    """)
+    op.execute("""
+        CREATE INDEX queue_coalesce_idx ON queue(midi_hash, synth)
+        WHERE status IN ('new', 'recording', 'encoding', 'uploading')
+    """)
+
+def downgrade() -> None:
+    op.execute("""DROP INDEX queue_coalesce_idx""")
+    op.drop_table('queue_subscriber')
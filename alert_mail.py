@@ -19,6 +19,7 @@ def main():
         subject='DTMaaS System Alert',
         content=sys.stdin.read()
     )
+    email.close()
 
 if __name__ == "__main__":
     main()
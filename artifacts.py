@@ -0,0 +1,95 @@
+"""Manifest entries for the files a queue item's stages produce"""
+import hashlib
+import os
+import struct
+from dataclasses import dataclass, asdict, replace
+from typing import Optional
+
+@dataclass(frozen=True)
+class Artifact:
+    """A stage output with what is needed to check it is still intact"""
+    path: str
+    size: int
+    sha256: str
+    samples: int
+    url: Optional[str] = None
+
+    @staticmethod
+    def from_file(path: str) -> 'Artifact':
+        """Describe the file at `path`, counting samples of WAV and FLAC files"""
+        return Artifact(
+            path=path,
+            size=os.stat(path).st_size,
+            sha256=get_sha256(path),
+            samples=get_samples(path) if path.endswith(('.wav', '.flac')) else 0,
+        )
+
+    @staticmethod
+    def deserialize(data: dict) -> 'Artifact':
+        """Deserialize an artifact from a dictionary"""
+        return Artifact(**data)
+
+    def serialize(self) -> dict:
+        """Serialize the artifact to a dictionary"""
+        return asdict(self)
+
+    def with_url(self, url: str) -> 'Artifact':
+        """Return the artifact with the URL it was uploaded to"""
+        return replace(self, url=url)
+
+    def is_valid(self) -> bool:
+        """Check the file still exists with the recorded size and checksum"""
+        try:
+            if os.stat(self.path).st_size != self.size:
+                return False
+        except FileNotFoundError:
+            return False
+        return get_sha256(self.path) == self.sha256
+
+def get_sha256(path: str) -> str:
+    """Return the hex sha256 of the file at `path`"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while chunk := fp.read(1024*1024):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def get_samples(path: str) -> int:
+    """Return the number of samples per channel of a WAV or FLAC file"""
+    with open(path, 'rb') as fp:
+        magic = fp.read(4)
+        fp.seek(0)
+        if magic == b'RIFF':
+            return _get_wav_samples(fp, os.fstat(fp.fileno()).st_size)
+        if magic == b'fLaC':
+            return _get_flac_samples(fp)
+    raise ValueError(f'Unsupported audio file "{path}"')
+
+def _get_wav_samples(fp, file_size: int) -> int:
+    """Count samples from the RIFF chunks, which also works for the
+    WAVE_FORMAT_EXTENSIBLE files arecord writes and `wave` rejects"""
+    riff, _, wave = struct.unpack('<4sI4s', fp.read(12))
+    if riff != b'RIFF' or wave != b'WAVE':
+        raise ValueError('Not a WAV file')
+    block_align = None
+    while header := fp.read(8):
+        chunk_id, chunk_size = struct.unpack('<4sI', header)
+        if chunk_id == b'fmt ':
+            block_align = struct.unpack('<12xH', fp.read(14))[0]
+            fp.seek(chunk_size - 14 + chunk_size % 2, os.SEEK_CUR)
+        elif chunk_id == b'data':
+            if block_align is None:
+                raise ValueError('WAV data before format')
+            if fp.tell() + chunk_size > file_size:
+                raise ValueError('WAV data truncated')
+            return chunk_size // block_align
+        else:
+            fp.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+    raise ValueError('WAV has no data')
+
+def _get_flac_samples(fp) -> int:
+    """Read the total samples from the FLAC STREAMINFO block"""
+    header = fp.read(8 + 34)
+    if header[:4] != b'fLaC' or header[4] & 0x7F != 0:
+        raise ValueError('FLAC has no STREAMINFO')
+    return int.from_bytes(header[8+10:8+18], 'big') & (2**36 - 1)
@@ -1,27 +1,103 @@
 """Module to interfave with Azure Services"""
-from typing import BinaryIO
+import base64
+import hashlib
+import hmac
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from os import environ
+from typing import BinaryIO, Dict, Tuple
+from urllib.parse import urlencode
+from xml.etree import ElementTree
 
 import requests
 
+from metrics import Counter, Histogram, timed
+from tracing import traced
+
+AZURE_SECONDS = Histogram('dtmaas_azure_seconds', 'Latency of Azure requests', ['method'])
+AZURE_BYTES = Counter('dtmaas_azure_upload_bytes_total', 'Bytes uploaded to Azure blobs')
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+def format_time(seconds: float) -> str:
+    """Format a UNIX time the way Azure Storage expects"""
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime(TIME_FORMAT)
+
+def parse_time(text: str) -> float:
+    """Parse an Azure Storage time to a UNIX time"""
+    return datetime.strptime(text[:19], TIME_FORMAT[:-1]).replace(
+        tzinfo=timezone.utc).timestamp()
+
+@dataclass
+class UserDelegationKey:
+    """Key for signing SAS tokens on behalf of the client's identity"""
+    signed_oid: str
+    signed_tid: str
+    signed_start: str
+    signed_expiry: str
+    signed_service: str
+    signed_version: str
+    value: str
+
+    def get_expiry(self) -> float:
+        """Return the UNIX time the key expires at"""
+        return parse_time(self.signed_expiry)
+
 class AzureClient:
     """Interface for Azure services"""
     DNS_TTL = 600
+    LOGIN_URL = 'https://login.microsoftonline.com'
+    BLOB_URL = 'https://{blob_account}.blob.core.windows.net'
+    SAS_VERSION = '2020-12-06'
+    SAS_LIFETIME = 24*60*60
+    # also allow for clock skew between us and the storage service
+    SAS_CLOCK_SKEW = 5*60
+    DELEGATION_KEY_LIFETIME = 2*24*60*60
+    TOKEN_MARGIN = 5*60
+    # tokens and delegation keys are shared by all clients until near expiry
+    cache_lock = threading.Lock()
+    access_tokens: Dict[Tuple[str, str, str], Tuple[float, str]] = {}
+    delegation_keys: Dict[str, UserDelegationKey] = {}
 
     def __init__(self, tenant_id: str, client_id: str, client_secret: str,
             resource:str = 'https://management.azure.com/'):
-        """Retreive Azure access token for subsequent requests"""
-        url = f'https://login.microsoftonline.com/{tenant_id}/oauth2/token'
+        """Retreive Azure access token for subsequent requests, unless one
+        is cached"""
+        key = (tenant_id, client_id, resource)
+        with AzureClient.cache_lock:
+            cached = AzureClient.access_tokens.get(key)
+        if cached and cached[0] - time.time() > AzureClient.TOKEN_MARGIN:
+            self.access_token = cached[1]
+            return
+        expires_at, self.access_token = self._req_access_token(tenant_id, client_id,
+            client_secret, resource)
+        with AzureClient.cache_lock:
+            AzureClient.access_tokens[key] = (expires_at, self.access_token)
+
+    @staticmethod
+    @timed(AZURE_SECONDS, method='token')
+    @traced()
+    def _req_access_token(tenant_id: str, client_id: str, client_secret: str,
+            resource: str) -> Tuple[float, str]:
+        """Request an access token, returning when it expires and the token"""
+        login_url = environ.get('AZURE_LOGIN_URL', AzureClient.LOGIN_URL)
+        url = f'{login_url}/{tenant_id}/oauth2/token'
         payload = {
             'grant_type': 'client_credentials',
             'client_id': client_id,
             'client_secret': client_secret,
             'resource': resource,
         }
+        started = time.time()
         req = requests.post(url, data=payload, timeout=60)
         assert req.status_code == 200
         response_json = req.json()
-        self.access_token = response_json['access_token']
+        return started + int(response_json.get('expires_in', 0)), response_json['access_token']
 
+    @timed(AZURE_SECONDS)
+    @traced()
     def req_dns_get_record_ip(
             self,
             subscription_id: str,
@@ -38,6 +114,8 @@ class AzureClient:
         assert len(response_json['properties']['ARecords']) == 1
         return response_json['properties']['ARecords'][0]['ipv4Address']
 
+    @timed(AZURE_SECONDS)
+    @traced()
     def req_dns_update_record(
             self,
             subscription_id: str,
@@ -58,6 +136,14 @@ class AzureClient:
         req = requests.put(url, headers=headers, json=payload, timeout=60)
         assert req.status_code == 200
 
+    @staticmethod
+    def get_blob_url(blob_account: str, container: str, blob: str) -> str:
+        """Return the URL a blob is, or will be, uploaded to"""
+        blob_url = environ.get('AZURE_BLOB_URL', AzureClient.BLOB_URL)
+        return f'{blob_url.format(blob_account=blob_account)}/{container}/{blob}'
+
+    @timed(AZURE_SECONDS)
+    @traced()
     def req_blob_upload(
             self,
             blob_account: str,
@@ -70,7 +156,109 @@ class AzureClient:
             'x-ms-version': '2020-04-08',
             'x-ms-blob-type': 'BlockBlob',
         }
-        url = f'https://{blob_account}.blob.core.windows.net/{container}/{blob}'
+        url = self.get_blob_url(blob_account, container, blob)
         req = requests.put(url, headers=headers, data=data, timeout=60)
         assert req.status_code == 201
+        AZURE_BYTES.inc(int(req.request.headers.get('Content-Length', 0)))
         return url
+
+    @timed(AZURE_SECONDS)
+    @traced()
+    def req_user_delegation_key(self, blob_account: str) -> UserDelegationKey:
+        """Request a key for signing SAS tokens of `blob_account`"""
+        headers = {
+            'Authorization': f'Bearer {self.access_token}',
+            'x-ms-version': self.SAS_VERSION,
+            'Content-Type': 'application/xml',
+        }
+        now = time.time()
+        payload = '<?xml version="1.0" encoding="utf-8"?><KeyInfo>' \
+            f'<Start>{format_time(now - self.SAS_CLOCK_SKEW)}</Start>' \
+            f'<Expiry>{format_time(now + self.DELEGATION_KEY_LIFETIME)}</Expiry></KeyInfo>'
+        blob_url = environ.get('AZURE_BLOB_URL', AzureClient.BLOB_URL)
+        url = f'{blob_url.format(blob_account=blob_account)}/' \
+            '?restype=service&comp=userdelegationkey'
+        req = requests.post(url, headers=headers, data=payload.encode('utf8'), timeout=60)
+        assert req.status_code == 200
+        root = ElementTree.fromstring(req.content)
+        def get_text(tag: str) -> str:
+            return root.findtext(tag) or ''
+        return UserDelegationKey(
+            signed_oid=get_text('SignedOid'),
+            signed_tid=get_text('SignedTid'),
+            signed_start=get_text('SignedStart'),
+            signed_expiry=get_text('SignedExpiry'),
+            signed_service=get_text('SignedService'),
+            signed_version=get_text('SignedVersion'),
+            value=get_text('Value'),
+        )
+
+    def get_user_delegation_key(self, blob_account: str) -> UserDelegationKey:
+        """Return a delegation key valid for at least the lifetime of a SAS,
+        requesting a new one only once the cached one is about to expire"""
+        with AzureClient.cache_lock:
+            key = AzureClient.delegation_keys.get(blob_account)
+        if key is None or key.get_expiry() - time.time() \
+                < self.SAS_LIFETIME + self.SAS_CLOCK_SKEW:
+            key = self.req_user_delegation_key(blob_account)
+            with AzureClient.cache_lock:
+                AzureClient.delegation_keys[blob_account] = key
+        return key
+
+    @staticmethod
+    def sign_blob_sas(key: UserDelegationKey, blob_account: str, container: str, blob: str,
+            start: float, expiry: float) -> Dict[str, str]:
+        """Return the query parameters of a user delegation SAS allowing to
+        read a blob between `start` and `expiry`"""
+        params = {
+            'sp': 'r',
+            'st': format_time(start),
+            'se': format_time(expiry),
+            'skoid': key.signed_oid,
+            'sktid': key.signed_tid,
+            'skt': key.signed_start,
+            'ske': key.signed_expiry,
+            'sks': key.signed_service,
+            'skv': key.signed_version,
+            'sv': AzureClient.SAS_VERSION,
+            'sr': 'b',
+        }
+        string_to_sign = '\n'.join([
+            params['sp'],
+            params['st'],
+            params['se'],
+            f'/blob/{blob_account}/{container}/{blob}',
+            params['skoid'],
+            params['sktid'],
+            params['skt'],
+            params['ske'],
+            params['sks'],
+            params['skv'],
+            '', # signedAuthorizedUserObjectId
+            '', # signedUnauthorizedUserObjectId
+            '', # signedCorrelationId
+            '', # signedIP
+            '', # signedProtocol
+            params['sv'],
+            params['sr'],
+            '', # signedSnapshotTime
+            '', # signedEncryptionScope
+            '', # rscc
+            '', # rscd
+            '', # rsce
+            '', # rscl
+            '', # rsct
+        ])
+        signature = hmac.new(base64.b64decode(key.value), string_to_sign.encode('utf8'),
+            hashlib.sha256).digest()
+        params['sig'] = base64.b64encode(signature).decode('ascii')
+        return params
+
+    def get_blob_sas_url(self, blob_account: str, container: str, blob: str) -> str:
+        """Return a URL to read a blob that expires after `SAS_LIFETIME`,
+        signed locally with the cached delegation key"""
+        key = self.get_user_delegation_key(blob_account)
+        now = time.time()
+        params = self.sign_blob_sas(key, blob_account, container, blob,
+            now - self.SAS_CLOCK_SKEW, now + self.SAS_LIFETIME)
+        return f'{self.get_blob_url(blob_account, container, blob)}?{urlencode(params)}'
@@ -0,0 +1,293 @@
+"""Benchmark the queue against a postgres seeded with production-scale history
+
+Run with `python -m benchmarks.queue_benchmark --database-url <url>` against a
+scratch database, which is migrated to head and whose queue is truncated.
+Results are written as JSON so schema and index changes can be compared.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import select
+import subprocess
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from uuid import UUID, uuid4
+
+import psycopg2
+from alembic import command, config
+
+from queue_client import Queue, QueueItem, StatusEnum, SchedulingPolicy
+from synth import Synth
+from user import UserEmail
+
+def summarize(samples: Sequence[float]) -> Dict[str, float]:
+    """Return the count, mean and percentiles of latency `samples` in ms"""
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0}
+    def percentile(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000.
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered) * 1000.,
+        'p50': percentile(.5),
+        'p95': percentile(.95),
+        'p99': percentile(.99),
+        'max': ordered[-1] * 1000.,
+    }
+
+def seed(database_url: str, rows: int, pending: int, users: int):
+    """Replace the queue with `rows` items spread over every synth, all but
+    the newest `pending` of which are done or failed"""
+    con = psycopg2.connect(database_url)
+    con.autocommit = True
+    cur = con.cursor()
+    cur.execute("TRUNCATE queue, queue_subscriber, stage_history, midi_blob")
+    cur.execute("""
+        WITH synths AS (SELECT enum_range(NULL::synth_enum) AS ids)
+        INSERT INTO queue(uuid, status, retries, userdata, synth, midi_file, midi_length,
+            created_at, updated_at)
+        SELECT
+            gen_random_uuid(),
+            CASE
+                WHEN i > %(rows)s - %(pending)s THEN 'new'
+                WHEN i %% 50 = 0 THEN 'failed'
+                ELSE 'done'
+            END::status_enum,
+            0,
+            jsonb_build_object('type', 'user_email', 'email', 'user' || i %% %(users)s || '@example.com'),
+            ids[1 + i %% array_length(ids, 1)],
+            'seed.mid',
+            30 + i %% 600,
+            NOW() - (%(rows)s - i) * INTERVAL '1 minute',
+            NOW() - (%(rows)s - i) * INTERVAL '1 minute'
+        FROM synths, generate_series(1, %(rows)s) AS i
+    """, {'rows': rows, 'pending': pending, 'users': users})
+    cur.execute("ANALYZE queue")
+    con.close()
+
+def get_synth_ids(database_url: str) -> List[str]:
+    """Return the synths the schema knows about that this code can create"""
+    con = psycopg2.connect(database_url)
+    cur = con.cursor()
+    cur.execute("SELECT unnest(enum_range(NULL::synth_enum))::TEXT")
+    synth_ids = []
+    for (synth_id,) in cur.fetchall():
+        try:
+            Synth.from_id(synth_id)
+        except TypeError:
+            continue
+        synth_ids.append(synth_id)
+    con.close()
+    return synth_ids
+
+def _enqueue_worker(database_url: str, synth_id: str,
+        count: int) -> Tuple[float, float, List[float]]:
+    """Enqueue `count` items, returning when it started and ended and the
+    latency of each"""
+    Queue.connect(database_url)
+    synth = Synth.from_id(synth_id)
+    latencies = []
+    started = time.monotonic()
+    for i in range(count):
+        midi_data = uuid4().bytes
+        queue_item = QueueItem.factory(UserEmail(email=f'bench{i}@example.com'), synth,
+            'bench.mid', midi_data, midi_length=60)
+        start = time.monotonic()
+        Queue.enqueue_queue_item(queue_item)
+        latencies.append(time.monotonic() - start)
+    ended = time.monotonic()
+    Queue.disconnect()
+    return started, ended, latencies
+
+def _read_worker(database_url: str, policy: str, synth_id: str, method: str,
+        count: int) -> List[float]:
+    """Call a read-only Queue method `count` times, returning the latency of each"""
+    Queue.connect(database_url, SchedulingPolicy(policy))
+    synth = Synth.from_id(synth_id)
+    # time the estimate for the last pending item, the worst case
+    target = None
+    if method == 'get_queue_length_item':
+        cur = Queue._get_cursor() # pylint: disable=protected-access
+        cur.execute("""
+            SELECT uuid FROM queue
+            WHERE synth=%s AND status NOT IN ('done', 'failed')
+            ORDER BY created_at DESC LIMIT 1
+        """, [synth_id])
+        result = cur.fetchone()
+        if result:
+            target = QueueItem(uuid=UUID(result[0]), status=StatusEnum.NEW, retries=0,
+                user=UserEmail(email='bench@example.com'), synth=synth,
+                midi_file='bench.mid', midi_length=60)
+    latencies = []
+    for _ in range(count):
+        start = time.monotonic()
+        if method == 'get_front_queue_item':
+            Queue.get_front_queue_item(synth)
+        else:
+            Queue.get_queue_length(synth, target)
+        latencies.append(time.monotonic() - start)
+    Queue.disconnect()
+    return latencies
+
+def _listen_worker(database_url: str, ready, stop, results):
+    """Record the monotonic time of every wakeup on the queue channel"""
+    con = psycopg2.connect(database_url)
+    con.autocommit = True
+    con.cursor().execute("LISTEN queue")
+    ready.release()
+    wakeups = []
+    while not stop.is_set():
+        if select.select([con], [], [], .1) == ([], [], []):
+            continue
+        now = time.monotonic()
+        con.poll()
+        if con.notifies:
+            wakeups.append(now)
+            con.notifies.clear()
+    con.close()
+    results.put(wakeups)
+
+def run_parallel(ctx, workers: int, target, args: tuple) -> List[float]:
+    """Run `target` in `workers` processes, returning the merged samples"""
+    with ctx.Pool(workers) as pool:
+        samples = pool.starmap(target, [args] * workers)
+    return [sample for worker_samples in samples for sample in worker_samples]
+
+def bench_enqueue(ctx, database_url: str, synth_id: str, workers: int,
+        count: int) -> Dict[str, Any]:
+    """Measure enqueue throughput and latency, then remove the enqueued items"""
+    with ctx.Pool(workers) as pool:
+        runs = pool.starmap(_enqueue_worker, [(database_url, synth_id, count)] * workers)
+    # CLOCK_MONOTONIC is shared between processes
+    elapsed = max(ended for _, ended, _ in runs) - min(started for started, _, _ in runs)
+    latencies = [latency for _, _, run_latencies in runs for latency in run_latencies]
+    con = psycopg2.connect(database_url)
+    con.autocommit = True
+    con.cursor().execute("DELETE FROM queue WHERE midi_file='bench.mid'")
+    con.close()
+    return {'throughput': len(latencies) / elapsed, 'latency_ms': summarize(latencies)}
+
+def bench_wakeup(ctx, database_url: str, synth_id: str, workers: int,
+        count: int, interval: float = .05) -> Dict[str, Any]:
+    """Measure the delay from enqueuing to waking every listening worker"""
+    ready = ctx.Semaphore(0)
+    stop = ctx.Event()
+    results = ctx.Queue()
+    listeners = [ctx.Process(target=_listen_worker, args=(database_url, ready, stop, results))
+        for _ in range(workers)]
+    for listener in listeners:
+        listener.start()
+    for _ in listeners:
+        ready.acquire() # pylint: disable=consider-using-with
+    Queue.connect(database_url)
+    synth = Synth.from_id(synth_id)
+    sent = []
+    for i in range(count):
+        queue_item = QueueItem.factory(UserEmail(email=f'bench{i}@example.com'), synth,
+            'bench.mid', uuid4().bytes, midi_length=60)
+        sent.append(time.monotonic())
+        Queue.enqueue_queue_item(queue_item)
+        time.sleep(interval)
+    Queue.disconnect()
+    stop.set()
+    wakeups = [results.get() for _ in listeners]
+    for listener in listeners:
+        listener.join()
+
+    # pair each wakeup with the latest enqueue before it
+    latencies = []
+    for worker_wakeups in wakeups:
+        for wakeup in worker_wakeups:
+            before = [start for start in sent if start <= wakeup]
+            if before:
+                latencies.append(wakeup - before[-1])
+    con = psycopg2.connect(database_url)
+    con.autocommit = True
+    con.cursor().execute("DELETE FROM queue WHERE midi_file='bench.mid'")
+    con.close()
+    return {'latency_ms': summarize(latencies), 'missed': count * workers - len(latencies)}
+
+def get_environment(database_url: str) -> Dict[str, Optional[str]]:
+    """Describe what was benchmarked, to tell results apart"""
+    con = psycopg2.connect(database_url)
+    cur = con.cursor()
+    cur.execute("SHOW server_version")
+    result = cur.fetchone()
+    cur.execute("SELECT version_num FROM alembic_version")
+    revision = cur.fetchone()
+    con.close()
+    try:
+        commit: Optional[str] = subprocess.run(['git', 'rev-parse', 'HEAD'], check=True,
+            capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'alembic_revision': revision[0] if revision else None,
+        'postgres_version': result[0] if result else None,
+    }
+
+def main():
+    """Main program"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--database-url', default=os.environ.get('BENCHMARK_DATABASE_URL'),
+        help='scratch database to benchmark, its queue is truncated')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10**4, 10**5, 10**6],
+        help='sizes of the seeded queue history')
+    parser.add_argument('--pending', type=int, default=100,
+        help='number of seeded items still waiting')
+    parser.add_argument('--users', type=int, default=1000,
+        help='number of distinct users in the seeded history')
+    parser.add_argument('--workers', type=int, default=4,
+        help='number of concurrent worker processes')
+    parser.add_argument('--samples', type=int, default=100,
+        help='number of calls per worker for each measurement')
+    parser.add_argument('--policies', nargs='+',
+        default=[policy.value for policy in SchedulingPolicy],
+        help='scheduling policies to time reads under')
+    parser.add_argument('--output', default='queue_benchmark.json',
+        help='file to write the JSON results to')
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error('--database-url or BENCHMARK_DATABASE_URL is required')
+
+    # alembic's env.py reads the url from the environment
+    os.environ['DATABASE_URL'] = args.database_url
+    command.upgrade(config.Config('alembic.ini'), 'head')
+
+    ctx = multiprocessing.get_context('spawn')
+    synth_id = get_synth_ids(args.database_url)[0]
+    report: Dict[str, Any] = {
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'environment': get_environment(args.database_url),
+        'parameters': {key: value for key, value in vars(args).items() if key != 'database_url'},
+        'results': [],
+    }
+    for rows in args.rows:
+        print(f'Seeding {rows} rows...')
+        seed(args.database_url, rows, args.pending, args.users)
+        result: Dict[str, Any] = {'rows': rows, 'synth': synth_id}
+        for policy in args.policies:
+            for method in ('get_front_queue_item', 'get_queue_length', 'get_queue_length_item'):
+                print(f'Timing {method} under {policy}...')
+                latencies = run_parallel(ctx, args.workers, _read_worker,
+                    (args.database_url, policy, synth_id, method, args.samples))
+                result[f'{method}_{policy}_ms'] = summarize(latencies)
+        print('Timing enqueue...')
+        result['enqueue'] = bench_enqueue(ctx, args.database_url, synth_id,
+            args.workers, args.samples)
+        print('Timing wakeup...')
+        result['wakeup'] = bench_wakeup(ctx, args.database_url, synth_id,
+            args.workers, args.samples)
+        report['results'].append(result)
+        print(json.dumps(result, indent=2))
+
+    with open(args.output, 'w', encoding='utf8') as fp:
+        json.dump(report, fp, indent=2)
+    print(f'Wrote results to "{args.output}"')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Discord client for posting notifications to channels"""
+import logging
+import time
+from os import environ
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+class DiscordError(Exception):
+    """A request the Discord API did not accept"""
+    def __init__(self, status_code: int):
+        super().__init__(f'returned code {status_code}')
+        self.status_code = status_code
+
+    def is_permanent(self) -> bool:
+        """Whether repeating the request cannot succeed"""
+        return 400 <= self.status_code < 500 and self.status_code != 429
+
+class DiscordClient:
+    """Interface for the Discord REST API that respects its rate limits"""
+    API_URL = 'https://discord.com/api/v10'
+    MAX_MESSAGE_LENGTH = 2000
+    MAX_RETRIES = 5
+
+    def __init__(self, bot_token: Optional[str] = None, api_url: Optional[str] = None):
+        self.api_url = api_url if api_url else environ.get('DISCORD_API_URL', self.API_URL)
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = \
+            f'Bot {bot_token if bot_token else environ["DISCORD_BOT_TOKEN"]}'
+        # monotonic times before which a route, or every route, must not be used
+        self.route_resets: Dict[str, float] = {}
+        self.global_reset = 0.0
+
+    def _wait_rate_limit(self, route: str):
+        """Sleep until `route` may be requested again"""
+        delay = max(self.route_resets.get(route, 0), self.global_reset) - time.monotonic()
+        if delay > 0:
+            logging.info('Discord rate limited, waiting %.2fs...', delay)
+            time.sleep(delay)
+
+    def _request(self, method: str, route: str, **kwargs) -> requests.Response:
+        """Make a request, waiting out rate limits and retrying failures"""
+        req: Optional[requests.Response] = None
+        for attempt in range(self.MAX_RETRIES):
+            self._wait_rate_limit(route)
+            try:
+                req = self.session.request(method, f'{self.api_url}{route}', timeout=60, **kwargs)
+            except requests.ConnectionError:
+                if attempt == self.MAX_RETRIES - 1:
+                    raise
+                time.sleep(2**attempt)
+                continue
+
+            now = time.monotonic()
+            if req.headers.get('X-RateLimit-Remaining') == '0':
+                self.route_resets[route] = \
+                    now + float(req.headers.get('X-RateLimit-Reset-After', 1))
+            if req.status_code == 429:
+                response_json = req.json()
+                reset = now + float(response_json.get('retry_after', 1))
+                if response_json.get('global'):
+                    self.global_reset = reset
+                else:
+                    self.route_resets[route] = reset
+            elif req.status_code >= 500:
+                time.sleep(2**attempt)
+            else:
+                return req
+        assert req is not None
+        return req
+
+    def req_create_message(self, channel_id: int, content: str, user_ids: List[int]):
+        """Post `content` to a channel, allowing it to mention `user_ids`"""
+        payload = {
+            'content': content[:self.MAX_MESSAGE_LENGTH],
+            'allowed_mentions': {'users': [str(user_id) for user_id in user_ids]},
+        }
+        req = self._request('POST', f'/channels/{channel_id}/messages', json=payload)
+        if req.status_code != 200:
+            raise DiscordError(req.status_code)
+
+class DiscordNotifier:
+    """Posts batches of notifications, packing each channel's into few messages"""
+
+    def __init__(self, client: DiscordClient):
+        self.client = client
+
+    def post(self, batch: List[Tuple[int, int, str]]) -> List[Optional[Exception]]:
+        """Post notifications given as (channel id, user id, content), returning
+        for each the error that kept it from being delivered, if any"""
+        errors: List[Optional[Exception]] = [None] * len(batch)
+        channels: Dict[int, List[Tuple[int, int, str]]] = {}
+        for index, (channel_id, user_id, content) in enumerate(batch):
+            channels.setdefault(channel_id, []).append((index, user_id, f'<@{user_id}> {content}'))
+        for channel_id, parts in channels.items():
+            indices: List[int] = []
+            user_ids: List[int] = []
+            content = ''
+            for index, user_id, part in parts:
+                if content and len(content) + 2 + len(part) > DiscordClient.MAX_MESSAGE_LENGTH:
+                    self._send(channel_id, content, user_ids, indices, errors)
+                    indices, user_ids, content = [], [], ''
+                indices.append(index)
+                user_ids.append(user_id)
+                content = f'{content}\n\n{part}' if content else part
+            self._send(channel_id, content, user_ids, indices, errors)
+        return errors
+
+    def _send(self, channel_id: int, content: str, user_ids: List[int],
+            indices: List[int], errors: List[Optional[Exception]]):
+        """Post one message, recording a failure against the notifications it packs
+        so the other channels still get theirs"""
+        try:
+            self.client.req_create_message(channel_id, content, user_ids)
+        except (requests.RequestException, DiscordError) as e:
+            logging.exception('Could not notify discord channel %d', channel_id)
+            for index in indices:
+                errors[index] = e
@@ -1,23 +1,38 @@
 """Email client for handling sending and receiving emails"""
-import base64
+import binascii
+import io
 import logging
+import quopri
 import re
-import socket
+import select
+import ssl
+import time
 from os import environ
 from dataclasses import dataclass
-from email import message_from_bytes
-from email.message import Message, EmailMessage
+from email.header import decode_header, make_header
+from email.message import EmailMessage
+from email.parser import BytesHeaderParser
 from email.utils import parseaddr
-from imaplib import IMAP4_SSL
-from smtplib import SMTP_SSL 
+from imaplib import IMAP4, IMAP4_SSL
+from itertools import takewhile
+from smtplib import SMTP, SMTP_SSL, SMTPServerDisconnected
 from enum import Enum
-from typing import Iterator, Union, Tuple, Optional
+from typing import Iterator, Union, Tuple, Optional, List, Dict, Any, Callable, cast
+
+from metrics import Counter, Histogram, is_enabled, timed
+from tracing import traced
+
+EMAIL_SECONDS = Histogram('dtmaas_email_seconds',
+    'Latency of SMTP and IMAP calls', ['protocol', 'method'])
+EMAIL_BYTES = Counter('dtmaas_email_bytes_total',
+    'Bytes of emails sent and MIDI attachments downloaded', ['protocol'])
 
 class RequestEmailValidationResult(Enum):
     """Validation results for a request email"""
     OK = 'OK'
     TOO_BIG = 'Email too large >1 MiB'
     NO_MIDI = 'No MIDI attached'
+    BAD_ENCODING = 'MIDI attachment encoding not supported'
 
 @dataclass
 class RequestEmail:
@@ -28,18 +43,62 @@ class RequestEmail:
     midi_name: Union[None, str]
     midi_data: Union[None, bytes]
 
+@dataclass
+class MailboxState:
+    """Last seen UID of a mailbox, only valid for the same UIDVALIDITY"""
+    uidvalidity: int
+    last_uid: int
+
 class EmailClient:
     """Class for handling sending and receiving emails via Gmail"""
+    # transfer encodings a MIDI part can be decoded from, others are refused
+    # before the part is downloaded
+    MIDI_ENCODINGS = ('7bit', '8bit', 'binary', 'base64', 'quoted-printable')
 
     SMTP_HOST = 'smtp.gmail.com'
     SMTP_PORT = 465
     IMAP_HOST = 'imap.gmail.com'
     IMAP_PORT = 993
+    IMAP_TIMEOUT = 60
+    IMAP_MAX_BACKOFF = 5*60
+    IDLE_RENEWAL = 9*60
+    SMTP_TIMEOUT = 60
+    SMTP_IDLE_TIMEOUT = 60
 
     def __init__(self, email_account: Optional[str] = None, email_key: Optional[str] = None):
         self.email_account = email_account if email_account else environ['EMAIL_ACCOUNT']
         self.email_key = email_key if email_key else environ['EMAIL_ACCOUNT_KEY']
+        # gmail unless pointed at other servers, such as local stand-ins
+        self.smtp_host = environ.get('SMTP_HOST', self.SMTP_HOST)
+        self.smtp_port = int(environ.get('SMTP_PORT', self.SMTP_PORT))
+        self.imap_host = environ.get('IMAP_HOST', self.IMAP_HOST)
+        self.imap_port = int(environ.get('IMAP_PORT', self.IMAP_PORT))
+        self.use_ssl = environ.get('EMAIL_SSL', '1') != '0'
+        self.smtp: Optional[SMTP] = None
+        self.smtp_used_at = 0.0
+
+    def _get_smtp(self) -> SMTP:
+        """Return the logged in SMTP session, reconnecting if it has been idle"""
+        if self.smtp is not None \
+                and time.monotonic() - self.smtp_used_at > self.SMTP_IDLE_TIMEOUT:
+            self.close()
+        if self.smtp is None:
+            smtp_class = SMTP_SSL if self.use_ssl else SMTP
+            self.smtp = smtp_class(self.smtp_host, self.smtp_port, timeout=self.SMTP_TIMEOUT)
+            self.smtp.login(self.email_account, self.email_key)
+        self.smtp_used_at = time.monotonic()
+        return self.smtp
 
+    def close(self):
+        """Close the SMTP session if one is open"""
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except OSError:
+                pass
+            self.smtp = None
+
+    @traced()
     def send(self, to_email: str, subject: str, content: str):
         """Send an email to a given address"""
         # build email
@@ -49,102 +108,322 @@ class EmailClient:
         msg['Subject'] = subject
         msg.set_content(content)
 
-        # send email
-        server = SMTP_SSL(self.SMTP_HOST, self.SMTP_PORT)
-        server.login(self.email_account, self.email_key)
-        server.send_message(msg)
-        server.quit()
-
-    def _get_from_to_size(self,
-            size_response: bytes,
-            body_header_response: bytes) -> Tuple[str, str, int]:
-        addresses = body_header_response.decode('utf8').splitlines()
-        _, from_email = parseaddr(addresses[0])
-        _, to_email = parseaddr(addresses[1])
-        search_result = re.search(r'RFC822\.SIZE (\d+)', size_response.decode('ascii'))
-        assert search_result is not None
-        size = int(search_result.group(1))
-        return from_email, to_email, size
-
-
-    def _get_midi_attachment_from_msg(self, msg: Message) -> Tuple[Optional[str], Optional[bytes]]:
-        for part in msg.walk():
-            if part.get_content_type() == 'audio/midi' or \
-                (part.get_content_type() == 'application/octet-stream' and \
-                (part.get_filename() or '')[-4:].lower() == '.mid'):
-                assert part.get('Content-Transfer-Encoding') in [None, 'base64']
-                payload_encoded = part.get_payload()
-                assert isinstance(payload_encoded, str)
-                payload_decoded = base64.b64decode(payload_encoded)
-                return part.get_filename(), payload_decoded
-        return None, None
-
-    def req_email_midi_attachments(self, mailbox: str) -> Iterator[RequestEmail]:
-        """Check IMAP mailbox and return all emailed MIDIs"""
-        imap = IMAP4_SSL(host=EmailClient.IMAP_HOST, port=EmailClient.IMAP_PORT, timeout=15*60)
-        imap.login(self.email_account, self.email_key)
-        imap.select(mailbox)
+        # send email, reusing the session and reconnecting once if it was dropped
+        with EMAIL_SECONDS.time(protocol='smtp', method='send'):
+            try:
+                self._get_smtp().send_message(msg)
+            except SMTPServerDisconnected:
+                self.smtp = None
+                self._get_smtp().send_message(msg)
+        if is_enabled():
+            EMAIL_BYTES.inc(len(msg.as_bytes()), protocol='smtp')
+
+    @staticmethod
+    def _tokenize_imap(text: bytes) -> Iterator[Union[str, bytes, None]]:
+        """Split IMAP response text into parens, atoms and strings; NIL is None"""
+        pos = 0
+        while pos < len(text):
+            char = text[pos:pos+1]
+            if char in b' \r\n':
+                pos += 1
+            elif char in b'()':
+                yield char.decode('ascii')
+                pos += 1
+            elif char == b'"':
+                end = pos + 1
+                value = bytearray()
+                while end < len(text) and text[end:end+1] != b'"':
+                    if text[end:end+1] == b'\\':
+                        end += 1
+                    value += text[end:end+1]
+                    end += 1
+                yield bytes(value)
+                pos = end + 1
+            else:
+                end = pos
+                while end < len(text) and text[end:end+1] not in b' ()\r\n':
+                    if text[end:end+1] == b'[':
+                        end = text.index(b']', end)
+                    end += 1
+                atom = text[pos:end].decode('ascii')
+                yield None if atom.upper() == 'NIL' else atom
+                pos = end
+
+    @classmethod
+    def _parse_imap_fetch(cls, data: list) -> List[Dict[str, Any]]:
+        """Parse the data of a FETCH response into a dictionary per message
+
+        Atoms are `str`, strings and literals are `bytes`, lists are `list`."""
+        tokens: List[Union[str, bytes, None, Tuple[bytes]]] = []
+        for segment in data:
+            if isinstance(segment, tuple):
+                text, literal = segment
+                tokens.extend(cls._tokenize_imap(re.sub(rb'\{\d+\}$', b'', text)))
+                tokens.append((literal,))
+            elif segment:
+                tokens.extend(cls._tokenize_imap(segment))
+
+        def parse(pos: int) -> Tuple[Any, int]:
+            token = tokens[pos]
+            if token == '(':
+                values = []
+                pos += 1
+                while tokens[pos] != ')':
+                    value, pos = parse(pos)
+                    values.append(value)
+                return values, pos + 1
+            if isinstance(token, tuple):
+                return token[0], pos + 1
+            return token, pos + 1
+
+        messages = []
+        pos = 0
+        while pos < len(tokens):
+            _, pos = parse(pos) # message sequence number
+            items, pos = parse(pos)
+            messages.append({
+                str(key).upper(): value for key, value in zip(items[::2], items[1::2])
+            })
+        return messages
+
+    @staticmethod
+    def _get_params(params: Optional[list]) -> Dict[str, str]:
+        """Convert a BODYSTRUCTURE parameter list to a dictionary"""
+        if not params:
+            return {}
+        return {
+            key.decode('utf8').lower(): str(make_header(decode_header(value.decode('utf8'))))
+            for key, value in zip(params[::2], params[1::2])
+        }
+
+    @classmethod
+    def _get_midi_part(cls, body: list, part: str = '') -> Optional[Tuple[str, str, str]]:
+        """Return part number, filename and encoding of the first MIDI in `body`"""
+        if isinstance(body[0], list):
+            # multipart, children come before the subtype
+            for index, child in enumerate(takewhile(lambda x: isinstance(x, list), body)):
+                midi_part = cls._get_midi_part(child, f'{part}.{index+1}' if part else str(index+1))
+                if midi_part:
+                    return midi_part
+            return None
+        content_type = f'{body[0].decode("ascii")}/{body[1].decode("ascii")}'.lower()
+        # extension fields follow the type specific fields
+        extension = 10 if content_type == 'message/rfc822' else \
+            8 if content_type.startswith('text/') else 7
+        disposition = body[extension + 1] if len(body) > extension + 1 else None
+        filename = cls._get_params(disposition[1] if disposition else None).get('filename') or \
+            cls._get_params(body[2]).get('name') or ''
+        if content_type == 'audio/midi' or \
+            (content_type == 'application/octet-stream' and filename[-4:].lower() == '.mid'):
+            return part or '1', filename, body[5].decode('ascii').lower()
+        return None
+
+    @classmethod
+    def _decode_payload(cls, payload: bytes, encoding: str) -> bytes:
+        """Decode a downloaded part given its (lower case) transfer encoding"""
+        assert encoding in cls.MIDI_ENCODINGS
+        if encoding == 'base64':
+            return cls._decode_base64(payload)
+        if encoding == 'quoted-printable':
+            return quopri.decodestring(payload)
+        return payload
+
+    @staticmethod
+    def _decode_base64(encoded: bytes) -> bytes:
+        """Decode base64 line by line, tolerating lines that do not end on a
+        base64 quantum"""
+        decoded = bytearray()
+        remainder = b''
+        for line in io.BytesIO(encoded):
+            chunk = remainder + line.strip()
+            usable = len(chunk) - len(chunk) % 4
+            decoded += binascii.a2b_base64(chunk[:usable])
+            remainder = chunk[usable:]
+        return bytes(decoded)
+
+    @traced()
+    def _get_request_email(self, imap: IMAP4, message: Dict[str, Any]) -> RequestEmail:
+        """Validate a message from its FETCH summary, downloading the MIDI part"""
+        headers = BytesHeaderParser().parsebytes(message['BODY[HEADER.FIELDS (FROM TO)]'])
+        _, from_email = parseaddr(headers['From'])
+        _, to_email = parseaddr(headers['To'])
+
+        # skip if email too big
+        if int(message['RFC822.SIZE']) > 1024*1024:
+            return RequestEmail(
+                validation_result=RequestEmailValidationResult.TOO_BIG,
+                from_email=from_email,
+                to_email=to_email,
+                midi_name=None,
+                midi_data=None,
+            )
+
+        # look for MIDI attachment
+        midi_part = self._get_midi_part(message['BODYSTRUCTURE'])
+        if midi_part is None:
+            return RequestEmail(
+                validation_result=RequestEmailValidationResult.NO_MIDI,
+                from_email=from_email,
+                to_email=to_email,
+                midi_name=None,
+                midi_data=None,
+            )
+        part, midi_name, encoding = midi_part
+        if encoding not in self.MIDI_ENCODINGS:
+            return RequestEmail(
+                validation_result=RequestEmailValidationResult.BAD_ENCODING,
+                from_email=from_email,
+                to_email=to_email,
+                midi_name=None,
+                midi_data=None,
+            )
+        with EMAIL_SECONDS.time(protocol='imap', method='fetch_part'):
+            result, data = imap.uid('FETCH', message['UID'], f'(BODY.PEEK[{part}])')
+        assert result == 'OK'
+        payload = self._parse_imap_fetch(data)[0][f'BODY[{part}]']
+        EMAIL_BYTES.inc(len(payload), protocol='imap')
+        return RequestEmail(
+            validation_result=RequestEmailValidationResult.OK,
+            from_email=from_email,
+            to_email=to_email,
+            midi_name=midi_name,
+            midi_data=self._decode_payload(payload, encoding),
+        )
+
+    @timed(EMAIL_SECONDS, protocol='imap', method='connect')
+    @traced()
+    def _connect_imap(self, mailbox: str) -> Tuple[IMAP4, int, int]:
+        """Log in and select `mailbox`, returning its UIDVALIDITY and UIDNEXT"""
+        imap_class = IMAP4_SSL if self.use_ssl else IMAP4
+        imap = imap_class(host=self.imap_host, port=self.imap_port, timeout=self.IMAP_TIMEOUT)
+        try:
+            imap.login(self.email_account, self.email_key)
+            result, _ = imap.select(mailbox)
+            assert result == 'OK'
+        except BaseException:
+            self._close_imap(imap)
+            raise
+        _, uidvalidity = imap.response('UIDVALIDITY')
+        _, uidnext = imap.response('UIDNEXT')
+        return imap, int(uidvalidity[0]), int(uidnext[0])
+
+    @staticmethod
+    def _close_imap(imap: IMAP4) -> None:
+        """Close the connection of a session that is given up on"""
+        try:
+            imap.shutdown()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _has_response(imap: IMAP4) -> bool:
+        """Return whether a response can be read without blocking
+
+        Data the reader or the SSL layer already took off the socket is not
+        seen by select, so this peeks at the reader without blocking."""
+        timeout = imap.sock.gettimeout()
+        imap.sock.settimeout(0)
+        try:
+            return bool(cast(io.BufferedReader, imap.file).peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            imap.sock.settimeout(timeout)
+
+    def _idle(self, imap: IMAP4) -> None:
+        """Wait in IDLE until the mailbox changes or it is time to renew"""
+        tag = imap._new_tag() # pylint: disable=protected-access
+        imap.send(tag + b' IDLE\r\n')
+        response = imap.readline()
+        if not response.startswith(b'+'):
+            raise IMAP4.abort(f'IDLE rejected: {response!r}')
+        # wait on the socket rather than time out reading it, which would
+        # leave the connection unusable
+        deadline = time.monotonic() + self.IDLE_RENEWAL
         while True:
-            result, data = imap.search(None, 'UNSEEN')
+            remaining = deadline - time.monotonic()
+            if not self._has_response(imap) and (remaining <= 0
+                    or not select.select([imap.sock], [], [], remaining)[0]):
+                logging.info('Renewing IDLE...')
+                break
+            response = imap.readline()
+            if not response:
+                raise IMAP4.abort('Connection closed while idling')
+            logging.info('Received response: %s', response)
+            if re.match(rb'\* \d+ EXISTS', response):
+                break
+        imap.send(b'DONE\r\n')
+        while not response.startswith(tag):
+            response = imap.readline()
+            if not response:
+                raise IMAP4.abort('Connection closed ending IDLE')
+
+    def _sync_mailbox(self, imap: IMAP4, state: MailboxState,
+            on_sync: Callable[[MailboxState], None],
+            search: str) -> Iterator[RequestEmail]:
+        """Yield requests for messages matching `search`, advancing `state`"""
+        with EMAIL_SECONDS.time(protocol='imap', method='search'):
+            result, data = imap.uid('SEARCH', search)
+        assert result == 'OK'
+        # a `n:*` search always matches the last message, even below `n`
+        uids = [uid for uid in data[0].decode('ascii').split() if int(uid) > state.last_uid]
+        if uids:
+            # summarize all new messages in one round-trip
+            with EMAIL_SECONDS.time(protocol='imap', method='fetch_summary'):
+                result, data = imap.uid('FETCH', ','.join(uids),
+                    '(RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM TO)])')
             assert result == 'OK'
-            for num in data[0].split():
-                # get size of email, and to/from addresses
-                result, data = imap.fetch(num, '(RFC822.SIZE BODY[HEADER.FIELDS (FROM TO)])')
-                assert result == 'OK'
-                assert isinstance(data, list)
-                from_email, to_email, size = self._get_from_to_size(data[0][0], data[0][1])
-
-                # skip if email too big
-                if size > 1024*1024:
-                    #imap.store(num, '+FLAGS', '\\Seen')
-                    yield RequestEmail(
-                        validation_result=RequestEmailValidationResult.TOO_BIG,
-                        from_email=from_email,
-                        to_email=to_email,
-                        midi_name=None,
-                        midi_data=None,
-                    )
-                    continue
-
-                # parse email body
-                result, data = imap.fetch(num, 'RFC822')
-                assert result == 'OK'
-                assert isinstance(data, list)
-                msg = message_from_bytes(data[0][1])
-
-                # look for MIDI attachment
-                midi_name, midi_data = self._get_midi_attachment_from_msg(msg)
-                if midi_name and midi_data:
-                    yield RequestEmail(
-                        validation_result=RequestEmailValidationResult.OK,
-                        from_email=from_email,
-                        to_email=to_email,
-                        midi_name=midi_name,
-                        midi_data=midi_data
-                    )
+            messages = [message for message in self._parse_imap_fetch(data)
+                if 'UID' in message and 'BODYSTRUCTURE' in message]
+            for message in sorted(messages, key=lambda message: int(message['UID'])):
+                try:
+                    request_email = self._get_request_email(imap, message)
+                except (OSError, IMAP4.abort):
+                    raise
+                except Exception: # pylint: disable=broad-exception-caught
+                    # skip it rather than fail on it again after every restart,
+                    # flagged so it can be looked into
+                    logging.exception('Could not read email %s, skipping it', message['UID'])
+                    imap.uid('STORE', message['UID'], '+FLAGS', '(\\Seen \\Flagged)')
                 else:
-                    yield RequestEmail(
-                        validation_result=RequestEmailValidationResult.NO_MIDI,
-                        from_email=from_email,
-                        to_email=to_email,
-                        midi_name=None,
-                        midi_data=None,
-                    )
-
-            logging.info('Waiting for new emails...')
-            tag = imap._new_tag().decode('ascii') # pylint: disable=protected-access
-            imap.send(f'{tag} IDLE\r\n'.encode('ascii'))
-            response = imap.readline()
-            assert response == b'+ idling\r\n'
+                    yield request_email
+                    imap.uid('STORE', message['UID'], '+FLAGS', '(\\Seen)')
+                state.last_uid = max(state.last_uid, int(message['UID']))
+                on_sync(state)
+
+    def req_email_midi_attachments(self, mailbox: str,
+            state: Optional[MailboxState] = None,
+            on_sync: Callable[[MailboxState], None] = lambda state: None
+            ) -> Iterator[RequestEmail]:
+        """Watch IMAP mailbox and return all emailed MIDIs, resuming after `state`
+
+        `on_sync` is called with the updated state after each message and each
+        IDLE wake up, so that the caller can persist it."""
+        backoff = 1
+        while True:
+            imap: Optional[IMAP4] = None
             try:
-                response = imap.readline()
-                if response:
-                    logging.info('Received response: %s', response)
-                else:
-                    logging.info('Empty response, breaking...')
-                    break
-            except socket.timeout:
-                logging.info('Timed out waiting for new email.')
-                break
-            imap.send(f'{tag} DONE\r\n'.encode('ascii'))
-            logging.info('Received a new email?')
+                imap, uidvalidity, uidnext = self._connect_imap(mailbox)
+                backoff = 1
+                if state is None or state.uidvalidity != uidvalidity:
+                    # unknown position, handle whatever is still unread and
+                    # only persist the position once that is done
+                    logging.info('Syncing unseen emails of UIDVALIDITY %d...', uidvalidity)
+                    state = MailboxState(uidvalidity=uidvalidity, last_uid=0)
+                    yield from self._sync_mailbox(imap, state, lambda state: None, 'UNSEEN')
+                    state.last_uid = max(state.last_uid, uidnext - 1)
+                    on_sync(state)
+                while True:
+                    yield from self._sync_mailbox(imap, state, on_sync,
+                        f'UID {state.last_uid + 1}:*')
+                    logging.info('Waiting for new emails...')
+                    self._idle(imap)
+                    on_sync(state)
+            except (OSError, IMAP4.abort) as error:
+                logging.warning('IMAP connection failed (%s), reconnecting in %d seconds...',
+                    error, backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.IMAP_MAX_BACKOFF)
+            finally:
+                if imap is not None:
+                    self._close_imap(imap)
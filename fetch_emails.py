@@ -1,94 +1,212 @@
 """Script to ingest emailed MIDI attachments and enqeue them"""
-from os import environ
+from os import environ, getpid, kill
 import logging
+import queue
 import re
+import signal
+import threading
+from dataclasses import replace
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Optional, Tuple, Union
 
 from dotenv import load_dotenv
+import psycopg2
 import sdnotify # type: ignore
 
-from email_client import EmailClient, RequestEmailValidationResult
-from queue_client import Queue, QueueItem
+import metrics
+import tracing
+from email_client import EmailClient, RequestEmail, RequestEmailValidationResult, MailboxState
+from outbox import Outbox
+from queue_client import Queue, QueueItem, SchedulingPolicy, AdmissionResult
 from synth import Synth
 from user import UserEmail
 from midi_validator import MidiValidator, MidiValidatorResult
+from midi_processor import MidiProcessor
 
 load_dotenv()
 
+MAILBOX = 'dtmaas'
+
 def get_synth_id(to_email: str) -> str:
-    """Extract the synth id from the email's TO field"""
+    """Extract the synth id from the email's TO field, empty if it has none"""
     result = re.search(r'\+(\w+)@', to_email)
-    assert result is not None
-    return result.group(1)
+    return result.group(1) if result else ''
+
+def validate_midi(midi_data: bytes) -> Tuple[MidiValidatorResult, bytes, int]:
+    """Validate `midi_data` and return the result with the MIDI compacted for
+    playback and its length in seconds"""
+    result = MidiValidator.get_result(midi_data)
+    if result != MidiValidatorResult.OK:
+        return result, midi_data, 0
+    midi_data = MidiProcessor.compact(midi_data)
+    return result, midi_data, MidiProcessor.get_data_length(midi_data)
+
+class IngestPipeline:
+    """Validates, enqueues and replies to request emails off the IMAP thread
+
+    Emails are validated concurrently, with large MIDI files parsed in a
+    separate process. A single thread then enqueues them in arrival order,
+    writes the replies to the outbox and records mailbox sync points, so a
+    state is only saved once every email before it is handled.
+    """
+    LARGE_MIDI_SIZE = 32*1024
+
+    def __init__(self, workers: int, size: int):
+        self.validators = ThreadPoolExecutor(workers, thread_name_prefix='validate')
+        self.parsers = ProcessPoolExecutor(workers)
+        self.pending: queue.Queue[Union[Tuple[RequestEmail, Future], MailboxState, None]] = \
+            queue.Queue(size)
+        self.enqueuer = threading.Thread(target=self._enqueue_loop, name='enqueue')
+        self.enqueuer.start()
+
+    def submit(self, request_email: RequestEmail):
+        """Start validating `request_email`, blocks while the pipeline is full"""
+        future = self.validators.submit(self._validate, request_email)
+        self.pending.put((request_email, future))
+
+    def sync(self, state: MailboxState):
+        """Save `state` once every email submitted before it is enqueued"""
+        # the email client keeps updating its state, so queue a snapshot
+        self.pending.put(replace(state))
+
+    def close(self):
+        """Drain the pipeline and wait for all emails to be handled"""
+        if self.enqueuer.is_alive():
+            self.pending.put(None)
+            self.enqueuer.join()
+        self.validators.shutdown()
+        self.parsers.shutdown()
+
+    def _validate(self, request_email: RequestEmail) -> Tuple[Optional[QueueItem], str]:
+        """Return a queue item for `request_email`, or None and an error reply"""
+        if request_email.validation_result != RequestEmailValidationResult.OK:
+            logging.info('Request email status "%s" from %s',
+                request_email.validation_result, request_email.from_email)
+            return None, f'Sorry but I could not process your request ' \
+                f'because "{request_email.validation_result.value}"'
+        assert request_email.midi_name is not None
+        assert request_email.midi_data is not None
+        try:
+            synth = Synth.from_id(get_synth_id(request_email.to_email))
+        except TypeError as e:
+            logging.info('Synth status "%s" for %s', e, request_email.to_email)
+            return None, f'Sorry but I could not process your request because "{e}"'
+
+        if len(request_email.midi_data) > self.LARGE_MIDI_SIZE:
+            midi_validation_result, midi_data, midi_length = self.parsers.submit(
+                validate_midi, request_email.midi_data).result()
+        else:
+            midi_validation_result, midi_data, midi_length = \
+                validate_midi(request_email.midi_data)
+        if midi_validation_result != MidiValidatorResult.OK:
+            logging.info('MIDI status "%s" for "%s"',
+                midi_validation_result, request_email.midi_name)
+            return None, f'Sorry but I could not process your MIDI ' \
+                f'because "{midi_validation_result.value}"'
+
+        logging.info('MIDI file "%s" valid', request_email.midi_name)
+        return QueueItem.factory(
+            user=UserEmail(email=request_email.from_email),
+            synth=synth,
+            midi_file=request_email.midi_name,
+            midi_data=midi_data,
+            midi_length=midi_length,
+        ), ''
+
+    def _enqueue_loop(self):
+        """Enqueue validated emails and save sync points in arrival order
+
+        A failing email gets an error reply and is passed over, only losing
+        the database connection stops ingestion."""
+        try:
+            while (entry := self.pending.get()) is not None:
+                if isinstance(entry, MailboxState):
+                    Queue.set_mailbox_state(MAILBOX, entry)
+                    continue
+                request_email, future = entry
+                try:
+                    self._handle(request_email, future)
+                except Exception as e: # pylint: disable=broad-exception-caught
+                    if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                        raise
+                    # its sync point still follows, so it would not be
+                    # fetched again, tell the user rather than go quiet
+                    logging.exception('Could not handle email from %s',
+                        request_email.from_email)
+                    Outbox.put(to_email=request_email.from_email,
+                        subject='DTMaaS Error Confirmation',
+                        content='Sorry but something went wrong processing your request')
+        except Exception:
+            logging.exception('Enqueueing failed, stopping...')
+            kill(getpid(), signal.SIGINT)
+            raise
+
+    def _handle(self, request_email: RequestEmail, future: Future):
+        """Enqueue a validated email and queue its reply"""
+        queue_item, content = future.result()
+        enqueued = False
+        if queue_item is not None:
+            enqueued, content = self._enqueue(queue_item)
+        subject = 'DTMaaS Success Confirmation' if enqueued \
+            else 'DTMaaS Error Confirmation'
+        Outbox.put(to_email=request_email.from_email, subject=subject, content=content)
+        logging.info('Successfully handled email from %s', request_email.from_email)
+
+    @staticmethod
+    def _enqueue(queue_item: QueueItem) -> Tuple[bool, str]:
+        """Admit and enqueue `queue_item`, returning whether it was and the reply"""
+        admission_result, coalesced = Queue.admit_queue_item(queue_item)
+        if admission_result != AdmissionResult.OK:
+            logging.info('Admission status "%s" for "%s"',
+                admission_result, queue_item.midi_file)
+            return False, f'Sorry but I could not queue your MIDI ' \
+                f'because "{Queue.get_admission_message(admission_result)}"'
+        minutes = Queue.get_queue_length(queue_item.synth, queue_item)
+        if coalesced:
+            logging.info('Subscribed to "%s" with id "%s"', queue_item.midi_file, queue_item.uuid)
+            return True, f'Your MIDI file "{queue_item.midi_file}" looks good ' \
+                f'and is already slated to be recorded on a {queue_item.synth.get_name()} ' \
+                f'for someone else, so you will get the same recording! ' \
+                f'Expect an email in about {minutes} minutes...'
+        logging.info('Enqueued "%s" with id "%s"', queue_item.midi_file, queue_item.uuid)
+        return True, f'Your MIDI file "{queue_item.midi_file}" looks good ' \
+            f'and is slated to be recorded on a {queue_item.synth.get_name()}! ' \
+            f'Expect an email in about {minutes} minutes...'
 
 def main():
     """Main program"""
     logging.basicConfig(level=logging.INFO)
     logging.info('Started.')
+    metrics.start('fetch_emails')
+    tracing.start('fetch_emails')
     system_notifier = sdnotify.SystemdNotifier()
     email = EmailClient(
         email_account=environ['EMAIL_ACCOUNT'],
         email_key=environ['EMAIL_ACCOUNT_KEY']
     )
+    logging.info('Connecting to queue...')
+    Queue.connect(environ['DATABASE_URL'],
+        SchedulingPolicy(environ.get('QUEUE_POLICY', 'fair_share')))
+    Outbox.connect(environ['DATABASE_URL'])
+    pipeline = IngestPipeline(
+        workers=int(environ.get('INGEST_WORKERS', '4')),
+        size=int(environ.get('INGEST_QUEUE_SIZE', '64')))
+
+    def on_sync(state: MailboxState):
+        pipeline.sync(state)
+        logging.info('Watchdog pulse...')
+        system_notifier.notify("WATCHDOG=1")
+
     system_notifier.notify('READY=1')
-    while True:
-        logging.info('Fetching request emails...')
-        for request_email in email.req_email_midi_attachments(mailbox='dtmaas'):
+    logging.info('Fetching request emails...')
+    try:
+        for request_email in email.req_email_midi_attachments(mailbox=MAILBOX,
+                state=Queue.get_mailbox_state(MAILBOX), on_sync=on_sync):
             logging.info('Received request email from %s to %s',
                 request_email.from_email, request_email.to_email)
-            logging.info('Watchdog pulse...')
-            system_notifier.notify("WATCHDOG=1")
-            if request_email.validation_result == RequestEmailValidationResult.OK:
-                logging.info('Request email validated, validating MIDI...')
-                midi_validation_result = MidiValidator.get_result(request_email.midi_data)
-                if midi_validation_result == MidiValidatorResult.OK:
-                    logging.info('MIDI file "%s" valid, enqueueing...', request_email.midi_name)
-
-                    synth_id = get_synth_id(request_email.to_email)
-                    synth = Synth.from_id(synth_id)
-                    queue_item = QueueItem.factory(
-                        user=UserEmail(email=request_email.from_email),
-                        synth=synth,
-                        midi_file=request_email.midi_name,
-                        midi_data=request_email.midi_data,
-                        media_path=environ['MEDIA_PATH'],
-                    )
-                    Queue.connect(environ['DATABASE_URL'])
-                    Queue.enqueue_queue_item(queue_item)
-                    minutes = Queue.get_queue_length(synth)
-                    Queue.disconnect()
-
-                    logging.info('Enqueued with id "%s", sending notification...', queue_item.uuid)
-                    content = f'Your MIDI file "{queue_item.midi_file}" looks good ' \
-                        f'and is slated to be recorded on a {synth.get_name()}! ' \
-                        f'Expect an email in about {minutes} minutes...'
-                    email.send(
-                        to_email=request_email.from_email,
-                        subject='DTMaaS Success Confirmation',
-                        content=content
-                    )
-                else:
-                    logging.info('MIDI status "%s", sending notification...',
-                        midi_validation_result)
-                    content = f'Sorry but I could not process your MIDI ' \
-                        f'because "{midi_validation_result.value}"'
-                    email.send(
-                        to_email=request_email.from_email,
-                        subject='DTMaaS Error Confirmation',
-                        content=content
-                    )
-                    logging.info('Successfully handled email from %s', request_email.from_email)
-            else:
-                logging.info('Request email status "%s", sending notification...',
-                    request_email.validation_result)
-                content = f'Sorry but I could not process your request ' \
-                    f'because "{request_email.validation_result.value}"'
-                email.send(
-                    to_email=request_email.from_email,
-                    subject='DTMaaS Error Confirmation',
-                    content=content
-                )
-        logging.info('Watchdog pulse...')
-        system_notifier.notify("WATCHDOG=1")
+            pipeline.submit(request_email)
+    finally:
+        pipeline.close()
     logging.error('Done?')
 
 if __name__ == "__main__":
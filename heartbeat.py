@@ -0,0 +1,170 @@
+"""Watchdog heartbeat tied to the progress of the stage being worked on"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, Iterator, List, Optional, Tuple
+
+import sdnotify # type: ignore
+
+# a probe returns a counter that grows while the stage makes progress,
+# and optionally the fraction of the stage done
+Probe = Callable[[], Tuple[int, Optional[float]]]
+
+def get_file_size(path: str) -> int:
+    """Return the size of the file at `path`, or 0 if it does not exist yet"""
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+
+def get_children_cpu_ticks(pid: Optional[int] = None) -> int:
+    """Return the CPU ticks used by the live child processes of `pid`"""
+    pid = os.getpid() if pid is None else pid
+    ticks = 0
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat', encoding='ascii') as fp:
+                stat = fp.read()
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        # the command name may contain spaces, so split after it
+        fields = stat[stat.rindex(')') + 2:].split()
+        if int(fields[1]) == pid:
+            ticks += int(fields[11]) + int(fields[12])
+    return ticks
+
+def file_growth_probe(path: str, expected_size: int) -> Probe:
+    """Probe a file being written towards `expected_size` bytes"""
+    def probe() -> Tuple[int, Optional[float]]:
+        size = get_file_size(path)
+        return size, min(1.0, size / expected_size) if expected_size else None
+    return probe
+
+def subprocess_probe(output_paths: List[str]) -> Probe:
+    """Probe child processes by the CPU they use and the output they write"""
+    def probe() -> Tuple[int, Optional[float]]:
+        return get_children_cpu_ticks() \
+            + sum(get_file_size(path) for path in output_paths), None
+    return probe
+
+class ProgressReader:
+    """File wrapper counting the bytes read from it, for upload progress"""
+    def __init__(self, fp: BinaryIO, size: int):
+        self.fp = fp
+        self.size = size
+        self.bytes_read = 0
+
+    def __len__(self) -> int:
+        # lets requests send a Content-Length instead of chunking
+        return self.size - self.bytes_read
+
+    def read(self, size: int = -1) -> bytes:
+        """Read from the wrapped file, counting the bytes"""
+        data = self.fp.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def probe(self) -> Tuple[int, Optional[float]]:
+        """Probe the upload reading this file"""
+        return self.bytes_read, self.bytes_read / self.size if self.size else None
+
+class Heartbeat:
+    """Pulses the systemd watchdog from a thread for as long as work progresses
+
+    Outside of a stage the worker waits for queue items or moves between
+    stages, and the main loop reports it is alive with `alive`. Inside a stage
+    the pulse is withheld once its probe has not advanced for `stall_timeout`
+    seconds, and outside of one once the main loop has not reported for as
+    long, so systemd restarts a wedged worker.
+    """
+    INTERVAL = 5
+    STALL_TIMEOUT = 45
+
+    def __init__(self, notifier: sdnotify.SystemdNotifier,
+            interval: float = INTERVAL, stall_timeout: float = STALL_TIMEOUT):
+        self.notifier = notifier
+        self.interval = interval
+        self.stall_timeout = stall_timeout
+        self.lock = threading.Lock()
+        self.stage_name: Optional[str] = None
+        self.probe: Optional[Probe] = None
+        self.last_value: Optional[int] = None
+        self.last_progress = time.monotonic()
+        self.last_alive = time.monotonic()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='heartbeat', daemon=True)
+
+    def start(self):
+        """Start pulsing"""
+        self.thread.start()
+
+    def close(self):
+        """Stop pulsing"""
+        self.stopped.set()
+        self.thread.join()
+
+    def alive(self):
+        """Report the main loop is running, which it must do within the stall
+        timeout whenever it is outside of a stage"""
+        with self.lock:
+            self.last_alive = time.monotonic()
+
+    @contextmanager
+    def stage(self, stage_name: str, probe: Optional[Probe] = None) -> Iterator[None]:
+        """Watch the progress of a stage, which must finish within the stall
+        timeout if it has no probe"""
+        with self.lock:
+            self.stage_name = stage_name
+            self.probe = probe
+            self.last_value = None
+            self.last_progress = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stage_name = None
+                self.probe = None
+                self.last_alive = time.monotonic()
+
+    def beat(self) -> bool:
+        """Pulse the watchdog if work is progressing, returning whether it did"""
+        with self.lock:
+            stage_name, probe, last_alive = self.stage_name, self.probe, self.last_alive
+        if stage_name is None:
+            silent = time.monotonic() - last_alive
+            if silent > self.stall_timeout:
+                logging.warning('Main loop silent for %.0fs, withholding watchdog', silent)
+                self.notifier.notify('STATUS=Not responding')
+                return False
+            self.notifier.notify('WATCHDOG=1\nSTATUS=Waiting for queue items')
+            return True
+
+        status = stage_name
+        if probe is not None:
+            try:
+                value, fraction = probe()
+            except OSError:
+                logging.exception('Progress probe for %s failed', stage_name)
+                value, fraction = self.last_value or 0, None
+            with self.lock:
+                if value != self.last_value:
+                    self.last_value = value
+                    self.last_progress = time.monotonic()
+            if fraction is not None:
+                status = f'{stage_name} {fraction:.0%}'
+        stalled = time.monotonic() - self.last_progress
+        if stalled > self.stall_timeout:
+            logging.warning('%s stalled for %.0fs, withholding watchdog', stage_name, stalled)
+            self.notifier.notify(f'STATUS={status} (stalled)')
+            return False
+        self.notifier.notify(f'WATCHDOG=1\nSTATUS={status}')
+        return True
+
+    def _run(self):
+        """Beat every interval until stopped"""
+        while not self.stopped.wait(self.interval):
+            self.beat()
@@ -0,0 +1,252 @@
+"""HTTP intake of MIDI uploads, a low latency alternative to emailing them
+
+POST /requests?email=<address>&synth=<synth id>&name=<file name> with the MIDI
+file as the body queues it to be recorded, and the recording is emailed to
+<address> as for an emailed request. The upload is validated as it arrives,
+and the response gives the uuid of the queue item and the minutes until the
+recording is expected. GET /requests/<uuid> gives its status and its place
+in the queue.
+
+The intake does not authenticate anyone: whoever can reach it can have any
+<address> emailed, and admission control is keyed on that address, which
+the client chooses freely. It therefore listens on localhost only, and is
+meant to be exposed solely behind a reverse proxy that authenticates clients
+and sets <address> to the one they authenticated as.
+"""
+import json
+import logging
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ
+from typing import Any, Callable, Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+from uuid import UUID
+
+from dotenv import load_dotenv
+import psycopg2
+import sdnotify # type: ignore
+
+import metrics
+import tracing
+from metrics import Counter
+from midi_processor import MidiProcessor
+from midi_validator import MidiStreamValidator, MidiValidator, MidiValidatorResult
+from queue_client import Queue, QueueItem, SchedulingPolicy, AdmissionResult
+from synth import Synth
+from user import UserEmail
+
+load_dotenv()
+
+READ_SIZE = 16*1024
+MAX_NAME_LENGTH = 80
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+STATUS_PATH_PATTERN = re.compile(r'^/requests/([0-9a-fA-F-]{36})$')
+
+INTAKE_REQUESTS = Counter('dtmaas_intake_requests_total',
+    'HTTP intake requests by response status', ['method', 'status'])
+
+class IntakeHandler(BaseHTTPRequestHandler):
+    """Accepts MIDI uploads and reports on the queue items they became"""
+    protocol_version = 'HTTP/1.1'
+    # seconds a client may stall before its connection is dropped
+    timeout = 30
+    # the handler threads share the connection, and admission runs in a
+    # transaction on it that must not interleave with another request's
+    # queries, nor the connection be replaced while in use
+    queue_lock = threading.Lock()
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """Queue the uploaded MIDI"""
+        url = urlsplit(self.path)
+        if url.path != '/requests':
+            self.close_connection = True
+            self._respond(404, {'error': 'Not found'})
+            return
+        self._respond_to(self._post_request, parse_qs(url.query))
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """Report the status of a queue item"""
+        result = STATUS_PATH_PATTERN.match(urlsplit(self.path).path)
+        if not result:
+            self._respond(404, {'error': 'Not found'})
+            return
+        try:
+            uuid = UUID(result.group(1))
+        except ValueError:
+            self._respond(400, {'error': 'Invalid uuid'})
+            return
+        self._respond_to(self._get_request, uuid)
+
+    @tracing.traced(category='intake')
+    def _post_request(self, params: Dict[str, List[str]]) -> Tuple[int, Dict[str, Any]]:
+        """Validate and enqueue the upload, returning the response status and body"""
+        email = params.get('email', [''])[0]
+        midi_file = params.get('name', ['upload.mid'])[0]
+        if not EMAIL_PATTERN.match(email):
+            self.close_connection = True
+            return 400, {'error': 'Missing or invalid email'}
+        if len(midi_file) > MAX_NAME_LENGTH:
+            self.close_connection = True
+            return 400, {'error': f'File name too long >{MAX_NAME_LENGTH} characters'}
+        try:
+            synth = Synth.from_id(params.get('synth', [''])[0])
+        except TypeError as e:
+            self.close_connection = True
+            return 404, {'error': str(e)}
+
+        if 'Content-Length' not in self.headers:
+            self.close_connection = True
+            return 411, {'error': 'Content-Length required'}
+        try:
+            length = int(self.headers['Content-Length'])
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            return 400, {'error': 'Invalid Content-Length'}
+        validator = self._read_midi(length)
+        if validator.result != MidiValidatorResult.OK:
+            assert validator.result is not None
+            logging.info('MIDI status "%s" for "%s" from %s', validator.result, midi_file, email)
+            return 413 if validator.result == MidiValidatorResult.TOO_BIG else 400, \
+                {'error': validator.result.value}
+
+        # parsing dominates the cost of a request, so the length found while
+        # validating is kept unless compacting changed the MIDI
+        midi_data = validator.get_data()
+        compacted_data = MidiProcessor.compact(midi_data)
+        queue_item = QueueItem.factory(
+            user=UserEmail(email=email),
+            synth=synth,
+            midi_file=midi_file,
+            midi_data=compacted_data,
+            midi_length=validator.length if compacted_data is midi_data \
+                else MidiProcessor.get_data_length(compacted_data),
+        )
+        with self.queue_lock:
+            admission_result, coalesced = Queue.admit_queue_item(queue_item)
+        if admission_result != AdmissionResult.OK:
+            logging.info('Admission status "%s" for "%s" from %s',
+                admission_result, midi_file, email)
+            return 429, {'error': Queue.get_admission_message(admission_result)}
+        logging.info('%s "%s" with id "%s" from %s', 'Subscribed to' if coalesced else 'Enqueued',
+            midi_file, queue_item.uuid, email)
+        with self.queue_lock:
+            eta_minutes = Queue.get_queue_length(synth, queue_item)
+        return 202, {
+            'uuid': str(queue_item.uuid),
+            'coalesced': coalesced,
+            'eta_minutes': eta_minutes,
+            'status_url': f'/requests/{queue_item.uuid}',
+        }
+
+    def _read_midi(self, length: int) -> MidiStreamValidator:
+        """Read and validate a body of `length` bytes as it arrives, stopping
+        early once it is known to be invalid"""
+        validator = MidiStreamValidator()
+        if length > MidiValidator.MAX_FILE_SIZE:
+            self.close_connection = True
+            validator.result = MidiValidatorResult.TOO_BIG
+            return validator
+        while length > 0:
+            data = self.rfile.read(min(READ_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            if validator.feed(data) is not None:
+                break
+        if length > 0:
+            # the rest of the body is still on the connection
+            self.close_connection = True
+        validator.finish()
+        return validator
+
+    @tracing.traced(category='intake')
+    def _get_request(self, uuid: UUID) -> Tuple[int, Dict[str, Any]]:
+        """Return the response status and body reporting on queue item `uuid`"""
+        with self.queue_lock:
+            queue_item = Queue.get_queue_item(uuid)
+            if queue_item is None:
+                return 404, {'error': 'Not found'}
+            position = Queue.get_queue_item_position(queue_item)
+            return 200, {
+                'uuid': str(queue_item.uuid),
+                'status': queue_item.status.value,
+                'position': position,
+                'eta_minutes': Queue.get_queue_length(queue_item.synth, queue_item)
+                    if position is not None else None,
+            }
+
+    def _respond_to(self, request: Callable[..., Tuple[int, Dict[str, Any]]], *args):
+        """Respond with the status and body returned by `request`, or that the
+        queue is unavailable if it could not be reached"""
+        try:
+            status, body = request(*args)
+        except psycopg2.Error:
+            logging.exception('Could not reach the queue')
+            status, body = 503, {'error': 'Queue unavailable, try again later'}
+        self._respond(status, body)
+
+    def _respond(self, status: int, body: Dict[str, Any]):
+        """Send `body` as JSON"""
+        INTAKE_REQUESTS.inc(method=self.command, status=status)
+        data = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+class IntakeServer(ThreadingHTTPServer):
+    """Serves the intake, reconnecting to the queue once its connection was
+    lost and pulsing the watchdog while connected"""
+    PULSE_INTERVAL = 10
+
+    def __init__(self, server_address: Tuple[str, int], connection_url: str,
+            policy: SchedulingPolicy, system_notifier: sdnotify.SystemdNotifier):
+        super().__init__(server_address, IntakeHandler)
+        self.connection_url = connection_url
+        self.policy = policy
+        self.system_notifier = system_notifier
+        self.last_pulse = 0.
+
+    def service_actions(self):
+        if time.monotonic() - self.last_pulse < self.PULSE_INTERVAL:
+            return
+        self.last_pulse = time.monotonic()
+        with IntakeHandler.queue_lock:
+            if Queue.con is None or Queue.con.closed:
+                logging.warning('Reconnecting to queue...')
+                try:
+                    Queue.connect(self.connection_url, self.policy)
+                except psycopg2.OperationalError:
+                    logging.exception('Could not reconnect to queue')
+                    return
+        self.system_notifier.notify('WATCHDOG=1')
+
+def main():
+    """Main program"""
+    logging.basicConfig(level=logging.INFO)
+    logging.info('Started.')
+    metrics.start('intake_api')
+    tracing.start('intake_api')
+    system_notifier = sdnotify.SystemdNotifier()
+    logging.info('Connecting to queue...')
+    policy = SchedulingPolicy(environ.get('QUEUE_POLICY', 'fair_share'))
+    Queue.connect(environ['DATABASE_URL'], policy)
+    server = IntakeServer((environ.get('INTAKE_HOST', 'localhost'),
+        int(environ.get('INTAKE_PORT', '8080'))), environ['DATABASE_URL'], policy,
+        system_notifier)
+    system_notifier.notify('READY=1')
+    logging.info('Serving requests on port %d...', server.server_address[1])
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Placement and cleanup of the media files queue items produce"""
+import fcntl
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Set
+from uuid import UUID
+
+from synth import CaptureProfile
+
+class MediaManager:
+    """Stages media on a RAM-backed hot tier or on disk with reserved space
+
+    Space is reserved per queue item with a `<uuid>.reserve` sidecar file
+    holding the expected size of its media, so workers sharing a tier do not
+    overcommit it. Short recordings go to the hot tier when it has room,
+    everything else spills to disk.
+    """
+    LOCK_FILE = '.lock'
+    RESERVE_SUFFIX = '.reserve'
+    SWEEP_GRACE = 60
+    # room for the captured WAV plus encodes of it, which are smaller
+    ENCODE_OVERHEAD = .75
+
+    def __init__(self, disk_path: str, hot_path: Optional[str] = None,
+            hot_max_length: int = 5*60):
+        self.tiers = [hot_path, disk_path] if hot_path else [disk_path]
+        self.hot_path = hot_path
+        self.hot_max_length = hot_max_length
+        # a tmpfs tier comes back empty after a reboot
+        for path in self.tiers:
+            os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def from_environ() -> 'MediaManager':
+        """Create a media manager configured from the environment"""
+        return MediaManager(
+            disk_path=os.environ['MEDIA_PATH'],
+            hot_path=os.environ.get('MEDIA_HOT_PATH'),
+            hot_max_length=int(os.environ.get('MEDIA_HOT_MAX_LENGTH', 5*60)),
+        )
+
+    @staticmethod
+    def get_required_space(midi_length: int, profile: CaptureProfile) -> int:
+        """Return the bytes to reserve for a recording of `midi_length` seconds"""
+        # pad for the reset and the tail arecord keeps recording
+        return int((midi_length + 5) * profile.get_bytes_per_second()
+            * (1 + MediaManager.ENCODE_OVERHEAD))
+
+    @staticmethod
+    def get_free_space(path: str) -> int:
+        """Return the bytes available to unprivileged users at `path`"""
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+
+    @contextmanager
+    def _locked(self, path: str) -> Iterator[None]:
+        """Serialize reservations on a tier between processes"""
+        with open(os.path.join(path, self.LOCK_FILE), 'a', encoding='ascii') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _get_files(self, path: str, uuid: Optional[UUID] = None) -> List[str]:
+        """Return the media files in a tier, optionally only those of `uuid`"""
+        return [name for name in os.listdir(path)
+            if name != self.LOCK_FILE and (uuid is None or name.split('.')[0] == str(uuid))]
+
+    def _get_reserved_space(self, path: str) -> int:
+        """Return the reserved bytes in a tier not yet taken up by files"""
+        reserved: Dict[str, int] = {}
+        used: Dict[str, int] = {}
+        for name in self._get_files(path):
+            uuid = name.split('.')[0]
+            try:
+                if name.endswith(self.RESERVE_SUFFIX):
+                    with open(os.path.join(path, name), encoding='ascii') as fp:
+                        reserved[uuid] = int(fp.read() or 0)
+                else:
+                    used[uuid] = used.get(uuid, 0) + os.stat(os.path.join(path, name)).st_size
+            except FileNotFoundError:
+                continue
+        return sum(max(0, size - used.get(uuid, 0)) for uuid, size in reserved.items())
+
+    def locate(self, uuid: UUID) -> Optional[str]:
+        """Return the tier already holding media or a reservation for `uuid`"""
+        for path in self.tiers:
+            if os.path.exists(os.path.join(path, f'{uuid}{self.RESERVE_SUFFIX}')):
+                return path
+        return None
+
+    def reserve(self, uuid: UUID, midi_length: int, profile: CaptureProfile) -> str:
+        """Reserve space for a queue item's media and return the directory to use"""
+        path = self.locate(uuid)
+        if path is not None:
+            return path
+        size = self.get_required_space(midi_length, profile)
+        for path in self.tiers:
+            if path == self.hot_path and midi_length > self.hot_max_length:
+                continue
+            with self._locked(path):
+                free = self.get_free_space(path) - self._get_reserved_space(path)
+                if size <= free:
+                    with open(os.path.join(path, f'{uuid}{self.RESERVE_SUFFIX}'), 'w',
+                            encoding='ascii') as fp:
+                        fp.write(str(size))
+                    logging.info('Reserved %d bytes in "%s" for %s', size, path, uuid)
+                    return path
+            logging.info('Not enough space in "%s" for %d bytes', path, size)
+        raise RuntimeError(f'Not enough media space for {size} bytes')
+
+    def release(self, uuid: UUID):
+        """Remove a queue item's media and reservation from every tier"""
+        for path in self.tiers:
+            for name in self._get_files(path, uuid):
+                try:
+                    os.unlink(os.path.join(path, name))
+                except FileNotFoundError:
+                    pass
+
+    def sweep(self, live_uuids: Set[UUID]) -> int:
+        """Remove media no live queue item refers to, returning the number removed"""
+        removed = 0
+        now = time.time()
+        for path in self.tiers:
+            for name in self._get_files(path):
+                file_path = os.path.join(path, name)
+                try:
+                    uuid = UUID(name.split('.')[0])
+                except ValueError:
+                    continue
+                try:
+                    if uuid in live_uuids or now - os.stat(file_path).st_mtime < self.SWEEP_GRACE:
+                        continue
+                    os.unlink(file_path)
+                except FileNotFoundError:
+                    continue
+                logging.info('Swept orphaned media "%s"', file_path)
+                removed += 1
+        return removed
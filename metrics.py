@@ -0,0 +1,202 @@
+"""Prometheus style metrics for the hot paths, served over HTTP or written to a textfile
+
+Metrics are only collected once `start` found somewhere to expose them, until
+then recording one is a single attribute check.
+"""
+import bisect
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple, TypeVar
+
+DEFAULT_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+TEXTFILE_INTERVAL = 15
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+class Metric:
+    """A metric family with a value per combination of label values"""
+    TYPE = 'untyped'
+    enabled = False
+    registry: List['Metric'] = []
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple[str, ...], Any] = {}
+        Metric.registry.append(self)
+
+    def _get_key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        """Return the label values in declaration order"""
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        """Format label values as a Prometheus label set"""
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = [(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in pairs]
+        return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+    def _format_samples(self) -> List[str]:
+        """Return the sample lines of the metric"""
+        raise NotImplementedError
+
+    def format(self) -> str:
+        """Return the metric in the Prometheus text exposition format"""
+        with self.lock:
+            samples = self._format_samples()
+        return '\n'.join([f'# HELP {self.name} {self.help_text}',
+            f'# TYPE {self.name} {self.TYPE}'] + samples)
+
+class Counter(Metric):
+    """A monotonically increasing total"""
+    TYPE = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        """Add `amount` to the total"""
+        if not Metric.enabled:
+            return
+        key = self._get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _format_samples(self) -> List[str]:
+        return [f'{self.name}{self._format_labels(key)} {value}'
+            for key, value in self.values.items()]
+
+class Histogram(Metric):
+    """A distribution of observations, typically durations in seconds"""
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        """Add an observation"""
+        if not Metric.enabled:
+            return
+        key = self._get_key(labels)
+        with self.lock:
+            # per bucket counts followed by the sum and the count
+            counts = self.values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe the duration of the block, even if it raises"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def _format_samples(self) -> List[str]:
+        samples = []
+        for key, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(f'{self.name}_bucket'
+                    f'{self._format_labels(key, (("le", str(bound)),))} {cumulative}')
+            samples.append(f'{self.name}_bucket{self._format_labels(key, (("le", "+Inf"),))}'
+                f' {counts[-1]}')
+            samples.append(f'{self.name}_sum{self._format_labels(key)} {counts[-2]}')
+            samples.append(f'{self.name}_count{self._format_labels(key)} {counts[-1]}')
+        return samples
+
+def is_enabled() -> bool:
+    """Check whether metrics are collected, to skip measuring costly values"""
+    return Metric.enabled
+
+def timed(histogram: Histogram, **labels) -> Callable[[F], F]:
+    """Decorate a function to observe its duration, labelled with its
+    qualified name if the histogram has a `method` label"""
+    def decorator(func: F) -> F:
+        if 'method' in histogram.label_names and 'method' not in labels:
+            labels['method'] = func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not Metric.enabled:
+                return func(*args, **kwargs)
+            started = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.monotonic() - started, **labels)
+        return wrapper # type: ignore
+    return decorator
+
+def get_exposition() -> str:
+    """Return every registered metric in the Prometheus text exposition format"""
+    return ''.join(f'{metric.format()}\n' for metric in Metric.registry)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the metrics on any path"""
+    def do_GET(self): # pylint: disable=invalid-name
+        """Respond with the exposition"""
+        data = get_exposition().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+def write_textfile(path: str):
+    """Atomically replace `path` with the exposition"""
+    with open(f'{path}.tmp', 'w', encoding='utf8') as fp:
+        fp.write(get_exposition())
+    os.replace(f'{path}.tmp', path)
+
+def _write_textfile_periodically(path: str):
+    """Keep the textfile current for the life of the process"""
+    while True:
+        try:
+            write_textfile(path)
+        except OSError:
+            logging.exception('Could not write metrics to "%s"', path)
+        time.sleep(TEXTFILE_INTERVAL)
+
+def start(job: str):
+    """Start collecting metrics if METRICS_PORT or METRICS_TEXTFILE_DIR is set
+
+    METRICS_PORT serves them on localhost, METRICS_TEXTFILE_DIR writes them to
+    `dtmaas_<job>.prom` there for the node exporter's textfile collector."""
+    port = os.environ.get('METRICS_PORT')
+    textfile_dir = os.environ.get('METRICS_TEXTFILE_DIR')
+    if port:
+        try:
+            server = ThreadingHTTPServer(('localhost', int(port)), MetricsHandler)
+        except OSError:
+            logging.exception('Could not serve metrics on port %s', port)
+        else:
+            threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+            logging.info('Serving metrics on port %s', port)
+            Metric.enabled = True
+    if textfile_dir:
+        path = os.path.join(textfile_dir, f'dtmaas_{job}.prom')
+        threading.Thread(target=_write_textfile_periodically, args=(path,),
+            name='metrics', daemon=True).start()
+        logging.info('Writing metrics to "%s"', path)
+        Metric.enabled = True
+
+# metrics shared between modules
+DB_QUERY_SECONDS = Histogram('dtmaas_db_query_seconds',
+    'Latency of database calls', ['method'])
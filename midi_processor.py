@@ -1,4 +1,6 @@
 """Handles playing, recording, and encoding of MIDI files"""
+import io
+import os
 import subprocess
 import signal
 import shutil
@@ -6,13 +8,96 @@ import math
 import time
 import logging
 import re
+import threading
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import accumulate
+from typing import IO, List, Optional, Set, Tuple
 
 import mido # type: ignore
 
-from synth import Synth
+from metrics import Counter
+from synth import Synth, CaptureProfile, DEFAULT_CAPTURE_PROFILE
+from tracing import bind, span, traced
+
+DEFAULT_TEMPO = 500000
+# what arecord prints when it recovers from an xrun
+XRUN_PATTERN = re.compile(r'\b(?:overrun|underrun)!!!')
+
+CAPTURES = Counter('dtmaas_captures_total', 'Audio captures completed', ['synth'])
+CAPTURE_XRUNS = Counter('dtmaas_capture_xruns_total',
+    'Overruns arecord recovered from during captures', ['synth'])
+
+@dataclass(frozen=True)
+class CapturePriority:
+    """How arecord is scheduled: pinned to `cpus`, at SCHED_FIFO `rt_priority`
+    and in the realtime IO class at `io_priority`, each left alone when unset"""
+    cpus: str = ''
+    rt_priority: int = 0
+    io_priority: Optional[int] = None
+
+    @staticmethod
+    def from_environ() -> 'CapturePriority':
+        """Create a capture priority configured from the environment"""
+        io_priority = os.environ.get('CAPTURE_IO_PRIORITY', '')
+        return CapturePriority(
+            cpus=os.environ.get('CAPTURE_CPUS', ''),
+            rt_priority=int(os.environ.get('CAPTURE_RT_PRIORITY', 0)),
+            io_priority=int(io_priority) if io_priority else None,
+        )
+
+    def get_commands(self) -> List[List[str]]:
+        """Return the commands arecord is run through, outermost first"""
+        commands = []
+        if self.cpus:
+            commands.append(['taskset', '--cpu-list', self.cpus])
+        if self.rt_priority:
+            commands.append(['chrt', '--fifo', str(self.rt_priority)])
+        if self.io_priority is not None:
+            commands.append(['ionice', '--class', '1', '--classdata', str(self.io_priority)])
+        return commands
+
+DEFAULT_CAPTURE_PRIORITY = CapturePriority()
+
+class TempoMap:
+    """Converts between absolute ticks and seconds following the tempo changes"""
+    def __init__(self, midi_file: mido.MidiFile):
+        self.ticks_per_beat = midi_file.ticks_per_beat
+        changes = sorted((tick, message.tempo) for track in midi_file.tracks
+            for tick, message in zip(accumulate(message.time for message in track), track)
+            if message.type == 'set_tempo')
+        self.ticks = [0]
+        self.tempos = [DEFAULT_TEMPO]
+        self.seconds = [0.]
+        for tick, tempo in changes:
+            self.seconds.append(self.get_seconds(tick))
+            self.ticks.append(tick)
+            self.tempos.append(tempo)
+
+    def get_seconds(self, tick: int) -> float:
+        """Return the time in seconds of `tick`"""
+        index = bisect_right(self.ticks, tick) - 1
+        return self.seconds[index] + \
+            (tick - self.ticks[index]) * self.tempos[index] / self.ticks_per_beat / 1e6
+
+    def get_tick(self, seconds: float) -> int:
+        """Return the tick at `seconds`, rounded down"""
+        index = bisect_right(self.seconds, seconds) - 1
+        return self.ticks[index] + int((seconds - self.seconds[index]) * 1e6
+            * self.ticks_per_beat / self.tempos[index])
 
 class MidiProcessor:
     """Class for handling processing of MIDI files"""
+    # seconds of silence kept before the first note and of each long rest
+    COMPACT_LEAD_IN = 1.
+    COMPACT_MAX_REST = 3.
+    # sox output options of each supported rendition, keyed by extension
+    RENDITION_OPTIONS = {
+        'flac': ['-b', '24'],
+        'mp3': ['-C', '192'],
+        'ogg': ['-C', '5'],
+    }
 
     @staticmethod
     def get_length(midi_path: str) -> int:
@@ -21,6 +106,99 @@ class MidiProcessor:
         return math.ceil(midi_file.length)
 
     @staticmethod
+    def get_data_length(midi_data: bytes) -> int:
+        """Return the length in seconds of the given `midi_data`"""
+        midi_file = mido.MidiFile(file=io.BytesIO(midi_data))
+        return math.ceil(midi_file.length)
+
+    @staticmethod
+    def _get_rests(midi_file: mido.MidiFile) -> List[Tuple[int, int]]:
+        """Return the tick ranges in which no note sounds or is sustained,
+        from the start and up to the end of the file"""
+        events = sorted((tick, index, position, message)
+            for index, track in enumerate(midi_file.tracks)
+            for position, (tick, message) in enumerate(
+                zip(accumulate(message.time for message in track), track)))
+        sounding = 0
+        sustained: Set[int] = set()
+        rests = []
+        silent_since = 0
+        for tick, _, _, message in events:
+            was_silent = sounding == 0 and not sustained
+            if message.type == 'note_on' and message.velocity > 0:
+                sounding += 1
+            elif message.type in ('note_on', 'note_off'):
+                sounding = max(0, sounding - 1)
+            elif message.type == 'control_change' and message.control == 64:
+                if message.value >= 64:
+                    sustained.add(message.channel)
+                else:
+                    sustained.discard(message.channel)
+            is_silent = sounding == 0 and not sustained
+            if was_silent and not is_silent:
+                rests.append((silent_since, tick))
+            elif is_silent and not was_silent:
+                silent_since = tick
+        if events and sounding == 0 and not sustained:
+            rests.append((silent_since, events[-1][0]))
+        return rests
+
+    @staticmethod
+    @traced()
+    def compact(midi_data: bytes, lead_in: float = COMPACT_LEAD_IN,
+            max_rest: float = COMPACT_MAX_REST) -> bytes:
+        """Return `midi_data` with silence before the first note cut to
+        `lead_in` seconds and longer rests to `max_rest` seconds
+
+        Events within a cut, like controller changes, sysex and tempo changes,
+        are kept in order at its end so the state they set up is intact."""
+        midi_file = mido.MidiFile(file=io.BytesIO(midi_data))
+        if midi_file.type not in (0, 1):
+            return midi_data
+        if not any(message.type == 'note_on' and message.velocity > 0
+                for track in midi_file.tracks for message in track):
+            return midi_data
+        tempo_map = TempoMap(midi_file)
+
+        cuts = []
+        for index, (start, end) in enumerate(MidiProcessor._get_rests(midi_file)):
+            keep = lead_in if index == 0 else max_rest
+            start_seconds, end_seconds = tempo_map.get_seconds(start), tempo_map.get_seconds(end)
+            if index == 0:
+                # keep the lead in right before the first note
+                cut = (0, tempo_map.get_tick(end_seconds - keep))
+            else:
+                cut = (tempo_map.get_tick(start_seconds + keep), end)
+            if end_seconds - start_seconds > keep and cut[1] > cut[0]:
+                cuts.append(cut)
+        if not cuts:
+            return midi_data
+
+        def get_compacted_tick(tick: int) -> int:
+            compacted = tick
+            for start, end in cuts:
+                if tick > start:
+                    compacted -= min(tick, end) - start
+            return compacted
+
+        compacted_file = mido.MidiFile(type=midi_file.type,
+            ticks_per_beat=midi_file.ticks_per_beat)
+        for track in midi_file.tracks:
+            compacted_track = mido.MidiTrack()
+            previous = 0
+            for tick, message in zip(accumulate(message.time for message in track), track):
+                compacted = get_compacted_tick(tick)
+                compacted_track.append(message.copy(time=compacted - previous))
+                previous = compacted
+            compacted_file.tracks.append(compacted_track)
+        data = io.BytesIO()
+        compacted_file.save(file=data)
+        logging.info('Compacted MIDI from %.1f to %.1f seconds',
+            midi_file.length, compacted_file.length)
+        return data.getvalue()
+
+    @staticmethod
+    @traced()
     def _reset(synth: Synth):
         """Sends a reset to the MIDI device"""
         port = mido.open_output(synth.get_midi_port())
@@ -39,32 +217,65 @@ class MidiProcessor:
         return result.group(1)
 
     @staticmethod
-    def record(synth: Synth, midi_path: str, wav_path: str):
-        """Records given `midi_path` and returns path to WAV file"""
-        assert midi_path.endswith('.mid')
-        length = MidiProcessor.get_length(midi_path)
+    def count_xruns(log: str) -> int:
+        """Return the number of xruns arecord reported in `log`"""
+        return len(XRUN_PATTERN.findall(log))
+
+    @staticmethod
+    def _watch_capture_log(stream: IO[bytes], lines: List[str]):
+        """Collect arecord's log as it is written, warning of xruns as they happen"""
+        for line in io.TextIOWrapper(stream, encoding='ascii', errors='replace'):
+            if XRUN_PATTERN.search(line):
+                logging.warning('Capture %s', line.strip())
+            lines.append(line)
+
+    @staticmethod
+    @traced()
+    def record(synth: Synth, midi_data: bytes, wav_path: str,
+            priority: CapturePriority = DEFAULT_CAPTURE_PRIORITY) -> int:
+        """Records given `midi_data` to `wav_path`, streaming it to the synth,
+        and returns the number of xruns the capture recovered from"""
+        length = MidiProcessor.get_data_length(midi_data)
         if not shutil.which('arecord'):
             raise RuntimeError("`arecord` command not found")
         if not shutil.which('aplaymidi'):
             raise RuntimeError("`aplaymidi` command not found")
+        prefix: List[str] = []
+        for command in priority.get_commands():
+            if not shutil.which(command[0]):
+                raise RuntimeError(f"`{command[0]}` command not found")
+            prefix += command
         MidiProcessor._reset(synth)
+        profile = synth.get_capture_profile()
+        # without --fatal-errors arecord recovers from xruns and reports them
         record_args = [
-            'arecord', '--verbose', '--fatal-errors', '--nonblock',
-            '--buffer-size', '96000',
+            *prefix,
+            'arecord', '--verbose', '--nonblock',
+            '--buffer-size', str(profile.buffer_size),
+            '--period-size', str(profile.period_size),
             '--device', synth.get_audio_port(),
-            '--rate', '48000',
-            '--channels', '4',
-            '--format', 'S32_LE',
+            '--rate', str(profile.rate),
+            '--channels', str(profile.channels),
+            '--format', profile.sample_format,
             '--duration', str(length),
             wav_path
         ]
         logging.info('Running arecord with %s', record_args)
-        with subprocess.Popen(record_args,
+        record_log: List[str] = []
+        with span('capture', seconds=length), subprocess.Popen(record_args,
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE) as record_proc:
-            play_args = ['aplaymidi', '-p', MidiProcessor._get_seq_port_name(synth), midi_path]
+            assert record_proc.stdout is not None and record_proc.stderr is not None
+            watcher = threading.Thread(target=MidiProcessor._watch_capture_log,
+                args=(record_proc.stderr, record_log), daemon=True)
+            watcher.start()
+            play_args = ['aplaymidi', '-p', MidiProcessor._get_seq_port_name(synth), '-']
             logging.info('Running aplaymidi with %s', play_args)
-            with subprocess.Popen(play_args,
+            play_in, play_in_writer = os.pipe()
+            with subprocess.Popen(play_args, stdin=play_in,
                     stdout=subprocess.PIPE, stderr=subprocess.PIPE) as play_proc:
+                os.close(play_in)
+                with open(play_in_writer, 'wb') as fp:
+                    fp.write(midi_data)
                 while True:
                     time.sleep(1)
                     play_result = play_proc.poll()
@@ -78,28 +289,35 @@ class MidiProcessor:
                             raise RuntimeError("Play process exited with error")
                     if record_result is not None:
                         logging.info('record process exited with "%s"', record_result)
-                        record_out, record_err = record_proc.communicate(timeout=60)
-                        logging.info(record_out.decode('ascii'))
-                        logging.info(record_err.decode('ascii'))
+                        watcher.join(timeout=60)
+                        logging.info(record_proc.stdout.read().decode('ascii'))
+                        logging.info(''.join(record_log))
                         if not play_result:
                             logging.info('Exiting play process...')
                             play_proc.send_signal(signal.SIGTERM)
                         if record_proc.returncode:
                             raise RuntimeError("Record process exited with error")
                         break
+        xruns = MidiProcessor.count_xruns(''.join(record_log))
+        CAPTURES.inc(synth=synth.get_id())
+        CAPTURE_XRUNS.inc(xruns, synth=synth.get_id())
+        return xruns
 
     @staticmethod
-    def encode(wav_path: str, flac_path: str):
-        """Encodes given `wav_path` and returns path to FLAC file"""
+    @traced()
+    def encode(wav_path: str, output_path: str,
+            profile: CaptureProfile = DEFAULT_CAPTURE_PROFILE):
+        """Encodes given `wav_path` captured with `profile` to a stereo file
+        whose format follows the extension of `output_path`"""
         logging.info('Starting encoding of "%s"...', wav_path)
         if not shutil.which('sox'):
             raise RuntimeError("`sox` command not found")
         encode_args = [
             'sox',
             wav_path,
-            '-b', '24',
-            flac_path,
-            'remix', '1', '2',
+            *MidiProcessor.RENDITION_OPTIONS[output_path.rsplit('.', 1)[-1]],
+            output_path,
+            'remix', *[str(channel) for channel in profile.channel_map],
             'norm', '-3',
         ]
         logging.info('Running sox with %s', encode_args)
@@ -111,3 +329,15 @@ class MidiProcessor:
             logging.info(encode_err.decode('ascii'))
             if encode_proc.returncode:
                 raise RuntimeError("Encode process exited with error")
+
+    @staticmethod
+    @traced()
+    def encode_renditions(wav_path: str, output_paths: List[str],
+            profile: CaptureProfile = DEFAULT_CAPTURE_PROFILE):
+        """Encodes given `wav_path` to every one of `output_paths` in parallel"""
+        encode = bind(MidiProcessor.encode)
+        with ThreadPoolExecutor(max(1, len(output_paths))) as executor:
+            futures = [executor.submit(encode, wav_path, output_path, profile)
+                for output_path in output_paths]
+            for future in futures:
+                future.result()
@@ -1,6 +1,9 @@
 """Provides validation for MIDI files"""
 import io
+import math
+import struct
 from enum import Enum
+from typing import Optional, Tuple
 
 from mido import MidiFile # type: ignore
 
@@ -23,19 +26,87 @@ class MidiValidator:
         # check file size
         if len(midi_data) > cls.MAX_FILE_SIZE:
             return MidiValidatorResult.TOO_BIG
+        return cls.get_parsed_result(midi_data)[0]
 
-        # parse midi
+    @classmethod
+    def get_parsed_result(cls, midi_data: bytes) -> Tuple[MidiValidatorResult, int]:
+        """Return validation results for parsing given `midi_data`, with its
+        length in seconds if valid"""
+        # parse midi, a truncated file runs out of data mid-track and a meta
+        # message too short for its type indexes past its data
         try:
             midi = MidiFile(file=io.BytesIO(midi_data))
-        except OSError:
-            return MidiValidatorResult.FAIL_PARSE
+        except (OSError, EOFError, ValueError, IndexError):
+            return MidiValidatorResult.FAIL_PARSE, 0
 
         # check type
         if midi.type not in (0, 1):
-            return MidiValidatorResult.BAD_TYPE
+            return MidiValidatorResult.BAD_TYPE, 0
 
         # check length
         if midi.length > cls.MAX_MIDI_LENGTH:
-            return MidiValidatorResult.TOO_LONG
+            return MidiValidatorResult.TOO_LONG, 0
+
+        return MidiValidatorResult.OK, math.ceil(midi.length)
+
+class MidiStreamValidator:
+    """Validator for a MIDI file arriving in pieces
+
+    The size limit, the header and the chunk framing are checked as data is
+    fed, so a bad upload is refused without reading the rest of it. The
+    length can only be known once every track is in, and is checked by
+    `finish`."""
+    HEADER_SIZE = 14
+    CHUNK_HEADER_SIZE = 8
+
+    def __init__(self):
+        self.data = bytearray()
+        self.result: Optional[MidiValidatorResult] = None
+        # seconds, known once `finish` found the file valid
+        self.length = 0
+        # offset of the next chunk header to check
+        self.chunk_offset = 0
 
-        return MidiValidatorResult.OK
+    def feed(self, data: bytes) -> Optional[MidiValidatorResult]:
+        """Add the next piece of the file, returning the failed result as soon
+        as one is known"""
+        if self.result is not None:
+            return self.result
+        self.data += data
+        if len(self.data) > MidiValidator.MAX_FILE_SIZE:
+            self.result = MidiValidatorResult.TOO_BIG
+        elif self.chunk_offset == 0 and len(self.data) >= self.HEADER_SIZE:
+            self.result = self._check_header()
+        while self.result is None and self.chunk_offset \
+                and len(self.data) >= self.chunk_offset + self.CHUNK_HEADER_SIZE:
+            self.result = self._check_chunk()
+        return self.result
+
+    def finish(self) -> MidiValidatorResult:
+        """Return the validation result of the whole file"""
+        if self.result is None:
+            self.result, self.length = MidiValidator.get_parsed_result(bytes(self.data))
+        return self.result
+
+    def get_data(self) -> bytes:
+        """Return the file fed so far"""
+        return bytes(self.data)
+
+    def _check_header(self) -> Optional[MidiValidatorResult]:
+        """Check the header chunk, which must come first"""
+        chunk_type, size, midi_type = struct.unpack('>4sIH', self.data[:10])
+        if chunk_type != b'MThd' or size < 6:
+            return MidiValidatorResult.FAIL_PARSE
+        if midi_type not in (0, 1):
+            return MidiValidatorResult.BAD_TYPE
+        self.chunk_offset = self.CHUNK_HEADER_SIZE + size
+        return None
+
+    def _check_chunk(self) -> Optional[MidiValidatorResult]:
+        """Check the declared size of the next chunk fits the size limit"""
+        _, size = struct.unpack('>4sI',
+            self.data[self.chunk_offset:self.chunk_offset + self.CHUNK_HEADER_SIZE])
+        self.chunk_offset += self.CHUNK_HEADER_SIZE + size
+        if self.chunk_offset > MidiValidator.MAX_FILE_SIZE:
+            return MidiValidatorResult.TOO_BIG
+        return None
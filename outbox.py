@@ -0,0 +1,222 @@
+"""Durable outbox of emails and Discord notifications waiting to be sent,
+based on postgres"""
+import select
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional, Iterator, List
+
+import psycopg2
+
+from metrics import DB_QUERY_SECONDS, timed
+from tracing import traced
+
+class OutboxChannel(Enum):
+    """How an outbox message is delivered, each has its own sender"""
+    EMAIL = 'email'
+    DISCORD = 'discord'
+
+@dataclass
+class OutboxMessage:
+    """A message waiting in the outbox, emails have an address and a subject
+    and Discord notifications a channel and a user to mention"""
+    id: int
+    to_email: Optional[str]
+    subject: Optional[str]
+    content: str
+    attempts: int = 0
+    channel: OutboxChannel = OutboxChannel.EMAIL
+    discord_channel_id: Optional[int] = None
+    discord_user_id: Optional[int] = None
+
+class Outbox:
+    """Outbox interface based on postgres"""
+    con: Optional[psycopg2.extensions.connection] = None
+    MAX_ATTEMPTS = 10
+    RETRY_BACKOFF = 30
+    MAX_RETRY_BACKOFF = 60*60
+    BATCH_SIZE = 50
+
+    @classmethod
+    def connect(cls, connection_url):
+        """Make connection to postgres"""
+        cls.con = psycopg2.connect(connection_url)
+        cls.con.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+    @classmethod
+    def disconnect(cls):
+        """Disconnect from postgres"""
+        if cls.con:
+            cls.con.close()
+            cls.con = None
+
+    @classmethod
+    def _get_cursor(cls):
+        if cls.con is None:
+            raise RuntimeError("No database connection")
+        return cls.con.cursor()
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def put(cls, to_email: str, subject: str, content: str) -> int:
+        """Add an email to the outbox and return its id"""
+        cur = cls._get_cursor()
+        cur.execute("""
+            INSERT INTO outbox(to_email, subject, content)
+            VALUES (%s, %s, %s)
+            RETURNING id
+        """, [
+            to_email,
+            subject,
+            content
+        ])
+        result = cur.fetchone()
+        assert result is not None
+        return result[0]
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def put_discord(cls, channel_id: int, user_id: int, content: str) -> int:
+        """Add a Discord notification mentioning `user_id` to the outbox and
+        return its id"""
+        cur = cls._get_cursor()
+        cur.execute("""
+            INSERT INTO outbox(channel, discord_channel_id, discord_user_id, content)
+            VALUES (%s, %s, %s, %s)
+            RETURNING id
+        """, [
+            OutboxChannel.DISCORD.value,
+            channel_id,
+            user_id,
+            content
+        ])
+        result = cur.fetchone()
+        assert result is not None
+        return result[0]
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def get_due_messages(cls,
+            channel: OutboxChannel = OutboxChannel.EMAIL) -> List[OutboxMessage]:
+        """Return the oldest unsent messages of `channel` that are due to be attempted"""
+        cur = cls._get_cursor()
+        cur.execute("""
+            SELECT id, to_email, subject, content, attempts,
+                channel, discord_channel_id, discord_user_id
+            FROM outbox
+            WHERE channel = %s
+                AND sent_at IS NULL
+                AND attempts < %s
+                AND next_attempt_at <= NOW()
+            ORDER BY next_attempt_at, id
+            LIMIT %s
+        """, [
+            channel.value,
+            cls.MAX_ATTEMPTS,
+            cls.BATCH_SIZE
+        ])
+        return [OutboxMessage(
+            id=message_id,
+            to_email=to_email,
+            subject=subject,
+            content=content,
+            attempts=attempts,
+            channel=OutboxChannel(message_channel),
+            discord_channel_id=discord_channel_id,
+            discord_user_id=discord_user_id
+        ) for message_id, to_email, subject, content, attempts, message_channel,
+            discord_channel_id, discord_user_id in cur.fetchall()]
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def get_next_attempt_delay(cls,
+            channel: OutboxChannel = OutboxChannel.EMAIL) -> Optional[float]:
+        """Return seconds until the next retry of `channel` is due, None if
+        none are pending"""
+        cur = cls._get_cursor()
+        cur.execute("""
+            SELECT EXTRACT(EPOCH FROM MIN(next_attempt_at) - NOW())
+            FROM outbox
+            WHERE channel = %s
+                AND sent_at IS NULL
+                AND attempts < %s
+        """, [
+            channel.value,
+            cls.MAX_ATTEMPTS
+        ])
+        result = cur.fetchone()
+        assert result is not None
+        return None if result[0] is None else max(float(result[0]), 0)
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def mark_sent(cls, message: OutboxMessage):
+        """Record that `message` was handed to the SMTP server or Discord"""
+        cur = cls._get_cursor()
+        cur.execute("""
+            UPDATE outbox
+            SET sent_at=NOW(), attempts=attempts + 1
+            WHERE id=%s
+        """, [
+            message.id
+        ])
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def mark_failed(cls, message: OutboxMessage, error: str, permanent: bool = False):
+        """Record a failed attempt and back off exponentially before the next one"""
+        attempts = cls.MAX_ATTEMPTS if permanent else message.attempts + 1
+        delay = min(cls.RETRY_BACKOFF * 2**message.attempts, cls.MAX_RETRY_BACKOFF)
+        cur = cls._get_cursor()
+        cur.execute("""
+            UPDATE outbox
+            SET attempts=%s, error=%s, next_attempt_at=NOW() + %s * INTERVAL '1 second'
+            WHERE id=%s
+        """, [
+            attempts,
+            error,
+            delay,
+            message.id
+        ])
+        message.attempts = attempts
+
+    @classmethod
+    def fetch_messages(cls, timeout: int = 15*60,
+            channel: OutboxChannel = OutboxChannel.EMAIL) -> Iterator[OutboxMessage]:
+        """Outbox messages generator, stop on timeout"""
+        for messages in cls.fetch_batches(timeout, channel):
+            yield from messages
+
+    @classmethod
+    def fetch_batches(cls, timeout: int = 15*60,
+            channel: OutboxChannel = OutboxChannel.EMAIL,
+            batch_window: float = 0) -> Iterator[List[OutboxMessage]]:
+        """Generator of the due messages of `channel` in batches, stop on timeout
+
+        After waking up for a new message, wait `batch_window` seconds for
+        others to join its batch."""
+        cur = cls._get_cursor()
+        cur.execute("LISTEN outbox")
+        while True:
+            messages = cls.get_due_messages(channel)
+            if messages:
+                yield messages
+                continue
+
+            delay = cls.get_next_attempt_delay(channel)
+            assert cls.con is not None
+            if delay is not None and delay < timeout:
+                select.select([cls.con], [], [], delay)
+            elif select.select([cls.con], [], [], timeout) == ([],[],[]):
+                break
+            cls.con.poll()
+            if cls.con.notifies:
+                time.sleep(batch_window)
+            while cls.con.notifies:
+                _ = cls.con.notifies.pop(0)
@@ -1,14 +1,21 @@
 """Database Client Interface"""
 import math
 import select
+import hashlib
+import time
+from contextlib import contextmanager
 from enum import Enum
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from uuid import UUID, uuid4
-from typing import Optional, Iterable
+from typing import Optional, Iterable, Iterator, Dict, List, Tuple, Set
 
 import psycopg2
 import psycopg2.extras
 
+from artifacts import Artifact
+from metrics import DB_QUERY_SECONDS, Histogram, timed
+from tracing import span, traced
+from email_client import MailboxState
 from midi_processor import MidiProcessor
 from user import User, UserSerializer
 from synth import Synth
@@ -20,9 +27,79 @@ class StatusEnum(Enum):
     ENCODING = 'encoding'
     UPLOADING = 'uploading'
     NOTIFYING = 'notifying'
+    PUBLISHING = 'publishing'
     FAILED = 'failed'
     DONE = 'done'
 
+class AdmissionResult(Enum):
+    """Admission control results for a new request, see
+    `Queue.get_admission_message` for their descriptions"""
+    OK = 'ok'
+    TOO_MANY_REQUESTS = 'too_many_requests'
+    TOO_MUCH_QUEUED = 'too_much_queued'
+
+STAGES = [
+    StatusEnum.RECORDING,
+    StatusEnum.ENCODING,
+    StatusEnum.UPLOADING,
+    StatusEnum.NOTIFYING,
+    StatusEnum.PUBLISHING,
+]
+
+@dataclass
+class StageModel:
+    """Linear model of a stage's duration in seconds given the MIDI length"""
+    intercept: float
+    slope: float
+
+    @staticmethod
+    def fit(weight: float, sum_x: float, sum_y: float,
+            sum_xx: float, sum_xy: float) -> 'StageModel':
+        """Least squares fit from (weighted) sums of MIDI lengths `x` and durations `y`"""
+        if weight <= 0:
+            return StageModel(intercept=0., slope=0.)
+        denominator = weight * sum_xx - sum_x * sum_x
+        if abs(denominator) < 1e-6 * weight * weight:
+            # all samples had the same length, assume duration is proportional
+            if sum_x > 0:
+                return StageModel(intercept=0., slope=sum_y / sum_x)
+            return StageModel(intercept=sum_y / weight, slope=0.)
+        slope = max(0., (weight * sum_xy - sum_x * sum_y) / denominator)
+        intercept = max(0., (sum_y - slope * sum_x) / weight)
+        return StageModel(intercept=intercept, slope=slope)
+
+    def predict(self, midi_length: float) -> float:
+        """Return the predicted duration in seconds"""
+        return self.intercept + self.slope * midi_length
+
+# used until a synth has history for a stage: real time recording after a
+# reset, plus about 10% for encoding/uploading
+DEFAULT_STAGE_MODELS = {
+    StatusEnum.RECORDING: StageModel(intercept=1., slope=1.),
+    StatusEnum.ENCODING: StageModel(intercept=0., slope=.05),
+    StatusEnum.UPLOADING: StageModel(intercept=1., slope=.05),
+    StatusEnum.NOTIFYING: StageModel(intercept=1., slope=0.),
+    StatusEnum.PUBLISHING: StageModel(intercept=0., slope=0.),
+}
+
+class SchedulingPolicy(Enum):
+    """Orderings for choosing the next queue item of a synth"""
+    FIFO = 'fifo'
+    ROUND_ROBIN = 'round_robin'
+    FAIR_SHARE = 'fair_share'
+
+    def get_order_by(self) -> str:
+        """Return the SQL ordering of pending queue items under this policy
+
+        Items already in progress always come first, then higher priority.
+        ROUND_ROBIN alternates between users, FAIR_SHARE orders by each user's
+        cumulative queued length; ties are broken shortest job first."""
+        if self == SchedulingPolicy.FIFO:
+            return 'in_progress DESC, priority DESC, created_at, uuid'
+        if self == SchedulingPolicy.ROUND_ROBIN:
+            return 'in_progress DESC, priority DESC, user_rank, midi_length, created_at, uuid'
+        return 'in_progress DESC, priority DESC, user_share, midi_length, created_at, uuid'
+
 @dataclass
 class QueueItem:
     """Struct for an enqueable queue item"""
@@ -33,35 +110,71 @@ class QueueItem:
     synth: Synth
     midi_file: str
     midi_length: int
+    midi_hash: Optional[str] = None
+    priority: int = 0
+    xruns: int = 0
+    recaptures: int = 0
+    notified: int = 0
+    midi_data: Optional[bytes] = field(default=None, repr=False, compare=False)
+    artifacts: Dict[str, Artifact] = field(default_factory=dict, repr=False, compare=False)
 
     @staticmethod
-    def factory(user: User, synth: Synth, midi_file: str, midi_data: bytes, media_path: str):
-        """Create QueueItem, sync MIDI to disk, and populate default fields"""
-        uuid = uuid4()
-        midi_path = f'{media_path}/{uuid}.mid'
-        with open(midi_path, 'wb') as fp:
-            fp.write(midi_data)
+    def factory(user: User, synth: Synth, midi_file: str, midi_data: bytes,
+            midi_length: Optional[int] = None):
+        """Create QueueItem, hash MIDI content, and populate default fields"""
         return QueueItem(
-            uuid=uuid,
+            uuid=uuid4(),
             status=StatusEnum.NEW,
             retries=0,
             user=user,
             synth=synth,
             midi_file=midi_file,
-            midi_length=MidiProcessor.get_length(midi_path)
+            midi_length=midi_length if midi_length is not None \
+                else MidiProcessor.get_data_length(midi_data),
+            midi_hash=hashlib.sha256(midi_data).hexdigest(),
+            midi_data=midi_data,
         )
 
-    def midi_path(self, media_path: str):
-        """Generate the filesystem path to the MIDI file"""
-        return f'{media_path}/{self.uuid}.mid'
+# columns a QueueItem is read from, in order
+QUEUE_ITEM_COLUMNS = """
+    uuid,
+    status,
+    retries,
+    userdata,
+    synth,
+    midi_file,
+    midi_length,
+    midi_hash,
+    priority,
+    artifacts,
+    xruns,
+    recaptures,
+    notified
+"""
+
+STAGE_SECONDS = Histogram('dtmaas_stage_seconds',
+    'Duration of completed queue item stages', ['synth', 'stage'])
+QUEUE_WAIT_SECONDS = Histogram('dtmaas_queue_wait_seconds',
+    'Time queue items waited before their first stage started', ['synth'])
 
 class Queue:
     """Queue interface based on postgres"""
     con: Optional[psycopg2.extensions.connection] = None
+    policy: SchedulingPolicy = SchedulingPolicy.FAIR_SHARE
+    stage_models: Dict[str, Tuple[float, Dict[StatusEnum, StageModel]]] = {}
+    MIDI_BLOB_GRACE = 60*60
+    STAGE_MODEL_DECAY = .95
+    STAGE_MODEL_TTL = 5*60
+    RATE_LIMIT_REQUESTS = 10
+    RATE_LIMIT_WINDOW = 60*60
+    MAX_QUEUED_LENGTH = 30*60
 
     @classmethod
-    def connect(cls, connection_url):
+    def connect(cls, connection_url,
+            policy: SchedulingPolicy = SchedulingPolicy.FAIR_SHARE):
         """Make connection to postgres"""
+        cls.policy = policy
+        cls.stage_models = {}
         cls.con = psycopg2.connect(connection_url)
         cls.con.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
         psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
@@ -80,55 +193,251 @@ class Queue:
         return cls.con.cursor()
 
     @classmethod
-    def enqueue_queue_item(cls, queue_item: QueueItem):
-        """Add item to queue"""
+    @contextmanager
+    def _transaction(cls) -> Iterator[psycopg2.extensions.cursor]:
+        """Run the statements on the yielded cursor in one transaction"""
+        cur = cls._get_cursor()
+        cur.execute('BEGIN')
+        try:
+            yield cur
+        except BaseException:
+            if cls.con is not None and not cls.con.closed:
+                cur.execute('ROLLBACK')
+            raise
+        cur.execute('COMMIT')
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def enqueue_queue_item(cls, queue_item: QueueItem) -> bool:
+        """Add item to queue, storing its MIDI content if not already stored
+
+        If the same MIDI is still waiting to be recorded on the same synth,
+        the user subscribes to that item instead, `queue_item` takes its uuid
+        and True is returned."""
+        return cls._enqueue_queue_item(cls._get_cursor(), queue_item)
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def admit_queue_item(cls, queue_item: QueueItem) -> Tuple[AdmissionResult, bool]:
+        """Enqueue `queue_item` if its user is admitted, returning the
+        admission result and whether the item was coalesced
+
+        Both happen in one transaction holding the user's rate limit row, so
+        concurrent requests from a user, from any process, are admitted one
+        at a time against what the others queued."""
+        with cls._transaction() as cur:
+            admission_result = cls._get_admission_result(cur, queue_item.user,
+                queue_item.midi_length)
+            if admission_result != AdmissionResult.OK:
+                return admission_result, False
+            return admission_result, cls._enqueue_queue_item(cur, queue_item)
+
+    @classmethod
+    def _enqueue_queue_item(cls, cur, queue_item: QueueItem) -> bool:
+        """Add item to queue using `cur`, see `enqueue_queue_item`"""
         assert queue_item.status == StatusEnum.NEW
         assert queue_item.retries == 0
-        cur = cls._get_cursor()
+        # locking the pending item keeps it from reaching NOTIFYING, and so
+        # fanning out, before the subscriber is added
         cur.execute("""
-            INSERT INTO queue(
-                uuid,
-                status,
-                retries,
-                userdata,
-                synth,
-                midi_file,
-                midi_length
-            )
-            VALUES (
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s
+            WITH pending AS (
+                SELECT uuid
+                FROM queue
+                WHERE midi_hash=%(midi_hash)s
+                  AND synth=%(synth)s
+                  AND status IN ('new', 'recording', 'encoding', 'uploading')
+                ORDER BY created_at
+                LIMIT 1
+                FOR UPDATE
+            ), subscriber AS (
+                INSERT INTO queue_subscriber(uuid, userdata, midi_file)
+                SELECT uuid, %(userdata)s, %(midi_file)s
+                FROM pending
+                RETURNING uuid
+            ), blob AS (
+                INSERT INTO midi_blob(hash, data)
+                SELECT hash, data
+                FROM (VALUES (%(midi_hash)s, %(midi_data)s::BYTEA)) AS blob(hash, data)
+                WHERE data IS NOT NULL
+                  AND NOT EXISTS (SELECT FROM pending)
+                ON CONFLICT (hash) DO UPDATE SET updated_at = NOW()
+            ), item AS (
+                INSERT INTO queue(
+                    uuid,
+                    status,
+                    retries,
+                    userdata,
+                    synth,
+                    midi_file,
+                    midi_length,
+                    midi_hash,
+                    priority
+                )
+                SELECT
+                    %(uuid)s,
+                    %(status)s,
+                    %(retries)s,
+                    %(userdata)s,
+                    %(synth)s,
+                    %(midi_file)s,
+                    %(midi_length)s,
+                    %(midi_hash)s,
+                    %(priority)s
+                WHERE NOT EXISTS (SELECT FROM pending)
             )
+            SELECT uuid FROM subscriber
+        """, {
+            'uuid': str(queue_item.uuid),
+            'status': queue_item.status.value,
+            'retries': queue_item.retries,
+            'userdata': UserSerializer.serialize(queue_item.user),
+            'synth': queue_item.synth.get_id(),
+            'midi_file': queue_item.midi_file,
+            'midi_length': queue_item.midi_length,
+            'midi_hash': queue_item.midi_hash,
+            'midi_data': queue_item.midi_data,
+            'priority': queue_item.priority,
+        })
+        result = cur.fetchone()
+        if result is None:
+            return False
+        queue_item.uuid = UUID(result[0])
+        return True
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def get_queue_item_subscribers(cls, queue_item: QueueItem) -> List[Tuple[User, str]]:
+        """Return the users who subscribed to the queue item, with the name
+        of the MIDI file each sent"""
+        cur = cls._get_cursor()
+        cur.execute("""
+            SELECT userdata, midi_file
+            FROM queue_subscriber
+            WHERE uuid=%s
+            ORDER BY created_at
         """, [
-            str(queue_item.uuid),
-            queue_item.status.value,
-            queue_item.retries,
-            UserSerializer.serialize(queue_item.user),
-            queue_item.synth.get_id(),
-            queue_item.midi_file,
-            queue_item.midi_length
+            str(queue_item.uuid)
+        ])
+        return [(UserSerializer.deserialize(userdata), midi_file)
+            for userdata, midi_file in cur.fetchall()]
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def get_admission_result(cls, user: User, midi_length: int) -> AdmissionResult:
+        """Check if `user` may enqueue a MIDI of `midi_length` seconds, taking
+        a token from their rate limit bucket if so"""
+        with cls._transaction() as cur:
+            return cls._get_admission_result(cur, user, midi_length)
+
+    @classmethod
+    def get_admission_message(cls, admission_result: AdmissionResult) -> str:
+        """Return the reason given to the user for `admission_result`"""
+        if admission_result == AdmissionResult.TOO_MANY_REQUESTS:
+            return f'Too many requests >{cls.RATE_LIMIT_REQUESTS} ' \
+                f'per {cls.RATE_LIMIT_WINDOW // 60} min'
+        if admission_result == AdmissionResult.TOO_MUCH_QUEUED:
+            return f'Too much MIDI queued >{cls.MAX_QUEUED_LENGTH // 60} min'
+        return 'OK'
+
+    @classmethod
+    def _get_admission_result(cls, cur, user: User, midi_length: int) -> AdmissionResult:
+        """Check admission using `cur`, which must be in a transaction, see
+        `get_admission_result`"""
+        userdata = UserSerializer.serialize(user)
+        # the user's bucket is locked until the transaction ends, which
+        # serializes their requests
+        cur.execute("""
+            INSERT INTO rate_limit(userdata, tokens, updated_at)
+            VALUES (%s, %s, NOW())
+            ON CONFLICT (userdata) DO NOTHING
+        """, [
+            userdata,
+            cls.RATE_LIMIT_REQUESTS
+        ])
+        cur.execute("""
+            SELECT FROM rate_limit WHERE userdata=%s FOR UPDATE
+        """, [
+            userdata
         ])
+        cur.execute("""
+            SELECT COALESCE(SUM(midi_length), 0)
+            FROM queue
+            WHERE status NOT IN ('done', 'failed')
+              AND (userdata=%s
+                OR uuid IN (SELECT uuid FROM queue_subscriber WHERE userdata=%s))
+        """, [
+            userdata,
+            userdata
+        ])
+        result = cur.fetchone()
+        assert result is not None
+        if result[0] + midi_length > cls.MAX_QUEUED_LENGTH:
+            return AdmissionResult.TOO_MUCH_QUEUED
+
+        # token bucket refilling RATE_LIMIT_REQUESTS per RATE_LIMIT_WINDOW
+        rate = cls.RATE_LIMIT_REQUESTS / cls.RATE_LIMIT_WINDOW
+        cur.execute("""
+            UPDATE rate_limit SET
+                tokens = LEAST(%s, tokens + EXTRACT(EPOCH FROM NOW() - updated_at) * %s) - 1,
+                updated_at = NOW()
+            WHERE userdata=%s
+              AND LEAST(%s, tokens + EXTRACT(EPOCH FROM NOW() - updated_at) * %s) >= 1
+            RETURNING tokens
+        """, [
+            cls.RATE_LIMIT_REQUESTS,
+            rate,
+            userdata,
+            cls.RATE_LIMIT_REQUESTS,
+            rate,
+        ])
+        if cur.fetchone() is None:
+            return AdmissionResult.TOO_MANY_REQUESTS
+        return AdmissionResult.OK
 
     @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
     def update_queue_item_status(cls, queue_item: QueueItem, status: StatusEnum):
         """Change the status of the queue item, reset retries count"""
         cur = cls._get_cursor()
         cur.execute("""
             UPDATE queue
-            SET status=%s, retries=0
+            SET status=%s, retries=0, updated_at=NOW()
             WHERE uuid=%s
+            RETURNING EXTRACT(EPOCH FROM NOW() - created_at)
         """, [
             status.value,
             str(queue_item.uuid)
         ])
+        result = cur.fetchone()
+        if queue_item.status == StatusEnum.NEW and result:
+            QUEUE_WAIT_SECONDS.observe(float(result[0]), synth=queue_item.synth.get_id())
         queue_item.status = status
 
     @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def set_queue_item_artifact(cls, queue_item: QueueItem, name: str, artifact: Artifact):
+        """Record a stage output in the queue item's artifact manifest"""
+        cur = cls._get_cursor()
+        cur.execute("""
+            UPDATE queue
+            SET artifacts = artifacts || jsonb_build_object(%s::TEXT, %s::JSONB)
+            WHERE uuid=%s
+        """, [
+            name,
+            artifact.serialize(),
+            str(queue_item.uuid)
+        ])
+        queue_item.artifacts[name] = artifact
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
     def increment_queue_item_retries(cls, queue_item: QueueItem):
         """Increment queue item retry count"""
         cur = cls._get_cursor()
@@ -142,20 +451,265 @@ class Queue:
         queue_item.retries += 1
 
     @classmethod
-    def get_queue_length(cls, synth: Synth) -> int:
-        """Estimate the waiting time for the queue in minutes"""
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def add_queue_item_xruns(cls, queue_item: QueueItem, xruns: int, recapture: bool):
+        """Count the overruns of a capture and whether it is recorded again"""
         cur = cls._get_cursor()
         cur.execute("""
-            SELECT COALESCE(SUM(midi_length), 0)
-            FROM queue
+            UPDATE queue
+            SET xruns = xruns + %s, recaptures = recaptures + %s
+            WHERE uuid=%s
+        """, [
+            xruns,
+            int(recapture),
+            str(queue_item.uuid)
+        ])
+        queue_item.xruns += xruns
+        queue_item.recaptures += int(recapture)
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def set_queue_item_notified(cls, queue_item: QueueItem, notified: int):
+        """Record how many of the subscribers were notified, so a retry
+        carries on with the next"""
+        cur = cls._get_cursor()
+        cur.execute("""
+            UPDATE queue
+            SET notified = %s
+            WHERE uuid=%s
+        """, [
+            notified,
+            str(queue_item.uuid)
+        ])
+        queue_item.notified = notified
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def record_stage(cls, queue_item: QueueItem, stage: StatusEnum, duration: float):
+        """Add a completed stage to the history and update the synth's model"""
+        cur = cls._get_cursor()
+        cur.execute("""
+            WITH history AS (
+                INSERT INTO stage_history(uuid, stage, started_at, ended_at)
+                VALUES (%s, %s, NOW() - %s * INTERVAL '1 second', NOW())
+            )
+            INSERT INTO stage_model AS model(synth, stage, weight, sum_x, sum_y, sum_xx, sum_xy)
+            VALUES (%s, %s, 1, %s, %s, %s, %s)
+            ON CONFLICT (synth, stage) DO UPDATE SET
+                weight = model.weight * %s + 1,
+                sum_x = model.sum_x * %s + EXCLUDED.sum_x,
+                sum_y = model.sum_y * %s + EXCLUDED.sum_y,
+                sum_xx = model.sum_xx * %s + EXCLUDED.sum_xx,
+                sum_xy = model.sum_xy * %s + EXCLUDED.sum_xy,
+                updated_at = NOW()
+            RETURNING weight, sum_x, sum_y, sum_xx, sum_xy
+        """, [
+            str(queue_item.uuid),
+            stage.value,
+            duration,
+            queue_item.synth.get_id(),
+            stage.value,
+            queue_item.midi_length,
+            duration,
+            queue_item.midi_length * queue_item.midi_length,
+            queue_item.midi_length * duration,
+        ] + [cls.STAGE_MODEL_DECAY] * 5)
+        result = cur.fetchone()
+        cached = cls.stage_models.get(queue_item.synth.get_id())
+        if cached and result:
+            cached[1][stage] = StageModel.fit(*result)
+
+    @classmethod
+    @contextmanager
+    def timing_stage(cls, queue_item: QueueItem) -> Iterator[None]:
+        """Record the duration of the queue item's current stage if it succeeds"""
+        stage = queue_item.status
+        start = time.monotonic()
+        with span(stage.value, 'stage', synth=queue_item.synth.get_id()):
+            yield
+        duration = time.monotonic() - start
+        STAGE_SECONDS.observe(duration, synth=queue_item.synth.get_id(), stage=stage.value)
+        cls.record_stage(queue_item, stage, duration)
+
+    @classmethod
+    def get_stage_models(cls, synth: Synth) -> Dict[StatusEnum, StageModel]:
+        """Return the (cached) duration model of each stage for `synth`"""
+        cached = cls.stage_models.get(synth.get_id())
+        if cached and time.monotonic() - cached[0] < cls.STAGE_MODEL_TTL:
+            return cached[1]
+        stage_models = dict(DEFAULT_STAGE_MODELS)
+        cur = cls._get_cursor()
+        cur.execute("""
+            SELECT stage, weight, sum_x, sum_y, sum_xx, sum_xy
+            FROM stage_model
             WHERE synth=%s
-              AND status IN ('new', 'recording')
         """, [
             synth.get_id()
         ])
+        for result in cur.fetchall():
+            stage_models[StatusEnum(result[0])] = StageModel.fit(*result[1:])
+        cls.stage_models[synth.get_id()] = (time.monotonic(), stage_models)
+        return stage_models
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def get_mailbox_state(cls, mailbox: str) -> Optional[MailboxState]:
+        """Return the persisted sync state of an IMAP mailbox"""
+        cur = cls._get_cursor()
+        cur.execute("""
+            SELECT uidvalidity, last_uid
+            FROM mailbox_state
+            WHERE mailbox=%s
+        """, [
+            mailbox
+        ])
         result = cur.fetchone()
-        minutes = (result[0] * 1.1) / 60. # add 10% for encoding/uploading
-        return math.ceil(minutes)
+        if result:
+            return MailboxState(uidvalidity=result[0], last_uid=result[1])
+        return None
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def set_mailbox_state(cls, mailbox: str, state: MailboxState):
+        """Persist the sync state of an IMAP mailbox"""
+        cur = cls._get_cursor()
+        cur.execute("""
+            INSERT INTO mailbox_state(mailbox, uidvalidity, last_uid)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (mailbox) DO UPDATE SET
+                uidvalidity = EXCLUDED.uidvalidity,
+                last_uid = EXCLUDED.last_uid,
+                updated_at = NOW()
+        """, [
+            mailbox,
+            state.uidvalidity,
+            state.last_uid
+        ])
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def get_midi_data(cls, queue_item: QueueItem) -> bytes:
+        """Return the stored MIDI content of the queue item"""
+        if queue_item.midi_data is None:
+            cur = cls._get_cursor()
+            cur.execute("""
+                SELECT data
+                FROM midi_blob
+                WHERE hash=%s
+            """, [
+                queue_item.midi_hash
+            ])
+            result = cur.fetchone()
+            if result is None:
+                raise RuntimeError(f'No MIDI stored for queue item "{queue_item.uuid}"')
+            queue_item.midi_data = bytes(result[0])
+        return queue_item.midi_data
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def get_live_uuids(cls) -> Set[UUID]:
+        """Return the uuids of all queue items that are not done or failed"""
+        cur = cls._get_cursor()
+        cur.execute("""
+            SELECT uuid
+            FROM queue
+            WHERE status NOT IN ('done', 'failed')
+        """)
+        return {UUID(row[0]) for row in cur.fetchall()}
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def collect_midi_blobs(cls) -> int:
+        """Delete stored MIDI content no longer referenced by the queue"""
+        cur = cls._get_cursor()
+        cur.execute("""
+            DELETE FROM midi_blob
+            WHERE refcount = 0
+              AND updated_at < NOW() - %s * INTERVAL '1 second'
+        """, [
+            cls.MIDI_BLOB_GRACE
+        ])
+        return cur.rowcount
+
+    @classmethod
+    def _get_scheduled_sql(cls) -> str:
+        """Return SQL ranking the pending items of a synth by `policy`"""
+        return f"""
+            SELECT
+                *,
+                ROW_NUMBER() OVER (ORDER BY {cls.policy.get_order_by()}) AS position
+            FROM (
+                SELECT
+                    uuid,
+                    status,
+                    retries,
+                    userdata,
+                    synth,
+                    midi_file,
+                    midi_length,
+                    midi_hash,
+                    priority,
+                    artifacts,
+                    xruns,
+                    recaptures,
+                    notified,
+                    created_at,
+                    updated_at,
+                    status <> 'new' AS in_progress,
+                    ROW_NUMBER() OVER user_window AS user_rank,
+                    SUM(midi_length) OVER user_window AS user_share
+                FROM queue
+                WHERE synth=%s
+                  AND status NOT IN ('done', 'failed')
+                WINDOW user_window AS (PARTITION BY userdata ORDER BY created_at, uuid)
+            ) pending
+        """
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def get_queue_length(cls, synth: Synth, queue_item: Optional[QueueItem] = None) -> int:
+        """Estimate the waiting time in minutes for the whole queue, or until
+        `queue_item` is notified under the scheduling policy"""
+        stage_models = cls.get_stage_models(synth)
+        cur = cls._get_cursor()
+        cur.execute(f"""
+            WITH scheduled AS ({cls._get_scheduled_sql()})
+            SELECT
+                uuid,
+                status,
+                midi_length,
+                EXTRACT(EPOCH FROM NOW() - updated_at)
+            FROM scheduled
+            WHERE %s::UUID IS NULL
+               OR position <= (SELECT position FROM scheduled WHERE uuid=%s)
+        """, [
+            synth.get_id(),
+            str(queue_item.uuid) if queue_item else None,
+            str(queue_item.uuid) if queue_item else None,
+        ])
+        seconds = 0.
+        for uuid, status, midi_length, elapsed in cur.fetchall():
+            stages = STAGES[STAGES.index(StatusEnum(status)):] \
+                if status != StatusEnum.NEW.value else STAGES
+            for stage in stages:
+                # the other renditions are published after the user is notified
+                if stage == StatusEnum.PUBLISHING and queue_item \
+                        and uuid == str(queue_item.uuid):
+                    continue
+                duration = stage_models[stage].predict(midi_length)
+                if stage.value == status:
+                    duration -= float(elapsed)
+                seconds += max(0., duration)
+        return math.ceil(seconds / 60.)
 
     @classmethod
     def fetch_queue_items(cls, synth: Synth, timeout: int = 15*60) -> Iterable[QueueItem]:
@@ -175,35 +729,76 @@ class Queue:
                 while cls.con.notifies:
                     _ = cls.con.notifies.pop(0)
 
+    @staticmethod
+    def _get_queue_item_from_row(row: Tuple) -> QueueItem:
+        """Create a queue item from a row of `QUEUE_ITEM_COLUMNS`"""
+        return QueueItem(
+            uuid=UUID(row[0]),
+            status=StatusEnum(row[1]),
+            retries=row[2],
+            user=UserSerializer.deserialize(row[3]),
+            synth=Synth.from_id(row[4]),
+            midi_file=row[5],
+            midi_length=row[6],
+            midi_hash=row[7],
+            priority=row[8],
+            artifacts={name: Artifact.deserialize(data) for name, data in row[9].items()},
+            xruns=row[10],
+            recaptures=row[11],
+            notified=row[12],
+        )
+
     @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
     def get_front_queue_item(cls, synth: Synth) -> Optional[QueueItem]:
         """Return the front of the queue for the given `synth`"""
         cur = cls._get_cursor()
-        cur.execute("""
-            SELECT
-                uuid,
-                status,
-                retries,
-                userdata,
-                synth,
-                midi_file,
-                midi_length
-            FROM queue
-            WHERE synth=%s
-              AND status NOT IN ('done', 'failed')
-            ORDER BY created_at
+        cur.execute(f"""
+            SELECT {QUEUE_ITEM_COLUMNS}
+            FROM ({cls._get_scheduled_sql()}) scheduled
+            ORDER BY position
+            LIMIT 1
         """, [
             synth.get_id()
         ])
         result = cur.fetchone()
         if result:
-            return QueueItem(
-                uuid=UUID(result[0]),
-                status=StatusEnum(result[1]),
-                retries=result[2],
-                user=UserSerializer.deserialize(result[3]),
-                synth=Synth.from_id(result[4]),
-                midi_file=result[5],
-                midi_length=result[6],
-            )
+            return cls._get_queue_item_from_row(result)
+        return None
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def get_queue_item(cls, uuid: UUID) -> Optional[QueueItem]:
+        """Return the queue item with the given `uuid`"""
+        cur = cls._get_cursor()
+        cur.execute(f"""
+            SELECT {QUEUE_ITEM_COLUMNS}
+            FROM queue
+            WHERE uuid=%s
+        """, [
+            str(uuid)
+        ])
+        result = cur.fetchone()
+        if result:
+            return cls._get_queue_item_from_row(result)
         return None
+
+    @classmethod
+    @timed(DB_QUERY_SECONDS)
+    @traced()
+    def get_queue_item_position(cls, queue_item: QueueItem) -> Optional[int]:
+        """Return the 1-based place of the queue item in its synth's queue under
+        the scheduling policy, None once it is no longer pending"""
+        cur = cls._get_cursor()
+        cur.execute(f"""
+            SELECT position
+            FROM ({cls._get_scheduled_sql()}) scheduled
+            WHERE uuid=%s
+        """, [
+            queue_item.synth.get_id(),
+            str(queue_item.uuid)
+        ])
+        result = cur.fetchone()
+        return result[0] if result else None
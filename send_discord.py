@@ -0,0 +1,58 @@
+"""Script to post Discord notifications waiting in the outbox in batches"""
+from os import environ
+import logging
+from typing import List
+
+from dotenv import load_dotenv
+import sdnotify # type: ignore
+
+import metrics
+import tracing
+from discord_client import DiscordClient, DiscordError, DiscordNotifier
+from outbox import Outbox, OutboxChannel, OutboxMessage
+
+load_dotenv()
+
+BATCH_WINDOW = 1.0
+
+def send_messages(notifier: DiscordNotifier, messages: List[OutboxMessage]):
+    """Post `messages` and record the outcome of each in the outbox"""
+    batch = []
+    for message in messages:
+        assert message.discord_channel_id is not None and message.discord_user_id is not None
+        batch.append((message.discord_channel_id, message.discord_user_id, message.content))
+    for message, error in zip(messages, notifier.post(batch)):
+        if error is None:
+            logging.info('Sent message %d to discord user %d',
+                message.id, message.discord_user_id)
+            Outbox.mark_sent(message)
+        else:
+            permanent = isinstance(error, DiscordError) and error.is_permanent()
+            logging.error('Could not send message %d (permanent=%s): %s',
+                message.id, permanent, error)
+            Outbox.mark_failed(message, str(error), permanent=permanent)
+
+def main():
+    """Main program"""
+    logging.basicConfig(level=logging.INFO)
+    logging.info('Started.')
+    metrics.start('send_discord')
+    tracing.start('send_discord')
+    system_notifier = sdnotify.SystemdNotifier()
+    notifier = DiscordNotifier(DiscordClient())
+    logging.info('Connecting to outbox...')
+    Outbox.connect(environ['DATABASE_URL'])
+
+    system_notifier.notify('READY=1')
+    while True:
+        logging.info('Fetching outbox messages...')
+        for messages in Outbox.fetch_batches(channel=OutboxChannel.DISCORD,
+                batch_window=BATCH_WINDOW):
+            logging.info('Watchdog pulse...')
+            system_notifier.notify('WATCHDOG=1')
+            send_messages(notifier, messages)
+        logging.info('Watchdog pulse...')
+        system_notifier.notify('WATCHDOG=1')
+
+if __name__ == "__main__":
+    main()
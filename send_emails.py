@@ -0,0 +1,66 @@
+"""Script to send emails waiting in the outbox over one SMTP session"""
+from os import environ
+import logging
+from smtplib import SMTPRecipientsRefused, SMTPResponseException
+
+from dotenv import load_dotenv
+import sdnotify # type: ignore
+
+import metrics
+import tracing
+from email_client import EmailClient
+from outbox import Outbox, OutboxMessage
+
+load_dotenv()
+
+def send_message(email: EmailClient, message: OutboxMessage):
+    """Send `message` and record the outcome in the outbox"""
+    assert message.to_email is not None and message.subject is not None
+    try:
+        email.send(
+            to_email=message.to_email,
+            subject=message.subject,
+            content=message.content
+        )
+    except SMTPRecipientsRefused as e:
+        logging.error('Recipient %s refused, giving up: %s', message.to_email, e)
+        Outbox.mark_failed(message, str(e), permanent=True)
+    except SMTPResponseException as e:
+        permanent = e.smtp_code >= 500
+        logging.error('Could not send message %d (permanent=%s): %s', message.id, permanent, e)
+        Outbox.mark_failed(message, str(e), permanent=permanent)
+    except OSError as e:
+        logging.error('Could not send message %d, will retry: %s', message.id, e)
+        email.close()
+        Outbox.mark_failed(message, str(e))
+    else:
+        logging.info('Sent message %d to %s', message.id, message.to_email)
+        Outbox.mark_sent(message)
+
+def main():
+    """Main program"""
+    logging.basicConfig(level=logging.INFO)
+    logging.info('Started.')
+    metrics.start('send_emails')
+    tracing.start('send_emails')
+    system_notifier = sdnotify.SystemdNotifier()
+    email = EmailClient(
+        email_account=environ['EMAIL_ACCOUNT'],
+        email_key=environ['EMAIL_ACCOUNT_KEY']
+    )
+    logging.info('Connecting to outbox...')
+    Outbox.connect(environ['DATABASE_URL'])
+
+    system_notifier.notify('READY=1')
+    while True:
+        logging.info('Fetching outbox messages...')
+        for message in Outbox.fetch_messages():
+            logging.info('Watchdog pulse...')
+            system_notifier.notify('WATCHDOG=1')
+            send_message(email, message)
+        email.close()
+        logging.info('Watchdog pulse...')
+        system_notifier.notify('WATCHDOG=1')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""Drive synthetic requests through fetch_emails, the queue and a worker
+
+Run with `python -m simulation.driver --database-url <url>` against a scratch
+database, which is migrated to head and emptied. The services run unchanged
+as subprocesses, with SynthNull recorded by the fake ALSA tools and email and
+storage served by the local stand-ins, and the driver reports throughput,
+synth utilization and end-to-end latency.
+"""
+import argparse
+import email
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from email.message import EmailMessage
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+import mido # type: ignore
+import psycopg2
+from alembic import command, config
+
+from simulation import fake_tools
+from simulation.servers import AzureServer, ImapServer, SmtpServer, serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAILBOX = 'dtmaas'
+SYNTH_ID = 'nullsynth'
+
+def make_midi(seconds: int) -> bytes:
+    """Return a type 1 MIDI file holding one note for `seconds` at 120 bpm"""
+    midi_file = mido.MidiFile(type=1, ticks_per_beat=480)
+    track = mido.MidiTrack()
+    track.append(mido.Message('program_change', program=0, time=0))
+    track.append(mido.Message('note_on', note=60, velocity=64, time=0))
+    track.append(mido.Message('note_off', note=60, velocity=0, time=seconds * 2 * 480))
+    midi_file.tracks.append(track)
+    data = io.BytesIO()
+    midi_file.save(file=data)
+    return data.getvalue()
+
+def make_request(from_email: str, midi_name: str, midi_data: Optional[bytes],
+        synth_id: str = SYNTH_ID) -> bytes:
+    """Return a request email, with `midi_data` attached if given"""
+    message = EmailMessage()
+    message['From'] = from_email
+    message['To'] = f'dtmaas+{synth_id}@sim.example'
+    message['Subject'] = 'Please record'
+    message.set_content('Attached')
+    if midi_data is not None:
+        message.add_attachment(midi_data, maintype='audio', subtype='midi', filename=midi_name)
+    return message.as_bytes()
+
+def get_percentiles(samples: Sequence[float]) -> Dict[str, float]:
+    """Return the count, mean, p50 and p95 of `samples`"""
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0}
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': ordered[int(.5 * len(ordered))],
+        'p95': ordered[min(len(ordered) - 1, int(.95 * len(ordered)))],
+    }
+
+def reset_database(database_url: str):
+    """Migrate the scratch database and empty every table"""
+    # alembic's env.py reads the url from the environment
+    os.environ['DATABASE_URL'] = database_url
+    command.upgrade(config.Config(os.path.join(ROOT, 'alembic.ini')), 'head')
+    con = psycopg2.connect(database_url)
+    con.autocommit = True
+    con.cursor().execute("""
+        TRUNCATE queue, queue_subscriber, midi_blob, stage_history, stage_model, rate_limit,
+            mailbox_state, outbox
+    """)
+    con.close()
+
+class Service:
+    """A service subprocess restarted when it exits, as systemd would"""
+    RESTART_DELAY = 1
+
+    def __init__(self, name: str, args: List[str], env: Dict[str, str], log_dir: str):
+        self.name = name
+        self.args = args
+        self.env = env
+        self.log_path = os.path.join(log_dir, f'{name}.log')
+        self.restarts = 0
+        self.stopping = False
+        self.proc: Optional[subprocess.Popen] = None
+        self.thread = threading.Thread(target=self._supervise, name=name, daemon=True)
+
+    def start(self):
+        """Start the service and keep it running"""
+        self._spawn()
+        self.thread.start()
+
+    def _spawn(self):
+        with open(self.log_path, 'ab') as log:
+            self.proc = subprocess.Popen( # pylint: disable=consider-using-with
+                [sys.executable, *self.args], cwd=ROOT, env=self.env,
+                stdout=log, stderr=subprocess.STDOUT)
+
+    def _supervise(self):
+        while not self.stopping:
+            assert self.proc is not None
+            if self.proc.poll() is not None and not self.stopping:
+                self.restarts += 1
+                time.sleep(self.RESTART_DELAY)
+                self._spawn()
+            time.sleep(.2)
+
+    def stop(self):
+        """Stop the service"""
+        self.stopping = True
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+def get_service_env(args, imap: ImapServer, smtp: SmtpServer, azure: AzureServer,
+        work_dir: str) -> Dict[str, str]:
+    """Return the environment pointing the services at the stand-ins"""
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_URL': args.database_url,
+        'SIMULATION': '1',
+        'EMAIL_ACCOUNT': 'dtmaas@sim.example',
+        'EMAIL_ACCOUNT_KEY': 'simulated',
+        'EMAIL_SSL': '0',
+        'IMAP_HOST': 'localhost',
+        'IMAP_PORT': str(imap.server_address[1]),
+        'SMTP_HOST': 'localhost',
+        'SMTP_PORT': str(smtp.server_address[1]),
+        'AZURE_TENANT_ID': 'simulated',
+        'AZURE_CLIENT_ID': 'simulated',
+        'AZURE_CLIENT_SECRET': 'simulated',
+        'AZURE_LOGIN_URL': azure.get_url(),
+        'AZURE_BLOB_URL': f'{azure.get_url()}/{{blob_account}}',
+        'MEDIA_PATH': os.path.join(work_dir, 'media'),
+        'MEDIA_HOT_PATH': '',
+        'MIDO_BACKEND': 'simulation.mido_backend',
+        'PATH': f'{os.path.join(work_dir, "bin")}{os.pathsep}{os.environ["PATH"]}',
+        'PYTHONPATH': ROOT,
+        'QUEUE_POLICY': args.policy,
+        'RENDITIONS': args.renditions,
+        'SIM_TIME_SCALE': str(args.time_scale),
+        'SIM_ENCODE_SPEED': str(args.encode_speed),
+        'SIM_FAIL_ARECORD': str(args.fail_arecord),
+        'SIM_FAIL_APLAYMIDI': str(args.fail_aplaymidi),
+        'SIM_FAIL_SOX': str(args.fail_sox),
+        'SIM_XRUN_RATE': str(args.xrun_rate),
+    })
+    return env
+
+def get_stage_stats(database_url: str) -> Dict[str, Any]:
+    """Summarize the stage history and final statuses of the run"""
+    con = psycopg2.connect(database_url)
+    cur = con.cursor()
+    cur.execute("""
+        SELECT stage, EXTRACT(EPOCH FROM ended_at - started_at)
+        FROM stage_history
+    """)
+    stages: Dict[str, List[float]] = {}
+    for stage, duration in cur.fetchall():
+        stages.setdefault(stage, []).append(float(duration))
+    cur.execute("SELECT status, COUNT(*) FROM queue GROUP BY status")
+    statuses = dict(cur.fetchall())
+    cur.execute("SELECT COALESCE(SUM(xruns), 0), COALESCE(SUM(recaptures), 0) FROM queue")
+    xruns, recaptures = cur.fetchone()
+    con.close()
+    return {
+        'stages': {stage: get_percentiles(durations) for stage, durations in stages.items()},
+        'recording_seconds': sum(stages.get('recording', [])),
+        'statuses': statuses,
+        'xruns': int(xruns),
+        'recaptures': int(recaptures),
+    }
+
+def get_replies(smtp: SmtpServer) -> Dict[str, Dict[str, float]]:
+    """Return when each user was sent each subject"""
+    replies: Dict[str, Dict[str, float]] = {}
+    with smtp.lock:
+        messages = list(smtp.messages)
+    for message in messages:
+        parsed = email.message_from_bytes(message.data)
+        for rcpt in message.rcpt_to:
+            replies.setdefault(rcpt, {}).setdefault(str(parsed['Subject']), message.received_at)
+    return replies
+
+def get_failed_users(database_url: str) -> Set[str]:
+    """Return the users whose requests the worker gave up on"""
+    con = psycopg2.connect(database_url)
+    cur = con.cursor()
+    cur.execute("SELECT userdata->>'email' FROM queue WHERE status='failed'")
+    failed = {row[0] for row in cur.fetchall()}
+    con.close()
+    return failed
+
+def is_finished(replies: Dict[str, float]) -> bool:
+    """Check whether a request was rejected or recorded"""
+    return 'DTMaaS Recording' in replies or 'DTMaaS Error Confirmation' in replies
+
+def main():
+    """Main program"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--database-url', default=os.environ.get('SIMULATION_DATABASE_URL'),
+        help='scratch database to run against, it is emptied')
+    parser.add_argument('--jobs', type=int, default=20, help='number of requests to send')
+    parser.add_argument('--rate', type=float, default=60,
+        help='mean requests per minute, arriving as a Poisson process')
+    parser.add_argument('--min-length', type=int, default=30, help='shortest MIDI in seconds')
+    parser.add_argument('--max-length', type=int, default=180, help='longest MIDI in seconds')
+    parser.add_argument('--time-scale', type=float, default=.01,
+        help='real seconds the fake tools take per simulated second')
+    parser.add_argument('--encode-speed', type=float, default=50,
+        help='how many times faster than realtime the fake sox encodes')
+    parser.add_argument('--policy', default='fair_share', help='queue scheduling policy')
+    parser.add_argument('--renditions', default='flac', help='renditions to encode')
+    for tool in ('arecord', 'aplaymidi', 'sox'):
+        parser.add_argument(f'--fail-{tool}', type=float, default=0.,
+            help=f'probability {tool} fails')
+    parser.add_argument('--xrun-rate', type=float, default=0.,
+        help='overruns per minute the fake arecord reports')
+    parser.add_argument('--fail-smtp', type=float, default=0.,
+        help='probability the SMTP server rejects a message')
+    parser.add_argument('--fail-blob', type=float, default=0.,
+        help='probability a blob upload fails')
+    parser.add_argument('--timeout', type=float, default=600,
+        help='seconds to wait for all requests to finish')
+    parser.add_argument('--seed', type=int, default=None, help='random seed of the workload')
+    parser.add_argument('--output', default='simulation.json',
+        help='file to write the JSON report to')
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error('--database-url or SIMULATION_DATABASE_URL is required')
+    rng = random.Random(args.seed)
+
+    reset_database(args.database_url)
+    work_dir = tempfile.mkdtemp(prefix='dtmaas-sim-')
+    fake_tools.install(os.path.join(work_dir, 'bin'))
+    imap = serve(ImapServer())
+    smtp = serve(SmtpServer(fail_rate=args.fail_smtp))
+    azure = serve(AzureServer(fail_rate=args.fail_blob))
+    env = get_service_env(args, imap, smtp, azure, work_dir)
+    services = [
+        Service('fetch_emails', ['fetch_emails.py'], env, work_dir),
+        Service('send_emails', ['send_emails.py'], env, work_dir),
+        Service('worker', ['worker.py', SYNTH_ID], env, work_dir),
+    ]
+    for service in services:
+        service.start()
+    print(f'Running in "{work_dir}"...')
+
+    submitted: Dict[str, float] = {}
+    midi_lengths: Dict[str, int] = {}
+    try:
+        for index in range(args.jobs):
+            from_email = f'user{index}@sim.example'
+            midi_lengths[from_email] = rng.randint(args.min_length, args.max_length)
+            data = make_request(from_email, f'job{index}.mid', make_midi(midi_lengths[from_email]))
+            submitted[from_email] = time.time()
+            imap.append(MAILBOX, data)
+            time.sleep(rng.expovariate(args.rate / 60))
+
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            replies = get_replies(smtp)
+            failed = get_failed_users(args.database_url)
+            if all(is_finished(replies.get(user, {})) or user in failed for user in submitted):
+                break
+            time.sleep(.5)
+    finally:
+        for service in services:
+            service.stop()
+
+    replies = get_replies(smtp)
+    latencies = [replies[user]['DTMaaS Recording'] - start
+        for user, start in submitted.items() if 'DTMaaS Recording' in replies.get(user, {})]
+    finished = [max(replies[user].values()) for user in submitted if replies.get(user)]
+    wall = (max(finished) if finished else time.time()) - min(submitted.values())
+    stats = get_stage_stats(args.database_url)
+    report = {
+        'parameters': {key: value for key, value in vars(args).items() if key != 'database_url'},
+        'work_dir': work_dir,
+        'submitted': len(submitted),
+        'recorded': len(latencies),
+        'rejected': sum('DTMaaS Error Confirmation' in replies.get(user, {})
+            for user in submitted),
+        'wall_seconds': wall,
+        'jobs_per_hour': len(latencies) / wall * 3600,
+        'synth_utilization': stats['recording_seconds'] / wall,
+        'end_to_end_seconds': get_percentiles(latencies),
+        'stage_seconds': stats['stages'],
+        'statuses': stats['statuses'],
+        'xruns': stats['xruns'],
+        'recaptures': stats['recaptures'],
+        'restarts': {service.name: service.restarts for service in services},
+        'uploaded_bytes': sum(azure.blobs.values()),
+    }
+    print(json.dumps(report, indent=2))
+    with open(args.output, 'w', encoding='utf8') as fp:
+        json.dump(report, fp, indent=2)
+    print(f'Wrote report to "{args.output}"')
+
+if __name__ == '__main__':
+    main()
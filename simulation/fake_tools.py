@@ -0,0 +1,149 @@
+"""Stand-ins for arecord, aplaymidi and sox that take scaled time and can fail
+
+They are installed as executables by `install` and configured from the
+environment:
+
+SIM_TIME_SCALE: real seconds taken per simulated second
+SIM_ENCODE_SPEED: how many times faster than realtime sox encodes
+SIM_FAIL_<TOOL>: probability the tool fails, e.g. SIM_FAIL_ARECORD
+SIM_XRUN_RATE: overruns arecord reports per simulated minute
+"""
+import io
+import os
+import random
+import struct
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import mido # type: ignore
+
+from artifacts import get_samples
+from synth import CaptureProfile
+
+TOOLS = ('arecord', 'aplaymidi', 'sox')
+# bytes per second of audio for the lossy renditions
+LOSSY_BYTE_RATES = {'mp3': 24000, 'ogg': 20000}
+FLAC_RATIO = .6
+
+def get_time_scale() -> float:
+    """Return the real seconds taken per simulated second"""
+    return float(os.environ.get('SIM_TIME_SCALE', '.01'))
+
+def will_fail(tool: str) -> bool:
+    """Decide whether this run of `tool` fails, at its configured failure rate"""
+    return random.random() < float(os.environ.get(f'SIM_FAIL_{tool.upper()}', '0'))
+
+def fail(tool: str, message: str):
+    """Exit with an error like the real tool's"""
+    print(f'{tool}: {message}', file=sys.stderr)
+    sys.exit(1)
+
+def maybe_fail(tool: str, message: str):
+    """Exit with an error at the configured failure rate of `tool`"""
+    if will_fail(tool):
+        fail(tool, message)
+
+def parse_args(args: List[str]) -> Tuple[Dict[str, str], List[str]]:
+    """Split `--option value` pairs from positional arguments, ignoring flags"""
+    options = {}
+    positional = []
+    flags = ('--verbose', '--fatal-errors', '--nonblock')
+    pos = 0
+    while pos < len(args):
+        if args[pos] in flags:
+            pos += 1
+        elif args[pos].startswith('-') and args[pos] != '-':
+            options[args[pos].lstrip('-')] = args[pos + 1]
+            pos += 2
+        else:
+            positional.append(args[pos])
+            pos += 1
+    return options, positional
+
+def write_sparse(fp, size: int):
+    """Grow the file to `size` bytes without writing them"""
+    fp.truncate(size)
+    fp.seek(size)
+
+def arecord(args: List[str]):
+    """Capture silence for `--duration` seconds, growing the WAV as it goes"""
+    options, positional = parse_args(args)
+    profile = CaptureProfile(
+        channels=int(options['channels']),
+        channel_map=(1, 2),
+        sample_format=options['format'],
+        rate=int(options['rate']),
+        buffer_size=int(options.get('buffer-size', 0)),
+        period_size=int(options.get('period-size', 0)),
+    )
+    duration = int(options['duration'])
+    block_align = profile.channels * profile.get_sample_width()
+    data_size = duration * profile.rate * block_align
+    with open(positional[-1], 'wb') as fp:
+        fp.write(b'RIFF' + struct.pack('<I', 36 + data_size) + b'WAVE')
+        fp.write(b'fmt ' + struct.pack('<IHHIIHH', 16, 1, profile.channels, profile.rate,
+            profile.rate * block_align, block_align, profile.get_sample_width() * 8))
+        fp.write(b'data' + struct.pack('<I', data_size))
+        start = time.monotonic()
+        real_duration = duration * get_time_scale()
+        # a failing capture breaks off somewhere along the way
+        fail_at = random.uniform(0, real_duration) if will_fail('arecord') else None
+        xrun_rate = float(os.environ.get('SIM_XRUN_RATE', '0')) / 60 / get_time_scale()
+        xrun_at = random.expovariate(xrun_rate) if xrun_rate else real_duration
+        while (elapsed := time.monotonic() - start) < real_duration:
+            if fail_at is not None and elapsed >= fail_at:
+                fail('arecord', 'pcm_read:2221: read error: Input/output error')
+            while elapsed >= xrun_at:
+                print(f'overrun!!! (at least {random.uniform(1, 50):.3f} ms long)',
+                    file=sys.stderr, flush=True)
+                xrun_at += random.expovariate(xrun_rate)
+            write_sparse(fp, 44 + int(data_size * elapsed / real_duration) // block_align
+                * block_align)
+            fp.flush()
+            time.sleep(min(.1, real_duration - elapsed))
+        write_sparse(fp, 44 + data_size)
+
+def aplaymidi(args: List[str]):
+    """Play the MIDI file from stdin for as long as it lasts"""
+    _, positional = parse_args(args)
+    assert positional == ['-']
+    midi_file = mido.MidiFile(file=io.BytesIO(sys.stdin.buffer.read()))
+    maybe_fail('aplaymidi', 'Cannot connect to port')
+    time.sleep(midi_file.length * get_time_scale())
+
+def sox(args: List[str]):
+    """Encode a WAV to a file of the output format with the same length"""
+    wav_path, output_path = [arg for arg in args
+        if arg.rsplit('.', 1)[-1] in ('wav', 'flac', 'mp3', 'ogg')][:2]
+    samples = get_samples(wav_path)
+    with open(wav_path, 'rb') as fp:
+        rate = struct.unpack('<24xI', fp.read(28))[0]
+    seconds = samples / rate
+    time.sleep(seconds / float(os.environ.get('SIM_ENCODE_SPEED', '50')) * get_time_scale())
+    maybe_fail('sox', 'Input/output error')
+
+    extension = output_path.rsplit('.', 1)[-1]
+    with open(output_path, 'wb') as fp:
+        if extension == 'flac':
+            streaminfo = struct.pack('>HH3s3sQ16x', 4096, 4096, b'\0\0\0', b'\0\0\0',
+                rate << 44 | 1 << 41 | 23 << 36 | samples)
+            fp.write(b'fLaC\x80' + len(streaminfo).to_bytes(3, 'big') + streaminfo)
+            write_sparse(fp, int(samples * 2 * 3 * FLAC_RATIO))
+        else:
+            fp.write(b'ID3\4\0\0\0\0\0\0')
+            write_sparse(fp, int(seconds * LOSSY_BYTE_RATES[extension]))
+
+def install(bin_dir: str):
+    """Write executables for the fake tools to `bin_dir`, for the front of PATH"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.makedirs(bin_dir, exist_ok=True)
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w', encoding='utf8') as fp:
+            fp.write(f'#!{sys.executable}\n'
+                'import sys\n'
+                f'sys.path.insert(0, {root!r})\n'
+                f'from simulation.fake_tools import {tool}\n'
+                f'{tool}(sys.argv[1:])\n')
+        os.chmod(path, 0o755)
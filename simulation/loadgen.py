@@ -0,0 +1,233 @@
+"""Mail synthetic request load into a local IMAP server while fetch_emails ingests it
+
+Run with `python -m simulation.loadgen --database-url <url>` against a scratch
+database, which is migrated to head and emptied. fetch_emails runs unchanged
+against the local IMAP stand-in, while requests are appended to its mailbox
+at a given rate: valid MIDIs of varying sizes, from a corpus if one is given,
+and invalid requests without a MIDI, with a broken MIDI, too large or for an
+unknown synth. Each request comes from its own sender so admission control
+does not interfere, and the report gives the throughput and the latency from
+appending a request to its reply being written to the outbox and, for valid
+ones, to it being enqueued.
+"""
+import argparse
+import imaplib
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+import mido # type: ignore
+import psycopg2
+
+from simulation.driver import (MAILBOX, SYNTH_ID, Service, get_percentiles, make_request,
+    reset_database)
+from simulation.servers import ImapServer, serve
+
+# kinds of request and the subject of the expected reply
+KINDS = {
+    'valid': 'DTMaaS Success Confirmation',
+    'no_midi': 'DTMaaS Error Confirmation',
+    'bad_midi': 'DTMaaS Error Confirmation',
+    'oversize': 'DTMaaS Error Confirmation',
+    'unknown_synth': 'DTMaaS Error Confirmation',
+}
+OVERSIZE_BYTES = 1024*1024 + 4096
+
+def make_random_midi(rng: random.Random, seconds: int, notes_per_second: float) -> bytes:
+    """Return a type 0 MIDI file of random notes lasting about `seconds` at 120 bpm"""
+    midi_file = mido.MidiFile(type=0, ticks_per_beat=480)
+    track = mido.MidiTrack()
+    track.append(mido.Message('program_change', program=rng.randrange(128), time=0))
+    ticks = seconds * 2 * 480
+    notes = max(1, int(seconds * notes_per_second))
+    step = ticks // notes
+    for _ in range(notes):
+        note = rng.randint(36, 96)
+        track.append(mido.Message('note_on', note=note, velocity=rng.randint(32, 127), time=0))
+        track.append(mido.Message('note_off', note=note, velocity=0, time=step))
+    midi_file.tracks.append(track)
+    data = io.BytesIO()
+    midi_file.save(file=data)
+    return data.getvalue()
+
+def load_corpus(path: str) -> List[Tuple[str, bytes]]:
+    """Return the names and contents of the MIDI files in directory `path`"""
+    corpus = []
+    for name in sorted(os.listdir(path)):
+        if name.lower().endswith(('.mid', '.midi')):
+            with open(os.path.join(path, name), 'rb') as fp:
+                corpus.append((name, fp.read()))
+    return corpus
+
+def make_load_request(rng: random.Random, kind: str, from_email: str, args,
+        corpus: List[Tuple[str, bytes]]) -> bytes:
+    """Return a request email of `kind`"""
+    if kind == 'no_midi':
+        return make_request(from_email, 'none.mid', None)
+    if kind == 'bad_midi':
+        return make_request(from_email, 'broken.mid', rng.randbytes(rng.randint(16, 4096)))
+    if kind == 'oversize':
+        return make_request(from_email, 'huge.mid', rng.randbytes(OVERSIZE_BYTES))
+    if corpus:
+        midi_name, midi_data = rng.choice(corpus)
+    else:
+        midi_name = f'{from_email.split("@")[0]}.mid'
+        midi_data = make_random_midi(rng, rng.randint(args.min_length, args.max_length),
+            rng.uniform(.5, args.max_notes_per_second))
+    synth_id = 'unknownsynth' if kind == 'unknown_synth' else SYNTH_ID
+    return make_request(from_email, midi_name, midi_data, synth_id)
+
+def deliver(imap_port: int, requests: List[Tuple[str, bytes]], rate: float,
+        rng: random.Random, appended: Dict[str, float]):
+    """APPEND `requests` as a Poisson process of `rate` per second, noting
+    when each was appended"""
+    imap = imaplib.IMAP4('localhost', imap_port)
+    imap.login('loadgen', 'loadgen')
+    next_at = time.monotonic()
+    for from_email, data in requests:
+        next_at += rng.expovariate(rate)
+        time.sleep(max(0., next_at - time.monotonic()))
+        result, _ = imap.append(MAILBOX, '', imaplib.Time2Internaldate(time.time()), data)
+        assert result == 'OK'
+        appended[from_email] = time.time()
+    imap.logout()
+
+def get_handled(database_url: str) -> Tuple[Dict[str, Tuple[str, float]], Dict[str, float]]:
+    """Return the reply subject and time written to the outbox, and the time
+    enqueued, of each sender"""
+    con = psycopg2.connect(database_url)
+    cur = con.cursor()
+    cur.execute("SELECT to_email, subject, EXTRACT(EPOCH FROM created_at::TIMESTAMPTZ) FROM outbox")
+    replies = {to_email: (subject, float(at)) for to_email, subject, at in cur.fetchall()}
+    cur.execute("""
+        SELECT userdata->>'email', EXTRACT(EPOCH FROM created_at::TIMESTAMPTZ)
+        FROM queue
+    """)
+    enqueued = {from_email: float(at) for from_email, at in cur.fetchall()}
+    con.close()
+    return replies, enqueued
+
+def get_report(kinds: Dict[str, str], appended: Dict[str, float],
+        replies: Dict[str, Tuple[str, float]], enqueued: Dict[str, float]) -> Dict[str, Any]:
+    """Summarize latencies and outcomes per kind of request"""
+    report: Dict[str, Any] = {}
+    for kind, expected_subject in KINDS.items():
+        senders = [sender for sender, sender_kind in kinds.items()
+            if sender_kind == kind and sender in appended]
+        if not senders:
+            continue
+        report[kind] = {
+            'sent': len(senders),
+            'replied': sum(sender in replies for sender in senders),
+            'unexpected_replies': sum(replies[sender][0] != expected_subject
+                for sender in senders if sender in replies),
+            'reply_seconds': get_percentiles([replies[sender][1] - appended[sender]
+                for sender in senders if sender in replies]),
+        }
+        if kind == 'valid':
+            report[kind]['enqueue_seconds'] = get_percentiles(
+                [enqueued[sender] - appended[sender] for sender in senders
+                    if sender in enqueued])
+    return report
+
+def main():
+    """Main program"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--database-url', default=os.environ.get('SIMULATION_DATABASE_URL'),
+        help='scratch database to run against, it is emptied')
+    parser.add_argument('--requests', type=int, default=200, help='number of requests to send')
+    parser.add_argument('--rate', type=float, default=10,
+        help='mean requests per second, arriving as a Poisson process')
+    parser.add_argument('--mix', default='valid=80,no_midi=5,bad_midi=5,oversize=5,'
+        'unknown_synth=5', help='relative weights of the kinds of request')
+    parser.add_argument('--corpus', help='directory of MIDI files to send instead of random ones')
+    parser.add_argument('--min-length', type=int, default=10,
+        help='shortest random MIDI in seconds')
+    parser.add_argument('--max-length', type=int, default=600,
+        help='longest random MIDI in seconds')
+    parser.add_argument('--max-notes-per-second', type=float, default=20,
+        help='densest random MIDI, which sets the size of the larger files')
+    parser.add_argument('--ingest-workers', type=int, default=4,
+        help='INGEST_WORKERS of fetch_emails')
+    parser.add_argument('--timeout', type=float, default=120,
+        help='seconds to wait for replies after the last request')
+    parser.add_argument('--seed', type=int, default=None, help='random seed of the workload')
+    parser.add_argument('--output', default='loadgen.json',
+        help='file to write the JSON report to')
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error('--database-url or SIMULATION_DATABASE_URL is required')
+    weights = {kind: float(weight) for kind, weight
+        in (pair.split('=') for pair in args.mix.split(','))}
+    unknown = set(weights) - set(KINDS)
+    if unknown:
+        parser.error(f'unknown kinds of request {", ".join(sorted(unknown))}')
+    rng = random.Random(args.seed)
+    corpus = load_corpus(args.corpus) if args.corpus else []
+
+    print('Building requests...')
+    kinds: Dict[str, str] = {}
+    requests = []
+    for index in range(args.requests):
+        from_email = f'load{index}@sim.example'
+        kinds[from_email] = rng.choices(list(weights), list(weights.values()))[0]
+        requests.append((from_email,
+            make_load_request(rng, kinds[from_email], from_email, args, corpus)))
+
+    reset_database(args.database_url)
+    work_dir = tempfile.mkdtemp(prefix='dtmaas-loadgen-')
+    imap = serve(ImapServer())
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_URL': args.database_url,
+        'SIMULATION': '1',
+        'EMAIL_ACCOUNT': 'dtmaas@sim.example',
+        'EMAIL_ACCOUNT_KEY': 'simulated',
+        'EMAIL_SSL': '0',
+        'IMAP_HOST': 'localhost',
+        'IMAP_PORT': str(imap.server_address[1]),
+        'INGEST_WORKERS': str(args.ingest_workers),
+        'PYTHONPATH': os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    })
+    fetch_emails = Service('fetch_emails', ['fetch_emails.py'], env, work_dir)
+    fetch_emails.start()
+    print(f'Running in "{work_dir}"...')
+
+    appended: Dict[str, float] = {}
+    replies: Dict[str, Tuple[str, float]] = {}
+    enqueued: Dict[str, float] = {}
+    try:
+        deliver(imap.server_address[1], requests, args.rate, rng, appended)
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            replies, enqueued = get_handled(args.database_url)
+            if all(sender in replies for sender in appended):
+                break
+            time.sleep(.5)
+    finally:
+        fetch_emails.stop()
+
+    handled = [at for sender, (_, at) in replies.items() if sender in appended]
+    wall = (max(handled) if handled else time.time()) - min(appended.values())
+    report = {
+        'parameters': {key: value for key, value in vars(args).items() if key != 'database_url'},
+        'work_dir': work_dir,
+        'sent': len(appended),
+        'sent_bytes': sum(len(data) for _, data in requests),
+        'handled': len(handled),
+        'wall_seconds': wall,
+        'requests_per_second': len(handled) / wall if wall > 0 else 0.,
+        'kinds': get_report(kinds, appended, replies, enqueued),
+        'restarts': fetch_emails.restarts,
+    }
+    print(json.dumps(report, indent=2))
+    with open(args.output, 'w', encoding='utf8') as fp:
+        json.dump(report, fp, indent=2)
+    print(f'Wrote report to "{args.output}"')
+
+if __name__ == '__main__':
+    main()
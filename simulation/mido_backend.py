@@ -0,0 +1,22 @@
+"""Mido backend with a single port that accepts and drops every message
+
+Select it with MIDO_BACKEND=simulation.mido_backend. The port is named like an
+ALSA sequencer port of SynthNull so its client:port address can be parsed.
+"""
+from mido.ports import BaseInput, BaseOutput # type: ignore
+
+PORT_NAME = 'Midi Through:Midi Through Port-0 14:0'
+
+def get_devices(**_) -> list:
+    """Return the one fake port"""
+    return [{'name': PORT_NAME, 'is_input': True, 'is_output': True}]
+
+class Input(BaseInput):
+    """Input port that never receives anything"""
+    def _receive(self, block=True):
+        return None
+
+class Output(BaseOutput):
+    """Output port that drops what is sent to it"""
+    def _send(self, msg):
+        pass
@@ -0,0 +1,222 @@
+"""Replay queue history against scheduling policies and fleet sizes
+
+Run with `python -m simulation.schedule_sim --database-url <url>` against a
+database holding production history, which is only read. Every queue row is
+replayed as a job arriving at its `created_at`, taking the stage durations it
+took according to `stage_history`, or the fitted stage models where it has
+none. Each synth unit works through its jobs one at a time like a worker does,
+and the simulator reports the waiting time until a job is picked up, the
+latency until its user is notified, and how busy the synths were.
+"""
+import argparse
+import heapq
+import json
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from queue_client import Queue, STAGES, StatusEnum, SchedulingPolicy
+from simulation.driver import get_percentiles
+from synth import Synth
+
+# stages the user waits for, publishing happens after they are notified
+NOTIFIED_STAGES = STAGES[:STAGES.index(StatusEnum.NOTIFYING) + 1]
+
+@dataclass
+class Job:
+    """A queue item replayed from history"""
+    uuid: str
+    user: str
+    synth: str
+    midi_length: int
+    priority: int
+    arrival: float
+    stages: Dict[StatusEnum, float] = field(default_factory=dict)
+
+    def get_service_time(self) -> float:
+        """Return how long the job keeps a worker busy"""
+        return sum(self.stages.values())
+
+    def get_notify_time(self) -> float:
+        """Return how long after starting the job its user is notified"""
+        return sum(self.stages.get(stage, 0.) for stage in NOTIFIED_STAGES)
+
+def rank_user_jobs(pending: List[Job]) -> Dict[str, Tuple[int, int]]:
+    """Return each pending job's rank and cumulative queued length within its
+    user's jobs, the `user_rank` and `user_share` of the scheduling SQL"""
+    ranks: Dict[str, Tuple[int, int]] = {}
+    counts: Dict[str, Tuple[int, int]] = {}
+    for job in sorted(pending, key=lambda job: (job.arrival, job.uuid)):
+        rank, share = counts.get(job.user, (0, 0))
+        counts[job.user] = ranks[job.uuid] = (rank + 1, share + job.midi_length)
+    return ranks
+
+def get_policy_key(policy: str) -> Callable[[List[Job]], Callable[[Job], tuple]]:
+    """Return a function giving the sort key of pending jobs under `policy`
+
+    fifo, round_robin and fair_share mirror `SchedulingPolicy.get_order_by`,
+    sjf runs the shortest job first regardless of user."""
+    def fifo(_pending: List[Job]) -> Callable[[Job], tuple]:
+        return lambda job: (-job.priority, job.arrival, job.uuid)
+    def sjf(_pending: List[Job]) -> Callable[[Job], tuple]:
+        return lambda job: (-job.priority, job.midi_length, job.arrival, job.uuid)
+    def round_robin(pending: List[Job]) -> Callable[[Job], tuple]:
+        ranks = rank_user_jobs(pending)
+        return lambda job: (-job.priority, ranks[job.uuid][0], job.midi_length,
+            job.arrival, job.uuid)
+    def fair_share(pending: List[Job]) -> Callable[[Job], tuple]:
+        ranks = rank_user_jobs(pending)
+        return lambda job: (-job.priority, ranks[job.uuid][1], job.midi_length,
+            job.arrival, job.uuid)
+    policies = {
+        SchedulingPolicy.FIFO.value: fifo,
+        SchedulingPolicy.ROUND_ROBIN.value: round_robin,
+        SchedulingPolicy.FAIR_SHARE.value: fair_share,
+        'sjf': sjf,
+    }
+    if policy not in policies:
+        raise ValueError(f'Unknown policy "{policy}"')
+    return policies[policy]
+
+def simulate(jobs: List[Job], policy: str, units: int) -> Dict[str, Any]:
+    """Replay the `jobs` of one synth on `units` synths under `policy`"""
+    get_key = get_policy_key(policy)
+    # events are (time, order, job), a job arriving or None for a unit freed
+    events: List[Tuple[float, int, Optional[Job]]] = [
+        (job.arrival, i, job) for i, job in enumerate(jobs)]
+    heapq.heapify(events)
+    order = len(events)
+    pending: List[Job] = []
+    idle = units
+    waits = []
+    latencies = []
+    busy = recording = 0.
+    end = 0.
+    while events:
+        now, _, job = heapq.heappop(events)
+        if job is None:
+            idle += 1
+        else:
+            pending.append(job)
+        # handle every event at this instant before scheduling
+        if events and events[0][0] <= now:
+            continue
+        while idle and pending:
+            job = min(pending, key=get_key(pending))
+            pending.remove(job)
+            idle -= 1
+            waits.append(now - job.arrival)
+            latencies.append(now + job.get_notify_time() - job.arrival)
+            busy += job.get_service_time()
+            recording += job.stages.get(StatusEnum.RECORDING, 0.)
+            end = max(end, now + job.get_service_time())
+            heapq.heappush(events, (now + job.get_service_time(), order, None))
+            order += 1
+
+    span = end - min((job.arrival for job in jobs), default=0.)
+    capacity = span * units if span > 0 else 1.
+    return {
+        'policy': policy,
+        'units': units,
+        'jobs': len(jobs),
+        'wait_seconds': get_percentiles(waits),
+        'notify_seconds': get_percentiles(latencies),
+        'worker_utilization': busy / capacity,
+        'synth_utilization': recording / capacity,
+    }
+
+def load_jobs(database_url: str, since: Optional[str] = None,
+        synth_ids: Optional[List[str]] = None) -> Dict[str, List[Job]]:
+    """Return the jobs replayed from the queue history of each synth"""
+    Queue.connect(database_url)
+    cur = Queue._get_cursor() # pylint: disable=protected-access
+    cur.execute("""
+        SELECT
+            uuid,
+            userdata::TEXT,
+            synth::TEXT,
+            midi_length,
+            priority,
+            EXTRACT(EPOCH FROM created_at)
+        FROM queue
+        WHERE (%(since)s::TIMESTAMP IS NULL OR created_at >= %(since)s::TIMESTAMP)
+          AND (%(synths)s::TEXT[] IS NULL OR synth::TEXT = ANY(%(synths)s::TEXT[]))
+        ORDER BY created_at, uuid
+    """, {'since': since, 'synths': synth_ids})
+    jobs = {row[0]: Job(uuid=row[0], user=row[1], synth=row[2], midi_length=row[3],
+        priority=row[4], arrival=float(row[5])) for row in cur.fetchall()}
+    cur.execute("""
+        SELECT
+            uuid,
+            stage::TEXT,
+            SUM(EXTRACT(EPOCH FROM ended_at - started_at))
+        FROM stage_history
+        GROUP BY uuid, stage
+    """)
+    for uuid, stage, duration in cur.fetchall():
+        if uuid in jobs and StatusEnum(stage) in STAGES:
+            jobs[uuid].stages[StatusEnum(stage)] = float(duration)
+
+    by_synth: Dict[str, List[Job]] = {}
+    for job in jobs.values():
+        by_synth.setdefault(job.synth, []).append(job)
+    for synth_id, synth_jobs in by_synth.items():
+        # fill in stages without history, e.g. for items still queued
+        stage_models = Queue.get_stage_models(Synth.from_id(synth_id))
+        start = synth_jobs[0].arrival
+        for job in synth_jobs:
+            job.arrival -= start
+            for stage in STAGES:
+                if stage not in job.stages:
+                    job.stages[stage] = stage_models[stage].predict(job.midi_length)
+    Queue.disconnect()
+    return by_synth
+
+def main():
+    """Main program"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--database-url', default=os.environ.get('SIMULATION_DATABASE_URL'),
+        help='database holding the queue history, only read')
+    parser.add_argument('--since', help='only replay items created at or after this time')
+    parser.add_argument('--synths', nargs='+', help='only replay items of these synths')
+    parser.add_argument('--policies', nargs='+',
+        default=[policy.value for policy in SchedulingPolicy] + ['sjf'],
+        help='scheduling policies to compare')
+    parser.add_argument('--units', type=int, nargs='+', default=[1, 2, 3],
+        help='fleet sizes to compare, as units per synth')
+    parser.add_argument('--load', type=float, nargs='+', default=[1.],
+        help='factors to speed up arrivals by, to model growth')
+    parser.add_argument('--output', default='schedule_sim.json',
+        help='file to write the JSON results to')
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error('--database-url or SIMULATION_DATABASE_URL is required')
+
+    by_synth = load_jobs(args.database_url, args.since, args.synths)
+    report: Dict[str, Any] = {
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'parameters': {key: value for key, value in vars(args).items() if key != 'database_url'},
+        'results': [],
+    }
+    for synth_id, jobs in sorted(by_synth.items()):
+        for load in args.load:
+            scaled = [Job(uuid=job.uuid, user=job.user, synth=job.synth,
+                midi_length=job.midi_length, priority=job.priority,
+                arrival=job.arrival / load, stages=job.stages) for job in jobs]
+            for units in args.units:
+                for policy in args.policies:
+                    result = {'synth': synth_id, 'load': load, **simulate(scaled, policy, units)}
+                    report['results'].append(result)
+                    wait = result['wait_seconds']
+                    print(f'{synth_id} x{units} load {load:g} {policy}: '
+                        f'{len(jobs)} jobs, wait p50 {wait.get("p50", 0):.0f}s '
+                        f'p95 {wait.get("p95", 0):.0f}s, '
+                        f'synth utilization {result["synth_utilization"]:.0%}')
+
+    with open(args.output, 'w', encoding='utf8') as fp:
+        json.dump(report, fp, indent=2)
+    print(f'Wrote results to "{args.output}"')
+
+if __name__ == '__main__':
+    main()
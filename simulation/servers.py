@@ -0,0 +1,372 @@
+"""Local stand-ins for the IMAP, SMTP and Azure services the pipeline talks to
+
+They implement just enough of each protocol for `EmailClient` and
+`AzureClient`, in plain text on localhost, and can fail at a set rate.
+"""
+import base64
+import email
+import email.policy
+import json
+import random
+import re
+import select
+import socketserver
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Set
+
+def quote(value: str) -> str:
+    """Return `value` as an IMAP quoted string"""
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def get_bodystructure(part: email.message.Message) -> str:
+    """Return the IMAP BODYSTRUCTURE of a message part"""
+    if part.is_multipart():
+        children = ''.join(get_bodystructure(child) for child in part.get_payload()) # type: ignore
+        return f'({children} {quote(part.get_content_subtype())})'
+    params = part.get_params() or []
+    param_list = ' '.join(f'{quote(key)} {quote(value)}' for key, value in params[1:])
+    payload = str(part.get_payload(decode=False)).encode('utf8')
+    encoding = part.get('Content-Transfer-Encoding', '7bit')
+    fields = f'{quote(part.get_content_maintype())} {quote(part.get_content_subtype())} ' \
+        f'{"(" + param_list + ")" if param_list else "NIL"} NIL NIL ' \
+        f'{quote(encoding)} {len(payload)}'
+    if part.get_content_maintype() == 'text':
+        lines = payload.count(b'\n')
+        fields += f' {lines}'
+    disposition_list = 'NIL'
+    disposition = part.get_content_disposition()
+    if disposition:
+        filename = part.get_filename()
+        disposition_params = f'({quote("filename")} {quote(filename)})' if filename else 'NIL'
+        disposition_list = f'({quote(disposition)} {disposition_params})'
+    return f'({fields} NIL {disposition_list} NIL NIL)'
+
+def get_part(message: email.message.Message, part: str) -> email.message.Message:
+    """Return the part of `message` numbered like `1.2`"""
+    for index in part.split('.'):
+        if message.is_multipart():
+            message = message.get_payload()[int(index) - 1] # type: ignore
+    return message
+
+@dataclass
+class ImapMessage:
+    """A message in a simulated mailbox"""
+    uid: int
+    data: bytes
+    flags: Set[str] = field(default_factory=set)
+    appended_at: float = field(default_factory=time.time)
+
+class ImapServer(socketserver.ThreadingTCPServer):
+    """IMAP server keeping its mailboxes in memory"""
+    daemon_threads = True
+    allow_reuse_address = True
+    UIDVALIDITY = 1
+
+    def __init__(self, address=('localhost', 0)):
+        super().__init__(address, ImapHandler)
+        self.mailboxes: Dict[str, List[ImapMessage]] = {}
+        self.changed = threading.Condition()
+
+    def append(self, mailbox: str, data: bytes) -> int:
+        """Add a message to `mailbox` and return its uid"""
+        with self.changed:
+            messages = self.mailboxes.setdefault(mailbox, [])
+            uid = messages[-1].uid + 1 if messages else 1
+            messages.append(ImapMessage(uid, data))
+            self.changed.notify_all()
+        return uid
+
+    def get_messages(self, mailbox: str) -> List[ImapMessage]:
+        """Return a snapshot of the messages in `mailbox`"""
+        with self.changed:
+            return list(self.mailboxes.get(mailbox, []))
+
+class ImapHandler(socketserver.StreamRequestHandler):
+    """Handles one IMAP connection"""
+    server: ImapServer
+
+    def setup(self):
+        super().setup()
+        self.mailbox = ''
+        # the message count last reported to the client
+        self.exists = 0
+
+    def send(self, line: str, literal: Optional[bytes] = None, end: str = ''):
+        """Send a response line, optionally followed by a literal and more text"""
+        data = line.encode('utf8')
+        if literal is not None:
+            data += f' {{{len(literal)}}}\r\n'.encode('ascii') + literal + end.encode('utf8')
+        self.wfile.write(data + b'\r\n')
+
+    def handle(self):
+        self.send('* OK Simulated IMAP ready')
+        while line := self.rfile.readline():
+            parts = line.decode('utf8').rstrip('\r\n').split(' ', 2)
+            if len(parts) < 2:
+                self.send('* BAD Missing command')
+                continue
+            tag, command, args = parts[0], parts[1].upper(), parts[2] if len(parts) > 2 else ''
+            if command == 'UID':
+                command, _, args = args.partition(' ')
+                command = f'UID_{command.upper()}'
+            method = getattr(self, f'do_{command.lower()}', None)
+            if method is None:
+                self.send(f'{tag} BAD Unknown command')
+                continue
+            if method(tag, args) is False:
+                break
+
+    def _get_messages(self) -> List[ImapMessage]:
+        return self.server.get_messages(self.mailbox)
+
+    def do_capability(self, tag: str, _: str):
+        """List the supported extensions"""
+        self.send('* CAPABILITY IMAP4rev1 IDLE')
+        self.send(f'{tag} OK CAPABILITY completed')
+
+    def do_login(self, tag: str, _: str):
+        """Accept any credentials"""
+        self.send(f'{tag} OK LOGIN completed')
+
+    def do_noop(self, tag: str, _: str):
+        """Do nothing"""
+        self.send(f'{tag} OK NOOP completed')
+
+    def do_logout(self, tag: str, _: str) -> bool:
+        """End the session"""
+        self.send('* BYE Logging out')
+        self.send(f'{tag} OK LOGOUT completed')
+        return False
+
+    def do_select(self, tag: str, args: str):
+        """Select a mailbox, reporting its UIDVALIDITY and UIDNEXT"""
+        self.mailbox = args.strip('"')
+        messages = self._get_messages()
+        self.exists = len(messages)
+        self.send(f'* {self.exists} EXISTS')
+        self.send(f'* OK [UIDVALIDITY {self.server.UIDVALIDITY}] UIDs valid')
+        self.send(f'* OK [UIDNEXT {messages[-1].uid + 1 if messages else 1}] Predicted next UID')
+        self.send(f'{tag} OK [READ-WRITE] SELECT completed')
+
+    def do_uid_search(self, tag: str, args: str):
+        """Search by UNSEEN or `UID n:*`"""
+        messages = self._get_messages()
+        if args.upper() == 'UNSEEN':
+            uids = [message.uid for message in messages if '\\Seen' not in message.flags]
+        elif match := re.match(r'UID (\d+):\*', args, re.IGNORECASE):
+            uids = [message.uid for message in messages if message.uid >= int(match.group(1))]
+            # like real servers, `n:*` always matches the last message
+            if not uids and messages:
+                uids = [messages[-1].uid]
+        else:
+            uids = [message.uid for message in messages]
+        self.send(' '.join(['* SEARCH'] + [str(uid) for uid in uids]))
+        self.send(f'{tag} OK SEARCH completed')
+
+    def do_uid_fetch(self, tag: str, args: str):
+        """Fetch the summary of messages or one part of a message"""
+        message_set, items = args.split(' ', 1)
+        uids = {int(uid) for uid in message_set.split(',')}
+        part = re.search(r'BODY\.PEEK\[([\d.]+)\]', items)
+        for seq, message in enumerate(self._get_messages(), 1):
+            if message.uid not in uids:
+                continue
+            parsed = email.message_from_bytes(message.data, policy=email.policy.compat32)
+            if part:
+                payload = str(get_part(parsed, part.group(1)).get_payload(decode=False))
+                self.send(f'* {seq} FETCH (UID {message.uid} BODY[{part.group(1)}]',
+                    payload.encode('utf8'), ')')
+            else:
+                headers = f'From: {parsed["From"]}\r\nTo: {parsed["To"]}\r\n\r\n'
+                self.send(f'* {seq} FETCH (UID {message.uid} RFC822.SIZE {len(message.data)} '
+                    f'BODYSTRUCTURE {get_bodystructure(parsed)} '
+                    f'BODY[HEADER.FIELDS (FROM TO)]', headers.encode('utf8'), ')')
+        self.send(f'{tag} OK FETCH completed')
+
+    def do_uid_store(self, tag: str, args: str):
+        """Add flags to a message"""
+        uid, _, flags = args.split(' ', 2)
+        for seq, message in enumerate(self._get_messages(), 1):
+            if message.uid == int(uid):
+                message.flags.update(flags.strip('()').split())
+                self.send(f'* {seq} FETCH (UID {uid} FLAGS ({" ".join(message.flags)}))')
+        self.send(f'{tag} OK STORE completed')
+
+    def do_idle(self, tag: str, _: str):
+        """Report new messages until the client is done"""
+        self.send('+ idling')
+        self.wfile.flush()
+        while True:
+            if (count := len(self._get_messages())) != self.exists:
+                self.exists = count
+                self.send(f'* {count} EXISTS')
+            if select.select([self.connection], [], [], .1)[0]:
+                break
+        self.rfile.readline()
+        self.send(f'{tag} OK IDLE terminated')
+
+    def do_append(self, tag: str, args: str):
+        """Add a message sent as a literal"""
+        match = re.match(r'"?([^" ]+)"?.*\{(\d+)\}$', args)
+        if match is None:
+            self.send(f'{tag} BAD Expected a literal')
+            return
+        self.send('+ Ready for literal data')
+        self.wfile.flush()
+        data = self.rfile.read(int(match.group(2)))
+        self.rfile.readline()
+        uid = self.server.append(match.group(1), data)
+        self.send(f'{tag} OK [APPENDUID {self.server.UIDVALIDITY} {uid}] APPEND completed')
+
+@dataclass
+class SmtpMessage:
+    """A message received by the SMTP sink"""
+    mail_from: str
+    rcpt_to: List[str]
+    data: bytes
+    received_at: float = field(default_factory=time.time)
+
+class SmtpServer(socketserver.ThreadingTCPServer):
+    """SMTP server keeping what it receives, rejecting a share of it"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('localhost', 0), fail_rate: float = 0.):
+        super().__init__(address, SmtpHandler)
+        self.fail_rate = fail_rate
+        self.messages: List[SmtpMessage] = []
+        self.lock = threading.Lock()
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    """Handles one SMTP connection"""
+    server: SmtpServer
+
+    def send(self, line: str):
+        """Send a reply line"""
+        self.wfile.write(f'{line}\r\n'.encode('utf8'))
+
+    def handle(self):
+        mail_from = ''
+        rcpt_to: List[str] = []
+        self.send('220 localhost Simulated ESMTP')
+        while line := self.rfile.readline():
+            command, _, args = line.decode('utf8').rstrip('\r\n').partition(' ')
+            command = command.upper()
+            if command == 'EHLO':
+                self.send('250-localhost')
+                self.send('250-AUTH PLAIN LOGIN')
+                self.send('250 8BITMIME')
+            elif command == 'HELO':
+                self.send('250 localhost')
+            elif command == 'AUTH':
+                mechanism, _, initial = args.partition(' ')
+                if mechanism.upper() == 'LOGIN':
+                    for prompt in ('Username:', 'Password:'):
+                        self.send(f'334 {base64.b64encode(prompt.encode()).decode()}')
+                        self.rfile.readline()
+                elif not initial:
+                    self.send('334 ')
+                    self.rfile.readline()
+                self.send('235 Authentication successful')
+            elif command == 'MAIL':
+                mail_from, rcpt_to = args.partition(':')[2].strip('<> '), []
+                self.send('250 OK')
+            elif command == 'RCPT':
+                rcpt_to.append(args.partition(':')[2].strip('<> '))
+                self.send('250 OK')
+            elif command == 'DATA':
+                self.send('354 End data with <CR><LF>.<CR><LF>')
+                self._receive(mail_from, rcpt_to)
+            elif command in ('RSET', 'NOOP'):
+                self.send('250 OK')
+            elif command == 'QUIT':
+                self.send('221 Bye')
+                break
+            else:
+                self.send('502 Command not implemented')
+
+    def _receive(self, mail_from: str, rcpt_to: List[str]):
+        """Read a message up to the terminating dot and keep or reject it"""
+        lines = []
+        while (line := self.rfile.readline()) not in (b'.\r\n', b''):
+            lines.append(line[1:] if line.startswith(b'..') else line)
+        if random.random() < self.server.fail_rate:
+            self.send('451 4.3.0 Simulated failure')
+            return
+        with self.server.lock:
+            self.server.messages.append(SmtpMessage(mail_from, rcpt_to, b''.join(lines)))
+        self.send('250 OK')
+
+class AzureServer(ThreadingHTTPServer):
+    """Token and blob endpoints recording the size of each uploaded blob"""
+    daemon_threads = True
+
+    def __init__(self, address=('localhost', 0), fail_rate: float = 0.):
+        super().__init__(address, AzureHandler)
+        self.fail_rate = fail_rate
+        self.blobs: Dict[str, int] = {}
+
+    def get_url(self) -> str:
+        """Return the base URL of the server"""
+        return f'http://localhost:{self.server_address[1]}'
+
+class AzureHandler(BaseHTTPRequestHandler):
+    """Handles requests to the token and blob endpoints"""
+    server: AzureServer
+
+    def _respond(self, status: int, body: Optional[dict] = None):
+        data = json.dumps(body).encode('utf8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self) -> int:
+        """Read and discard the request body, returning its size"""
+        remaining = size = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            remaining -= len(self.rfile.read(min(remaining, 1024*1024)))
+        return size
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """Issue a token or a user delegation key"""
+        self._read_body()
+        if self.path.endswith('comp=userdelegationkey'):
+            expiry = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + 2*24*60*60))
+            data = ('<?xml version="1.0" encoding="utf-8"?><UserDelegationKey>'
+                '<SignedOid>simulated</SignedOid><SignedTid>simulated</SignedTid>'
+                f'<SignedStart>{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}</SignedStart>'
+                f'<SignedExpiry>{expiry}</SignedExpiry><SignedService>b</SignedService>'
+                '<SignedVersion>2020-12-06</SignedVersion>'
+                '<Value>c2ltdWxhdGVkIGRlbGVnYXRpb24ga2V5</Value></UserDelegationKey>')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/xml')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data.encode('utf8'))
+            return
+        if not self.path.endswith('/oauth2/token'):
+            self._respond(404)
+            return
+        self._respond(200, {'access_token': 'simulated', 'expires_in': '3599'})
+
+    def do_PUT(self): # pylint: disable=invalid-name
+        """Store a blob"""
+        size = self._read_body()
+        if random.random() < self.server.fail_rate:
+            self._respond(500, {'error': 'Simulated failure'})
+            return
+        self.server.blobs[self.path] = size
+        self._respond(201)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+def serve(server: socketserver.BaseServer) -> socketserver.BaseServer:
+    """Run `server` in a daemon thread"""
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
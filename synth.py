@@ -1,5 +1,37 @@
 """Classes to represent a synthesizer"""
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from os import environ
+from typing import Tuple
+
+@dataclass(frozen=True)
+class CaptureProfile:
+    """How a synth's audio is captured by arecord and mixed down to stereo"""
+    SAMPLE_WIDTHS = {'S16_LE': 2, 'S24_3LE': 3, 'S24_LE': 4, 'S32_LE': 4}
+
+    channels: int
+    channel_map: Tuple[int, int]
+    sample_format: str
+    rate: int
+    buffer_size: int
+    period_size: int
+
+    def get_sample_width(self) -> int:
+        """Return the bytes per sample of the sample format"""
+        return self.SAMPLE_WIDTHS[self.sample_format]
+
+    def get_bytes_per_second(self) -> int:
+        """Return the bytes of raw audio captured per second"""
+        return self.channels * self.get_sample_width() * self.rate
+
+DEFAULT_CAPTURE_PROFILE = CaptureProfile(
+    channels=4,
+    channel_map=(1, 2),
+    sample_format='S32_LE',
+    rate=48000,
+    buffer_size=96000,
+    period_size=24000,
+)
 
 class Synth(ABC):
     """Base class for a synthesizer"""
@@ -23,11 +55,20 @@ class Synth(ABC):
     def get_audio_port(self) -> str:
         """Get the audio port the synth is attached to"""
 
+    def get_capture_profile(self) -> CaptureProfile:
+        """Get the settings the synth's audio is captured with"""
+        return DEFAULT_CAPTURE_PROFILE
+
     @staticmethod
     def from_id(synth_id: str) -> 'Synth':
-        """Create a Synth class from a given `synth_id`"""
+        """Create a Synth class from a given `synth_id`
+
+        The null synth is only available with SIMULATION=1, as no production
+        worker records it."""
         if synth_id == 'sc55mk2':
             return SynthRolandSC55mk2()
+        if synth_id == 'nullsynth' and environ.get('SIMULATION') == '1':
+            return SynthNull()
         raise TypeError(f'Synth "{synth_id}" unavailable')
 
     def __eq__(self, other) -> bool:
@@ -62,7 +103,18 @@ class SynthRolandSC55mk2(Synth):
         return "U-44:U-44 ZOOM U-44 MIDI I/O Port"
 
     def get_audio_port(self) -> str:
-        return "hw:CARD=U44"
+        return "plughw:CARD=U44"
+
+    def get_capture_profile(self) -> CaptureProfile:
+        # the SC55mk2 is on the first stereo input and only outputs 24-bit
+        return CaptureProfile(
+            channels=2,
+            channel_map=(1, 2),
+            sample_format='S24_3LE',
+            rate=48000,
+            buffer_size=96000,
+            period_size=24000,
+        )
 
     def get_reset_sysex(self) -> bytes:
         return b'\xF0\x41\x10\x42\x12\x40\x00\x7F\x00\x41\xF7'
@@ -0,0 +1,65 @@
+import os
+import struct
+import tempfile
+import wave
+
+from artifacts import Artifact, get_samples
+from tests.testcase import TestCase
+
+class ArtifactsTestCase(TestCase):
+    def test_wav(self):
+        with tempfile.NamedTemporaryFile(suffix='.wav') as fp:
+            wav = wave.open(fp.name, 'wb')
+            wav.setnchannels(2)
+            wav.setsampwidth(3)
+            wav.setframerate(48000)
+            wav.writeframes(b'\0' * 2 * 3 * 4800)
+            wav.close()
+
+            artifact = Artifact.from_file(fp.name)
+            self.assertEqual(artifact.samples, 4800)
+            self.assertEqual(artifact.size, 44 + 2 * 3 * 4800)
+            self.assertTrue(artifact.is_valid())
+            self.assertEqual(Artifact.deserialize(artifact.serialize()), artifact)
+
+            # damaged files are detected
+            with open(fp.name, 'r+b') as damaged:
+                damaged.seek(-1, os.SEEK_END)
+                damaged.write(b'\1')
+            self.assertFalse(artifact.is_valid())
+        self.assertFalse(artifact.is_valid())
+
+    def test_wav_extensible(self):
+        # WAVE_FORMAT_EXTENSIBLE as written by arecord for 4 channel S32_LE
+        fmt = struct.pack('<HHIIHHHHIH14s', 0xFFFE, 4, 48000, 48000*16, 16, 32,
+            22, 32, 0, 1, b'\0\0\0\0\x10\0\x80\0\0\xaa\0\x38\x9b\x71')
+        data = b'\0' * 16 * 100
+        with tempfile.NamedTemporaryFile(suffix='.wav') as fp:
+            fp.write(b'RIFF' + struct.pack('<I', 4 + 8 + len(fmt) + 8 + len(data)) + b'WAVE')
+            fp.write(b'fmt ' + struct.pack('<I', len(fmt)) + fmt)
+            fp.write(b'data' + struct.pack('<I', len(data)) + data)
+            fp.flush()
+            self.assertEqual(get_samples(fp.name), 100)
+
+            # a torn recording is shorter than its header claims
+            fp.truncate(fp.tell() - 16)
+            with self.assertRaises(ValueError):
+                get_samples(fp.name)
+
+    def test_flac(self):
+        streaminfo = struct.pack('>HH3s3sQ16x', 4096, 4096, b'\0\0\0', b'\0\0\0',
+            48000 << 44 | 1 << 41 | 23 << 36 | 123456)
+        with tempfile.NamedTemporaryFile(suffix='.flac') as fp:
+            fp.write(b'fLaC\x80' + len(streaminfo).to_bytes(3, 'big') + streaminfo)
+            fp.flush()
+            self.assertEqual(get_samples(fp.name), 123456)
+
+    def test_lossy(self):
+        with tempfile.NamedTemporaryFile(suffix='.mp3') as fp:
+            fp.write(b'ID3\4\0\0\0\0\0\0')
+            fp.flush()
+            artifact = Artifact.from_file(fp.name)
+            self.assertEqual(artifact.samples, 0)
+            self.assertTrue(artifact.is_valid())
+            with self.assertRaises(ValueError):
+                get_samples(fp.name)
@@ -0,0 +1,141 @@
+import base64
+import calendar
+import hashlib
+import hmac
+import io
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from azure_client import AzureClient
+from tests.testcase import TestCase
+
+DELEGATION_KEY = b'my delegation key'
+
+class AzureStandIn(BaseHTTPRequestHandler):
+    """Issues tokens and delegation keys and stores blobs, recording requests"""
+    def do_POST(self): # pylint: disable=invalid-name
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server.requests.append(('POST', self.path, dict(self.headers), body))
+        if self.path.endswith('/oauth2/token'):
+            self._respond(200, json.dumps({'access_token': f'token{len(server.requests)}',
+                'expires_in': str(server.token_lifetime)}).encode('utf8'))
+            return
+        expiry = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+            time.gmtime(time.time() + server.key_lifetime))
+        self._respond(200, '<?xml version="1.0" encoding="utf-8"?><UserDelegationKey>'
+            '<SignedOid>my-oid</SignedOid><SignedTid>my-tid</SignedTid>'
+            '<SignedStart>2026-10-22T00:00:00Z</SignedStart>'
+            f'<SignedExpiry>{expiry}</SignedExpiry><SignedService>b</SignedService>'
+            '<SignedVersion>2020-12-06</SignedVersion>'
+            f'<Value>{base64.b64encode(DELEGATION_KEY).decode()}</Value>'
+            '</UserDelegationKey>'.encode('utf8'))
+
+    def do_PUT(self): # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(('PUT', self.path, dict(self.headers), body))
+        self._respond(201, b'')
+
+    def _respond(self, status, data):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+class AzureClientTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('localhost', 0), AzureStandIn)
+        self.server.requests = []
+        self.server.token_lifetime = 3599
+        self.server.key_lifetime = 7*24*60*60
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.environ = dict(os.environ)
+        url = f'http://localhost:{self.server.server_address[1]}'
+        os.environ['AZURE_LOGIN_URL'] = url
+        os.environ['AZURE_BLOB_URL'] = f'{url}/{{blob_account}}'
+        AzureClient.access_tokens = {}
+        AzureClient.delegation_keys = {}
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        AzureClient.access_tokens = {}
+        AzureClient.delegation_keys = {}
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def get_client(self):
+        return AzureClient(tenant_id='my-tenant', client_id='my-client',
+            client_secret='my-secret', resource='https://storage.azure.com/')
+
+    def test_access_token(self):
+        client = self.get_client()
+        self.assertEqual(client.access_token, 'token1')
+        self.assertEqual(self.get_client().access_token, 'token1')
+        self.assertEqual(len(self.server.requests), 1)
+        method, path, _, body = self.server.requests[0]
+        self.assertEqual((method, path), ('POST', '/my-tenant/oauth2/token'))
+        self.assertIn(b'client_secret=my-secret', body)
+
+        # renewed when about to expire
+        AzureClient.access_tokens = {}
+        self.server.token_lifetime = AzureClient.TOKEN_MARGIN - 1
+        self.get_client()
+        self.assertEqual(self.get_client().access_token, 'token3')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_req_blob_upload(self):
+        url = self.get_client().req_blob_upload('myaccount', 'mycontainer', 'my.flac',
+            io.BytesIO(b'data'))
+        self.assertEqual(url, f'{os.environ["AZURE_LOGIN_URL"]}/myaccount/mycontainer/my.flac')
+        method, path, headers, body = self.server.requests[-1]
+        self.assertEqual((method, path, body), ('PUT', '/myaccount/mycontainer/my.flac', b'data'))
+        self.assertEqual(headers['Authorization'], 'Bearer token1')
+        self.assertEqual(headers['x-ms-blob-type'], 'BlockBlob')
+
+    def test_get_blob_sas_url(self):
+        client = self.get_client()
+        started = time.time()
+        url = client.get_blob_sas_url('myaccount', 'mycontainer', 'my.flac')
+        # the delegation key is only requested once
+        client.get_blob_sas_url('myaccount', 'mycontainer', 'other.flac')
+        self.get_client().get_blob_sas_url('myaccount', 'mycontainer', 'my.mp3')
+        self.assertEqual(len(self.server.requests), 2)
+        method, path, headers, body = self.server.requests[1]
+        self.assertEqual((method, path),
+            ('POST', '/myaccount/?restype=service&comp=userdelegationkey'))
+        self.assertEqual(headers['x-ms-version'], '2020-12-06')
+        self.assertIn(b'<KeyInfo><Start>', body)
+
+        parts = urlsplit(url)
+        self.assertEqual(parts.path, '/myaccount/mycontainer/my.flac')
+        params = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        self.assertEqual((params['sp'], params['sr'], params['sv']), ('r', 'b', '2020-12-06'))
+        self.assertEqual((params['skoid'], params['sktid'], params['sks']),
+            ('my-oid', 'my-tid', 'b'))
+        expiry = calendar.timegm(time.strptime(params['se'], '%Y-%m-%dT%H:%M:%SZ'))
+        self.assertAlmostEqual(expiry - started, AzureClient.SAS_LIFETIME, delta=5)
+
+        string_to_sign = (f'r\n{params["st"]}\n{params["se"]}\n'
+            '/blob/myaccount/mycontainer/my.flac\n'
+            f'my-oid\nmy-tid\n2026-10-22T00:00:00Z\n{params["ske"]}\nb\n2020-12-06\n'
+            '\n\n\n\n\n2020-12-06\nb\n\n\n\n\n\n\n')
+        signature = hmac.new(DELEGATION_KEY, string_to_sign.encode('utf8'), hashlib.sha256)
+        self.assertEqual(params['sig'], base64.b64encode(signature.digest()).decode())
+
+    def test_delegation_key_renewal(self):
+        # a key expiring before a link would is not reused
+        self.server.key_lifetime = AzureClient.SAS_LIFETIME
+        client = self.get_client()
+        client.get_blob_sas_url('myaccount', 'mycontainer', 'my.flac')
+        client.get_blob_sas_url('myaccount', 'mycontainer', 'my.flac')
+        self.assertEqual(len(self.server.requests), 3)
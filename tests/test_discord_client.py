@@ -0,0 +1,79 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from discord_client import DiscordClient, DiscordError, DiscordNotifier
+from tests.testcase import TestCase
+
+class DiscordStandIn(BaseHTTPRequestHandler):
+    """Records posted messages, rate limiting the first one"""
+    def do_POST(self): # pylint: disable=invalid-name
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path == '/channels/404/messages':
+            self._respond(404, {'message': 'Unknown Channel', 'code': 10003})
+            return
+        if not server.limited:
+            server.limited = True
+            self._respond(429, {'message': 'rate limited', 'retry_after': 0.05, 'global': False})
+            return
+        server.messages.append((self.path, self.headers['Authorization'], payload))
+        self._respond(200, {'id': str(len(server.messages))})
+
+    def _respond(self, status, body):
+        data = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+class DiscordClientTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('localhost', 0), DiscordStandIn)
+        self.server.limited = False
+        self.server.messages = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = DiscordClient(
+            bot_token='my-token',
+            api_url=f'http://localhost:{self.server.server_address[1]}'
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def test_req_create_message(self):
+        self.client.req_create_message(2, 'my content', [1])
+        self.assertEqual(self.server.messages, [(
+            '/channels/2/messages',
+            'Bot my-token',
+            {'content': 'my content', 'allowed_mentions': {'users': ['1']}},
+        )])
+
+    def test_notifier(self):
+        notifier = DiscordNotifier(self.client)
+        errors = notifier.post([
+            (2, 1, 'first'),
+            (3, 4, 'second'),
+            (404, 6, 'lost'),
+            (2, 5, 'third'),
+        ])
+        self.assertEqual(errors[:2] + errors[3:], [None, None, None])
+        assert isinstance(errors[2], DiscordError)
+        self.assertTrue(errors[2].is_permanent())
+        self.assertEqual(sorted(self.server.messages), [
+            ('/channels/2/messages', 'Bot my-token', {
+                'content': '<@1> first\n\n<@5> third',
+                'allowed_mentions': {'users': ['1', '5']},
+            }),
+            ('/channels/3/messages', 'Bot my-token', {
+                'content': '<@4> second',
+                'allowed_mentions': {'users': ['4']},
+            }),
+        ])
@@ -2,110 +2,84 @@ import unittest
 from unittest.mock import patch, Mock
 
 import base64
-import socket
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
+import quopri
+from dataclasses import asdict
+from itertools import islice
+from smtplib import SMTPServerDisconnected
 
-from email_client import EmailClient, RequestEmail, RequestEmailValidationResult
+from email_client import EmailClient, RequestEmail, RequestEmailValidationResult, MailboxState
 from tests.testcase import TestCase
 
 class EmailClientTestCase(TestCase):
-    HEADER_QUERY = '(RFC822.SIZE BODY[HEADER.FIELDS (FROM TO)])'
-    BODY_QUERY = 'RFC822'
-
-    def _msg_to_header_response(self, msg, index):
-        length = len(msg.as_bytes())
-        return 'OK', [(
-            f'{index} (RFC822.SIZE {length} FLAGS (\\Seen) BODY[HEADER.FIELDS (FROM TO)] {77}'.encode('utf8'),
-            f'From: {msg["From"]}\r\nTo: {msg["To"]}\r\n\r\n'.encode('utf8'),
-            b')',
-        )]
+    SUMMARY_QUERY = '(RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM TO)])'
 
-    def _msg_to_body_response(self, msg, index):
-        as_bytes = msg.as_bytes()
-        return 'OK', [(
-            f'{index} (RFC822 {{{len(as_bytes)}}}'.encode('utf8'),
-            as_bytes,
+    def _summary_response(self, uid, size, bodystructure):
+        headers = b'From: Someone <foo@gmail.com>\r\nTo: bar+sc55mk2@gmail.com\r\n\r\n'
+        return [
+            (
+                f'{uid} (UID {uid} RFC822.SIZE {size} BODYSTRUCTURE {bodystructure} '
+                f'BODY[HEADER.FIELDS (FROM TO)] {{{len(headers)}}}'.encode('utf8'),
+                headers,
+            ),
             b')',
-        )]
+        ]
 
     @patch('email_client.IMAP4_SSL')
     def test_req_email_midi_attachments(self, mock_imap):
         # setup email messages
-        msg_nomidi = MIMEMultipart()
-        msg_nomidi['From'] = 'Someone <foo@gmail.com>'
-        msg_nomidi['To'] = 'bar+sc55mk2@gmail.com'
-        msg_nomidi['Subject'] = 'no midi'
-        attachment = MIMEText('here it is')
-        msg_nomidi.attach(attachment)
-        attachment = MIMEBase('image', 'jpeg')
-        attachment.add_header('Content-Disposition', 'attachment', filename='me.jpg')
-        attachment.set_payload(b'data')
-        msg_nomidi.attach(attachment)
-
-        msg_toobig = MIMEMultipart()
-        msg_toobig['From'] = 'Someone <foo@gmail.com>'
-        msg_toobig['To'] = 'bar+sc55mk2@gmail.com'
-        msg_toobig['Subject'] = 'too big'
-        attachment = MIMEText('here it is')
-        msg_toobig.attach(attachment)
-        attachment = MIMEBase('audio', 'midi')
-        attachment.add_header('Content-Disposition', 'attachment', filename='mymidi.mid')
-        attachment.set_payload(b'x'*1025*1024)
-        msg_toobig.attach(attachment)
-
-        msg_ok = MIMEMultipart()
-        msg_ok['From'] = 'Someone <foo@gmail.com>'
-        msg_ok['To'] = 'bar+sc55mk2@gmail.com'
-        msg_ok['Subject'] = 'ok'
-        attachment = MIMEText('here it is')
-        msg_ok.attach(attachment)
-        attachment = MIMEBase('audio', 'midi')
-        attachment.add_header('Content-Disposition', 'attachment', filename='mymidi.mid')
-        attachment['Content-Transfer-Encoding'] = 'base64'
-        attachment.set_payload(base64.b64encode(b'data'))
-        msg_ok.attach(attachment)
-
-        msg_acceptable = MIMEMultipart()
-        msg_acceptable['From'] = 'Someone <foo@gmail.com>'
-        msg_acceptable['To'] = 'bar+sc55mk2@gmail.com'
-        msg_acceptable['Subject'] = 'ok'
-        attachment = MIMEText('here it is')
-        msg_acceptable.attach(attachment)
-        attachment = MIMEBase('application', 'octet-stream')
-        attachment.add_header('Content-Disposition', 'attachment', filename='mymidi.mid')
-        attachment['Content-Transfer-Encoding'] = 'base64'
-        attachment.set_payload(base64.b64encode(b'data'))
-        msg_acceptable.attach(attachment)
+        nomidi = '(("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)' \
+            '("IMAGE" "JPEG" NIL NIL NIL "BASE64" 8 NIL ("ATTACHMENT" ("FILENAME" "me.jpg")) ' \
+            'NIL NIL) "MIXED" ("BOUNDARY" "===============1==") NIL NIL NIL)'
+        toobig = '(("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)' \
+            '("AUDIO" "MIDI" NIL NIL NIL "7BIT" 1049600 NIL ' \
+            '("ATTACHMENT" ("FILENAME" "mymidi.mid")) NIL NIL) ' \
+            '"MIXED" ("BOUNDARY" "===============2==") NIL NIL NIL)'
+        ok = '(("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)' \
+            '("AUDIO" "MIDI" NIL NIL NIL "BASE64" 8 NIL ' \
+            '("ATTACHMENT" ("FILENAME" "mymidi.mid")) NIL NIL) ' \
+            '"MIXED" ("BOUNDARY" "===============3==") NIL NIL NIL)'
+        # nested multipart with a filename sent as a literal
+        acceptable = '((("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 10 1 NIL NIL NIL ' \
+            'NIL) "ALTERNATIVE" NIL NIL NIL NIL)' \
+            '("APPLICATION" "OCTET-STREAM" ("NAME" {10}'
+        acceptable_end = b') NIL NIL "BASE64" 8 NIL NIL NIL NIL) ' \
+            b'"MIXED" ("BOUNDARY" "===============4==") NIL NIL NIL)'
 
         # setup imap mock
         imap = Mock()
-        imap.search.return_value = ('OK', [b'1 2 3 4'])
-        def imap_fetch(message_set, message_parts):
-            if message_set == b'1' and message_parts == self.HEADER_QUERY:
-                return self._msg_to_header_response(msg_nomidi, 1)
-            if message_set == b'1' and message_parts == self.BODY_QUERY:
-                return self._msg_to_body_response(msg_nomidi, 1)
-            if message_set == b'2' and message_parts == self.HEADER_QUERY:
-                return self._msg_to_header_response(msg_toobig, 2)
-            if message_set == b'2' and message_parts == self.BODY_QUERY:
-                return self._msg_to_body_response(msg_toobig, 2)
-            if message_set == b'3' and message_parts == self.HEADER_QUERY:
-                return self._msg_to_header_response(msg_ok, 3)
-            if message_set == b'3' and message_parts == self.BODY_QUERY:
-                return self._msg_to_body_response(msg_ok, 3)
-            if message_set == b'4' and message_parts == self.HEADER_QUERY:
-                return self._msg_to_header_response(msg_acceptable, 4)
-            if message_set == b'4' and message_parts == self.BODY_QUERY:
-                return self._msg_to_body_response(msg_acceptable, 4)
-        imap.fetch.side_effect = imap_fetch
-        imap.readline.side_effect = [b'+ idling\r\n', socket.timeout()]
+        def imap_uid(command, *args):
+            if command == 'SEARCH':
+                return 'OK', [b'1 2 3 4']
+            if command == 'STORE':
+                return 'OK', [b'1 (FLAGS (\\Seen))']
+            message_set, message_parts = args
+            if message_set == '1,2,3,4' and message_parts == self.SUMMARY_QUERY:
+                data = self._summary_response(1, 2048, nomidi) + \
+                    self._summary_response(2, 1415000, toobig) + \
+                    self._summary_response(3, 2048, ok)
+                headers = data[0][1]
+                data.append((f'4 (UID 4 RFC822.SIZE 2048 BODYSTRUCTURE {acceptable}'.encode('utf8'),
+                    b'mymidi.mid'))
+                data.append((acceptable_end + f' BODY[HEADER.FIELDS (FROM TO)] '
+                    f'{{{len(headers)}}}'.encode('utf8'), headers))
+                data.append(b')')
+                return 'OK', data
+            if message_set in ('3', '4') and message_parts == '(BODY.PEEK[2])':
+                return 'OK', [(f'{message_set} (UID {message_set} BODY[2] {{10}}'.encode('utf8'),
+                    base64.encodebytes(b'data') + b'\r\n'), b')']
+            raise AssertionError(f'Unexpected command {command} {args}')
+        imap.uid.side_effect = imap_uid
+        imap.select.return_value = ('OK', [b'4'])
+        imap.response.side_effect = lambda code: (code, [b'5' if code == 'UIDNEXT' else b'1'])
         mock_imap.return_value = imap
 
         # setup email client
         email = EmailClient()
-        result = list(email.req_email_midi_attachments('bogus_mailbox'))
+        states = []
+        requests = email.req_email_midi_attachments('bogus_mailbox',
+            on_sync=lambda state: states.append(asdict(state)))
+        result = list(islice(requests, 4))
+        requests.close()
 
         # tests
         self.assertEqual(len(result), 4)
@@ -145,6 +119,142 @@ class EmailClientTestCase(TestCase):
                 midi_data=b'data'
             )
         )
+        stored = [call.args[1] for call in imap.uid.call_args_list if call.args[0] == 'STORE']
+        self.assertEqual(stored, ['1', '2', '3'])
+        # position is only persisted once all unseen emails are handled
+        self.assertEqual(states, [])
+
+    @patch('email_client.select')
+    @patch('email_client.IMAP4_SSL')
+    def test_req_email_midi_attachments_resume(self, mock_imap, mock_select):
+        ok = '("AUDIO" "MIDI" NIL NIL NIL "BASE64" 8 NIL ' \
+            '("ATTACHMENT" ("FILENAME" "mymidi.mid")) NIL NIL)'
+        searches = []
+        # the last message always matches, until a new one arrives
+        search_results = [b'4', b'4', b'5']
+        imap = Mock()
+        def imap_uid(command, *args):
+            if command == 'SEARCH':
+                searches.append(args[0])
+                return 'OK', [search_results[len(searches) - 1]]
+            if command == 'STORE':
+                return 'OK', []
+            message_set, message_parts = args
+            if message_parts == '(BODY.PEEK[1])':
+                return 'OK', [(f'{message_set} (UID {message_set} BODY[1] {{10}}'.encode('utf8'),
+                    base64.encodebytes(b'data') + b'\r\n'), b')']
+            return 'OK', self._summary_response(message_set, 2048, ok)
+        imap.uid.side_effect = imap_uid
+        imap.select.return_value = ('OK', [b'4'])
+        imap.response.side_effect = lambda code: (code, [b'5' if code == 'UIDNEXT' else b'1'])
+        imap._new_tag.side_effect = [b'A1', b'A2']
+        imap.readline.side_effect = [
+            b'+ idling\r\n',
+            b'* 1 EXPUNGE\r\n',
+            b'* 4 EXISTS\r\n',
+            b'A1 OK IDLE terminated\r\n',
+            b'+ idling\r\n',
+            b'* 5 EXISTS\r\n',
+            b'A2 OK IDLE terminated\r\n',
+        ]
+        mock_select.select.return_value = ([imap.sock], [], [])
+        mock_imap.return_value = imap
+
+        email = EmailClient()
+        states = []
+        requests = email.req_email_midi_attachments('bogus_mailbox',
+            state=MailboxState(uidvalidity=1, last_uid=3),
+            on_sync=lambda state: states.append(asdict(state)))
+        result = list(islice(requests, 2))
+        requests.close()
+
+        self.assertEqual([request.midi_data for request in result], [b'data', b'data'])
+        self.assertEqual(searches, ['UID 4:*', 'UID 5:*', 'UID 5:*'])
+        self.assertEqual(imap.send.call_args_list[-1].args, (b'DONE\r\n',))
+        self.assertEqual(states, [
+            {'uidvalidity': 1, 'last_uid': 4},
+            {'uidvalidity': 1, 'last_uid': 4},
+            {'uidvalidity': 1, 'last_uid': 4},
+        ])
+
+    def test_decode_base64(self):
+        data = bytes(range(256)) * 4
+        encoded = base64.encodebytes(data)
+        self.assertEqual(EmailClient._decode_base64(encoded), data)
+        # lines not aligned to base64 quanta
+        encoded = base64.b64encode(data)
+        encoded = b'\r\n'.join(encoded[i:i+75] for i in range(0, len(encoded), 75))
+        self.assertEqual(EmailClient._decode_base64(encoded), data)
+
+    @patch('email_client.select')
+    def test_idle_buffered_response(self, mock_select):
+        # EXISTS arrived in the same read as the continuation, so it is
+        # already buffered and the socket has nothing more to select on
+        imap = Mock()
+        imap._new_tag.return_value = b'A1'
+        imap.readline.side_effect = [
+            b'+ idling\r\n',
+            b'* 5 EXISTS\r\n',
+            b'A1 OK IDLE terminated\r\n',
+        ]
+        imap.file.peek.return_value = b'* 5 EXISTS\r\n'
+        mock_select.select.return_value = ([], [], [])
+        EmailClient()._idle(imap)
+        mock_select.select.assert_not_called()
+        self.assertEqual(imap.readline.call_count, 3)
+
+    @patch('email_client.IMAP4_SSL')
+    def test_req_email_midi_attachments_skips_unreadable(self, mock_imap):
+        ok = '("AUDIO" "MIDI" NIL NIL NIL "BASE64" 8 NIL ' \
+            '("ATTACHMENT" ("FILENAME" "mymidi.mid")) NIL NIL)'
+        imap = Mock()
+        def imap_uid(command, *args):
+            if command == 'SEARCH':
+                return 'OK', [b'4 5']
+            if command == 'STORE':
+                return 'OK', []
+            message_set, message_parts = args
+            if message_parts == '(BODY.PEEK[1])':
+                if message_set == '4':
+                    return 'NO', [b'Part unavailable']
+                return 'OK', [(f'{message_set} (UID {message_set} BODY[1] {{10}}'.encode('utf8'),
+                    base64.encodebytes(b'data') + b'\r\n'), b')']
+            return 'OK', self._summary_response(4, 2048, ok) + \
+                self._summary_response(5, 2048, ok)
+        imap.uid.side_effect = imap_uid
+        imap.select.return_value = ('OK', [b'5'])
+        imap.response.side_effect = lambda code: (code, [b'6' if code == 'UIDNEXT' else b'1'])
+        mock_imap.return_value = imap
+
+        states = []
+        requests = EmailClient().req_email_midi_attachments('bogus_mailbox',
+            state=MailboxState(uidvalidity=1, last_uid=3),
+            on_sync=lambda state: states.append(asdict(state)))
+        result = next(requests)
+        requests.close()
+
+        self.assertEqual(result.midi_data, b'data')
+        stored = [call.args for call in imap.uid.call_args_list if call.args[0] == 'STORE']
+        self.assertEqual(stored, [('STORE', '4', '+FLAGS', '(\\Seen \\Flagged)')])
+        self.assertEqual(states, [{'uidvalidity': 1, 'last_uid': 4}])
+        # the session is closed with the generator
+        imap.shutdown.assert_called_once()
+
+    def test_get_request_email_bad_encoding(self):
+        uuencoded = '("AUDIO" "MIDI" NIL NIL NIL "X-UUENCODE" 8 NIL ' \
+            '("ATTACHMENT" ("FILENAME" "mymidi.mid")) NIL NIL)'
+        message = EmailClient._parse_imap_fetch(self._summary_response(1, 2048, uuencoded))[0]
+        imap = Mock()
+        request = EmailClient()._get_request_email(imap, message)
+        self.assertEqual(request.validation_result, RequestEmailValidationResult.BAD_ENCODING)
+        imap.uid.assert_not_called()
+
+    def test_decode_payload(self):
+        data = bytes(range(256))
+        self.assertEqual(EmailClient._decode_payload(base64.encodebytes(data), 'base64'), data)
+        self.assertEqual(EmailClient._decode_payload(quopri.encodestring(data),
+            'quoted-printable'), data)
+        self.assertEqual(EmailClient._decode_payload(data, 'binary'), data)
 
     @patch('email_client.SMTP_SSL')
     def test_send(self, mock_smtp):
@@ -162,3 +272,24 @@ class EmailClientTestCase(TestCase):
         self.assertEqual(msg['To'], 'foo@gmail.com')
         self.assertEqual(msg['Subject'], 'my subject')
         self.assertEqual(msg.get_content().strip(), 'my content')
+
+    @patch('email_client.SMTP_SSL')
+    def test_send_reuses_session(self, mock_smtp):
+        smtp_1, smtp_2 = Mock(), Mock()
+        mock_smtp.side_effect = [smtp_1, smtp_2]
+        email = EmailClient(email_account='bar@gmail.com', email_key='my-account-key')
+        email.send(to_email='foo@gmail.com', subject='one', content='one')
+        email.send(to_email='foo@gmail.com', subject='two', content='two')
+        self.assertEqual(mock_smtp.call_count, 1)
+        self.assertEqual(smtp_1.login.call_count, 1)
+        self.assertEqual(smtp_1.send_message.call_count, 2)
+
+        # a dropped session is replaced and the message resent
+        smtp_1.send_message.side_effect = SMTPServerDisconnected()
+        email.send(to_email='foo@gmail.com', subject='three', content='three')
+        self.assertEqual(mock_smtp.call_count, 2)
+        self.assertEqual(smtp_2.send_message.call_args.args[0]['Subject'], 'three')
+
+        email.close()
+        smtp_2.quit.assert_called_once()
+        self.assertIsNone(email.smtp)
@@ -0,0 +1,74 @@
+import io
+import subprocess
+import tempfile
+import time
+from unittest.mock import MagicMock
+
+from heartbeat import Heartbeat, ProgressReader, file_growth_probe, get_children_cpu_ticks
+from tests.testcase import TestCase
+
+class HeartbeatTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.notifier = MagicMock()
+        self.heartbeat = Heartbeat(self.notifier, stall_timeout=.2)
+
+    def test_idle(self):
+        self.assertTrue(self.heartbeat.beat())
+        self.notifier.notify.assert_called_with('WATCHDOG=1\nSTATUS=Waiting for queue items')
+
+        # a main loop that stopped reporting outside of a stage is wedged
+        time.sleep(.3)
+        self.assertFalse(self.heartbeat.beat())
+        self.notifier.notify.assert_called_with('STATUS=Not responding')
+        self.heartbeat.alive()
+        self.assertTrue(self.heartbeat.beat())
+
+        # as is one that left a stage and never came back
+        with self.heartbeat.stage('Notifying'):
+            pass
+        self.assertTrue(self.heartbeat.beat())
+        time.sleep(.3)
+        self.assertFalse(self.heartbeat.beat())
+
+    def test_stage_progress(self):
+        with tempfile.NamedTemporaryFile() as fp:
+            with self.heartbeat.stage('Recording', file_growth_probe(fp.name, 100)):
+                fp.write(b'\0' * 25)
+                fp.flush()
+                self.assertTrue(self.heartbeat.beat())
+                self.notifier.notify.assert_called_with('WATCHDOG=1\nSTATUS=Recording 25%')
+
+                # no growth for longer than the stall timeout withholds the pulse
+                time.sleep(.3)
+                self.assertFalse(self.heartbeat.beat())
+                self.notifier.notify.assert_called_with('STATUS=Recording 25% (stalled)')
+
+                fp.write(b'\0' * 25)
+                fp.flush()
+                self.assertTrue(self.heartbeat.beat())
+                self.notifier.notify.assert_called_with('WATCHDOG=1\nSTATUS=Recording 50%')
+        # leaving the stage shows the main loop is alive
+        self.assertTrue(self.heartbeat.beat())
+
+    def test_stage_without_probe(self):
+        with self.heartbeat.stage('Notifying'):
+            self.assertTrue(self.heartbeat.beat())
+            time.sleep(.3)
+            self.assertFalse(self.heartbeat.beat())
+
+    def test_progress_reader(self):
+        reader = ProgressReader(io.BytesIO(b'\0' * 100), 100)
+        self.assertEqual(len(reader), 100)
+        reader.read(40)
+        self.assertEqual(reader.probe(), (40, .4))
+        self.assertEqual(len(reader), 60)
+
+    def test_children_cpu_ticks(self):
+        with subprocess.Popen(['python', '-c', 'while True: pass']) as proc:
+            try:
+                start = get_children_cpu_ticks()
+                time.sleep(.5)
+                self.assertGreater(get_children_cpu_ticks(), start)
+            finally:
+                proc.kill()
@@ -0,0 +1,135 @@
+import http.client
+import io
+import json
+import threading
+import time
+from os import environ
+from unittest.mock import MagicMock
+from uuid import uuid4
+
+import mido
+
+from tests.db_testcase import DBTestCase
+
+from intake_api import IntakeHandler, IntakeServer
+from midi_validator import MidiValidator
+from queue_client import Queue, SchedulingPolicy, StatusEnum
+
+class IntakeApiTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        Queue.connect(environ['DATABASE_URL'])
+        self.notifier = MagicMock()
+        self.server = IntakeServer(('localhost', 0), environ['DATABASE_URL'],
+            SchedulingPolicy.FAIR_SHARE, self.notifier)
+        self.server.PULSE_INTERVAL = 0
+        threading.Thread(target=self.server.serve_forever, args=(.05,), daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        Queue.disconnect()
+        super().tearDown()
+
+    def _midi_data(self, note: int = 64) -> bytes:
+        midi = mido.MidiFile(type=0, ticks_per_beat=24)
+        track = mido.MidiTrack()
+        track.append(mido.Message('note_on', note=note, velocity=64, time=0))
+        track.append(mido.Message('note_off', note=note, velocity=64, time=24*2*60))
+        midi.tracks.append(track)
+        stream = io.BytesIO()
+        midi.save(file=stream)
+        return stream.getvalue()
+
+    def _request(self, method, path, body=None, headers=None):
+        con = http.client.HTTPConnection('localhost', self.server.server_address[1])
+        con.request(method, path, body=body, headers=headers or {})
+        response = con.getresponse()
+        result = response.status, json.loads(response.read())
+        con.close()
+        return result
+
+    def test_post_request(self):
+        status, body = self._request('POST',
+            '/requests?email=foo@bar.com&synth=sc55mk2&name=town.mid', self._midi_data())
+        self.assertEqual(status, 202)
+        self.assertFalse(body['coalesced'])
+        self.assertEqual(body['status_url'], f'/requests/{body["uuid"]}')
+        self.assertGreaterEqual(body['eta_minutes'], 1)
+        queue_item = Queue.get_front_queue_item(Queue.get_queue_item(body['uuid']).synth)
+        self.assertEqual(str(queue_item.uuid), body['uuid'])
+        self.assertEqual(queue_item.midi_file, 'town.mid')
+        self.assertEqual(queue_item.user.email, 'foo@bar.com')
+
+        # the same MIDI from someone else shares the recording
+        status, coalesced_body = self._request('POST',
+            '/requests?email=baz@bar.com&synth=sc55mk2', self._midi_data())
+        self.assertEqual(status, 202)
+        self.assertTrue(coalesced_body['coalesced'])
+        self.assertEqual(coalesced_body['uuid'], body['uuid'])
+
+    def test_post_request_rejected(self):
+        url = '/requests?email=foo@bar.com&synth=sc55mk2'
+        self.assertEqual(self._request('POST', '/requests?synth=sc55mk2', self._midi_data())[0],
+            400)
+        self.assertEqual(self._request('POST', '/requests?email=foo@bar.com&synth=nosynth',
+            self._midi_data()), (404, {'error': 'Synth "nosynth" unavailable'}))
+        self.assertEqual(self._request('POST', url, b'',
+            {'Content-Length': 'many'}), (400, {'error': 'Invalid Content-Length'}))
+        self.assertEqual(self._request('POST', url, b'not a midi file at all'),
+            (400, {'error': 'MIDI file could not be parsed'}))
+        # a channel prefix meta message without its data byte
+        self.assertEqual(self._request('POST', url,
+            self._midi_data()[:-3] + b'\xff\x20\x00'),
+            (400, {'error': 'MIDI file could not be parsed'}))
+        self.assertEqual(self._request('POST', url, b'a' * (MidiValidator.MAX_FILE_SIZE + 1)),
+            (413, {'error': 'MIDI file too big >256 KiB'}))
+        # a large body is refused from its header without being read
+        midi_data = self._midi_data()
+        midi_data = midi_data[:8] + b'\x00\x02' + midi_data[10:]
+        self.assertEqual(self._request('POST', url, midi_data + b'\x00' * 200*1024),
+            (400, {'error': 'MIDI file must be type 0 or type 1'}))
+
+        for note in range(Queue.RATE_LIMIT_REQUESTS):
+            self.assertEqual(self._request('POST', url, self._midi_data(note))[0], 202)
+        self.assertEqual(self._request('POST', url, self._midi_data(100)),
+            (429, {'error': 'Too many requests >10 per 60 min'}))
+
+    def test_get_request(self):
+        uuids = [self._request('POST', f'/requests?email=user{note}@bar.com&synth=sc55mk2',
+            self._midi_data(note))[1]['uuid'] for note in range(2)]
+        status, body = self._request('GET', f'/requests/{uuids[1]}')
+        self.assertEqual(status, 200)
+        self.assertEqual((body['uuid'], body['status'], body['position']),
+            (uuids[1], 'new', 2))
+        self.assertGreaterEqual(body['eta_minutes'], 1)
+
+        queue_item = Queue.get_queue_item(uuids[0])
+        Queue.update_queue_item_status(queue_item, StatusEnum.DONE)
+        self.assertEqual(self._request('GET', f'/requests/{uuids[1]}')[1]['position'], 1)
+        self.assertEqual(self._request('GET', f'/requests/{uuids[0]}')[1],
+            {'uuid': uuids[0], 'status': 'done', 'position': None, 'eta_minutes': None})
+        self.assertEqual(self._request('GET', f'/requests/{uuid4()}')[0], 404)
+        self.assertEqual(self._request('GET', '/requests')[0], 404)
+        self.assertEqual(self._request('GET', f'/requests/{"-" * 36}'),
+            (400, {'error': 'Invalid uuid'}))
+
+    def test_reconnect(self):
+        status, body = self._request('POST', '/requests?email=foo@bar.com&synth=sc55mk2',
+            self._midi_data())
+        self.assertEqual(status, 202)
+        # hold off reconnecting until the lost connection was noticed
+        self.server.PULSE_INTERVAL = 60
+        with IntakeHandler.queue_lock:
+            assert Queue.con is not None
+            Queue.con.close()
+        self.assertEqual(self._request('GET', f'/requests/{body["uuid"]}'),
+            (503, {'error': 'Queue unavailable, try again later'}))
+        self.notifier.reset_mock()
+        self.server.PULSE_INTERVAL = 0
+        for _ in range(100):
+            if not Queue.con.closed:
+                break
+            time.sleep(.05)
+        self.assertEqual(self._request('GET', f'/requests/{body["uuid"]}')[0], 200)
+        self.notifier.notify.assert_called_with('WATCHDOG=1')
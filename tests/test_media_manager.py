@@ -0,0 +1,66 @@
+import os
+import tempfile
+import time
+from unittest.mock import patch
+from uuid import uuid4
+
+from media_manager import MediaManager
+from synth import DEFAULT_CAPTURE_PROFILE
+
+from tests.testcase import TestCase
+
+class MediaManagerTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.hot_dir = tempfile.TemporaryDirectory()
+        self.disk_dir = tempfile.TemporaryDirectory()
+        self.media = MediaManager(disk_path=self.disk_dir.name, hot_path=self.hot_dir.name,
+            hot_max_length=60)
+
+    def tearDown(self):
+        self.hot_dir.cleanup()
+        self.disk_dir.cleanup()
+        super().tearDown()
+
+    def test_reserve(self):
+        size = MediaManager.get_required_space(30, DEFAULT_CAPTURE_PROFILE)
+        with patch.object(MediaManager, 'get_free_space', return_value=int(size * 1.5)):
+            # short recordings go to the hot tier until it is reserved
+            uuid_1 = uuid4()
+            self.assertEqual(self.media.reserve(uuid_1, 30, DEFAULT_CAPTURE_PROFILE),
+                self.hot_dir.name)
+            self.assertEqual(self.media.reserve(uuid_1, 30, DEFAULT_CAPTURE_PROFILE),
+                self.hot_dir.name)
+            uuid_2 = uuid4()
+            self.assertEqual(self.media.reserve(uuid_2, 30, DEFAULT_CAPTURE_PROFILE),
+                self.disk_dir.name)
+
+            # written media takes up its reservation
+            with open(os.path.join(self.hot_dir.name, f'{uuid_1}.wav'), 'wb') as fp:
+                fp.write(b'\0' * 1024)
+            self.assertEqual(self.media.locate(uuid_1), self.hot_dir.name)
+
+            # released space can be reserved again
+            self.media.release(uuid_1)
+            self.assertEqual(os.listdir(self.hot_dir.name), ['.lock'])
+            self.assertEqual(self.media.reserve(uuid4(), 30, DEFAULT_CAPTURE_PROFILE),
+                self.hot_dir.name)
+
+            # long recordings never go to the hot tier
+            with self.assertRaises(RuntimeError):
+                self.media.reserve(uuid4(), 120, DEFAULT_CAPTURE_PROFILE)
+
+    def test_sweep(self):
+        live_uuid, dead_uuid = uuid4(), uuid4()
+        for uuid in (live_uuid, dead_uuid):
+            for suffix in ('.wav', '.flac', '.reserve'):
+                with open(os.path.join(self.disk_dir.name, f'{uuid}{suffix}'), 'wb'):
+                    pass
+        # recent files are left alone in case their queue item was just added
+        self.assertEqual(self.media.sweep({live_uuid}), 0)
+        past = time.time() - MediaManager.SWEEP_GRACE - 1
+        for name in os.listdir(self.disk_dir.name):
+            os.utime(os.path.join(self.disk_dir.name, name), (past, past))
+        self.assertEqual(self.media.sweep({live_uuid}), 3)
+        self.assertEqual(sorted(os.listdir(self.disk_dir.name)),
+            sorted([f'{live_uuid}.wav', f'{live_uuid}.flac', f'{live_uuid}.reserve']))
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer
+
+import requests
+
+from metrics import Counter, Histogram, Metric, MetricsHandler, get_exposition, timed, \
+    write_textfile
+from tests.testcase import TestCase
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.registry = Metric.registry
+        Metric.registry = []
+        Metric.enabled = True
+
+    def tearDown(self):
+        Metric.registry = self.registry
+        Metric.enabled = False
+        super().tearDown()
+
+    def test_disabled(self):
+        Metric.enabled = False
+        counter = Counter('test_total', 'Test counter')
+        counter.inc()
+        self.assertEqual(counter.values, {})
+
+    def test_counter(self):
+        counter = Counter('test_total', 'Test counter', ['kind'])
+        counter.inc(kind='a')
+        counter.inc(2, kind='a')
+        counter.inc(kind='b"')
+        self.assertEqual(get_exposition(),
+            '# HELP test_total Test counter\n'
+            '# TYPE test_total counter\n'
+            'test_total{kind="a"} 3\n'
+            'test_total{kind="b\\""} 1\n')
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test histogram', buckets=(1, 2))
+        histogram.observe(.5)
+        histogram.observe(1.5)
+        histogram.observe(3)
+        self.assertEqual(get_exposition(),
+            '# HELP test_seconds Test histogram\n'
+            '# TYPE test_seconds histogram\n'
+            'test_seconds_bucket{le="1"} 1\n'
+            'test_seconds_bucket{le="2"} 2\n'
+            'test_seconds_bucket{le="+Inf"} 3\n'
+            'test_seconds_sum 5.0\n'
+            'test_seconds_count 3\n')
+
+    def test_timed(self):
+        histogram = Histogram('test_seconds', 'Test histogram', ['method'])
+
+        @timed(histogram)
+        def my_function():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            my_function()
+        self.assertEqual(list(histogram.values),
+            [('MetricsTestCase.test_timed.<locals>.my_function',)])
+
+    def test_exposition(self):
+        Counter('test_total', 'Test counter').inc()
+        with tempfile.TemporaryDirectory() as path:
+            write_textfile(os.path.join(path, 'test.prom'))
+            with open(os.path.join(path, 'test.prom'), encoding='utf8') as fp:
+                self.assertEqual(fp.read(), get_exposition())
+            self.assertEqual(os.listdir(path), ['test.prom'])
+
+        server = ThreadingHTTPServer(('localhost', 0), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            req = requests.get(f'http://localhost:{server.server_address[1]}/metrics',
+                timeout=10)
+            self.assertEqual(req.text, get_exposition())
+        finally:
+            server.shutdown()
+            server.server_close()
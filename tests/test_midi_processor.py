@@ -1,3 +1,4 @@
+import io
 import math
 import os
 import struct
@@ -6,8 +7,8 @@ import wave
  
 import mido
 
-from midi_processor import MidiProcessor
-from synth import SynthNull
+from midi_processor import MidiProcessor, CapturePriority
+from synth import SynthNull, SynthRolandSC55mk2, DEFAULT_CAPTURE_PROFILE
 
 from tests.testcase import TestCase
 
@@ -25,18 +26,102 @@ class MidiProcessorTestCase(TestCase):
             length = MidiProcessor.get_length(fp.name)
             self.assertEqual(length, 60)
 
+    def test_get_data_length(self):
+        stream = io.BytesIO()
+        midi = mido.MidiFile(ticks_per_beat=24)
+        track = mido.MidiTrack()
+        track.append(mido.Message('note_on', note=64, velocity=64, time=0))
+        track.append(mido.Message('note_off', note=64, velocity=64, time=24*2*60))
+        midi.tracks.append(track)
+        midi.save(file=stream)
+
+        self.assertEqual(MidiProcessor.get_data_length(stream.getvalue()), 60)
+
+    def test_compact(self):
+        midi = mido.MidiFile(type=1, ticks_per_beat=480)
+        tempo_track = mido.MidiTrack()
+        tempo_track.append(mido.MetaMessage('set_tempo', tempo=500000, time=0))
+        # slow down to a second per beat 4 seconds in
+        tempo_track.append(mido.MetaMessage('set_tempo', tempo=1000000, time=480*8))
+        track = mido.MidiTrack()
+        track.append(mido.Message('program_change', program=5, time=0))
+        track.append(mido.Message('sysex', data=[0x41, 0x10], time=480*4))
+        # first note 6 seconds in
+        track.append(mido.Message('note_on', note=60, velocity=64, time=480*6))
+        track.append(mido.Message('note_off', note=60, velocity=0, time=480))
+        track.append(mido.Message('control_change', control=7, value=100, time=480*10))
+        # 20 seconds rest
+        track.append(mido.Message('note_on', note=62, velocity=64, time=480*10))
+        track.append(mido.Message('note_off', note=62, velocity=0, time=480))
+        midi.tracks += [tempo_track, track]
+        stream = io.BytesIO()
+        midi.save(file=stream)
+        self.assertEqual(MidiProcessor.get_data_length(stream.getvalue()), 28)
+
+        compacted = MidiProcessor.compact(stream.getvalue(), lead_in=1, max_rest=3)
+        self.assertEqual(MidiProcessor.get_data_length(compacted), 1 + 1 + 3 + 1)
+        compacted_midi = mido.MidiFile(file=io.BytesIO(compacted))
+        self.assertEqual([(message.type, message.time) for message in compacted_midi.tracks[0]],
+            [('set_tempo', 0), ('set_tempo', 0), ('end_of_track', 0)])
+        self.assertEqual([(message.type, message.time) for message in compacted_midi.tracks[1]],
+            [('program_change', 0), ('sysex', 0), ('note_on', 480), ('note_off', 480),
+            ('control_change', 480*3), ('note_on', 0), ('note_off', 480), ('end_of_track', 0)])
+
+        # nothing to cut
+        self.assertEqual(MidiProcessor.compact(compacted, lead_in=1, max_rest=3), compacted)
+
+    def test_compact_sustain(self):
+        midi = mido.MidiFile(type=0, ticks_per_beat=480)
+        track = mido.MidiTrack()
+        track.append(mido.Message('note_on', note=60, velocity=64, time=0))
+        track.append(mido.Message('control_change', control=64, value=127, time=0))
+        track.append(mido.Message('note_off', note=60, velocity=0, time=480))
+        # pedal held for 10 seconds, then 10 seconds of rest
+        track.append(mido.Message('control_change', control=64, value=0, time=480*20))
+        track.append(mido.Message('note_on', note=62, velocity=64, time=480*20))
+        track.append(mido.Message('note_off', note=62, velocity=0, time=480))
+        midi.tracks.append(track)
+        stream = io.BytesIO()
+        midi.save(file=stream)
+
+        compacted = MidiProcessor.compact(stream.getvalue(), lead_in=1, max_rest=3)
+        self.assertAlmostEqual(mido.MidiFile(file=io.BytesIO(compacted)).length, .5 + 10 + 3 + .5)
+
+    def test_capture_profile(self):
+        self.assertEqual(SynthNull().get_capture_profile(), DEFAULT_CAPTURE_PROFILE)
+        self.assertEqual(DEFAULT_CAPTURE_PROFILE.get_bytes_per_second(), 4*4*48000)
+        profile = SynthRolandSC55mk2().get_capture_profile()
+        self.assertEqual(profile.get_bytes_per_second(), 2*3*48000)
+
+    def test_capture_priority(self):
+        self.assertEqual(CapturePriority().get_commands(), [])
+        priority = CapturePriority(cpus='2,3', rt_priority=80, io_priority=0)
+        self.assertEqual(priority.get_commands(), [
+            ['taskset', '--cpu-list', '2,3'],
+            ['chrt', '--fifo', '80'],
+            ['ionice', '--class', '1', '--classdata', '0'],
+        ])
+
+    def test_count_xruns(self):
+        log = 'Recording WAVE \'/tmp/x.wav\' : Signed 32 bit Little Endian, Rate 48000 Hz\n' \
+            'overrun!!! (at least 12.345 ms long)\n' \
+            'Status:\n  state       : XRUN\n' \
+            'overrun!!! (at least 0.512 ms long)\n'
+        self.assertEqual(MidiProcessor.count_xruns(log), 2)
+        self.assertEqual(MidiProcessor.count_xruns(''), 0)
+
     def test_record(self):
-         with tempfile.NamedTemporaryFile(suffix='.mid') as fp:
+         with tempfile.NamedTemporaryFile(suffix='.wav') as fp:
             midi = mido.MidiFile(ticks_per_beat=24)
             track = mido.MidiTrack()
             track.append(mido.Message('note_on', note=64, velocity=64, time=0))
             track.append(mido.Message('note_off', note=64, velocity=64, time=24*2*60))
             midi.tracks.append(track)
-            midi.save(file=fp)
-            fp.flush()
+            stream = io.BytesIO()
+            midi.save(file=stream)
 
-            wav_path = f'{fp.name}.wav'
-            MidiProcessor.record(SynthNull(), fp.name, wav_path)
+            wav_path = fp.name
+            MidiProcessor.record(SynthNull(), stream.getvalue(), wav_path)
             self.assertTrue(os.path.exists(wav_path))
             self.assertTrue(os.stat(wav_path).st_size > 0)
 
@@ -58,3 +143,9 @@ class MidiProcessorTestCase(TestCase):
 
             self.assertTrue(os.path.exists(flac_path))
             self.assertTrue(os.stat(flac_path).st_size > 0)
+
+            paths = [f'{fp.name}.{rendition}' for rendition in MidiProcessor.RENDITION_OPTIONS]
+            MidiProcessor.encode_renditions(fp.name, paths)
+            for path in paths:
+                self.assertTrue(os.stat(path).st_size > 0)
+                os.unlink(path)
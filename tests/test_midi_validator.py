@@ -5,7 +5,7 @@ import io
 
 from mido import MidiFile, MidiTrack, Message
 
-from midi_validator import MidiValidator, MidiValidatorResult
+from midi_validator import MidiValidator, MidiValidatorResult, MidiStreamValidator
 from tests.testcase import TestCase
 
 class MidiValidatorTestCase(TestCase):
@@ -17,6 +17,23 @@ class MidiValidatorTestCase(TestCase):
         midi_data = b'dummy data'
         self.assertEqual(MidiValidator.get_result(midi_data), MidiValidatorResult.FAIL_PARSE)
 
+        # a file cut off mid-track
+        midi = MidiFile(type=0)
+        track = MidiTrack()
+        track.append(Message('note_on', note=64, velocity=64, time=0))
+        track.append(Message('note_off', note=64, velocity=64, time=32))
+        midi.tracks.append(track)
+        midi_stream = io.BytesIO()
+        midi.save(file=midi_stream)
+        self.assertEqual(MidiValidator.get_result(midi_stream.getvalue()[:-5]),
+            MidiValidatorResult.FAIL_PARSE)
+
+        # a channel prefix meta message without its data byte
+        midi_data = midi_stream.getvalue()
+        self.assertTrue(midi_data.endswith(b'\xff\x2f\x00'))
+        self.assertEqual(MidiValidator.get_result(midi_data[:-3] + b'\xff\x20\x00'),
+            MidiValidatorResult.FAIL_PARSE)
+
     def test_get_error_fail_bad_type(self):
         midi = MidiFile(type=2)
         track = MidiTrack()
@@ -46,3 +63,46 @@ class MidiValidatorTestCase(TestCase):
         midi_stream = io.BytesIO()
         midi.save(file=midi_stream)
         self.assertEqual(MidiValidator.get_result(midi_stream.getvalue()), MidiValidatorResult.OK)
+
+    def test_stream_ok(self):
+        midi = MidiFile(type=1)
+        for _ in range(2):
+            track = MidiTrack()
+            track.append(Message('note_on', note=64, velocity=64, time=0))
+            track.append(Message('note_off', note=64, velocity=64, time=32))
+            midi.tracks.append(track)
+        midi_stream = io.BytesIO()
+        midi.save(file=midi_stream)
+        midi_data = midi_stream.getvalue()
+        validator = MidiStreamValidator()
+        for pos in range(0, len(midi_data), 5):
+            self.assertIsNone(validator.feed(midi_data[pos:pos + 5]))
+        self.assertEqual(validator.finish(), MidiValidatorResult.OK)
+        self.assertEqual(validator.get_data(), midi_data)
+        self.assertEqual(validator.length, 1)
+
+        # a file cut off mid-track
+        validator = MidiStreamValidator()
+        self.assertIsNone(validator.feed(midi_data[:-5]))
+        self.assertEqual(validator.finish(), MidiValidatorResult.FAIL_PARSE)
+        self.assertEqual(MidiValidator.get_result(midi_data[:-5]), MidiValidatorResult.FAIL_PARSE)
+
+    def test_stream_early_failure(self):
+        # the header alone gives away a bad file
+        validator = MidiStreamValidator()
+        self.assertEqual(validator.feed(b'RIFF\x00\x00\x00\x06\x00\x01\x00\x01\x00\x60'),
+            MidiValidatorResult.FAIL_PARSE)
+        validator = MidiStreamValidator()
+        self.assertIsNone(validator.feed(b'MThd\x00\x00\x00\x06\x00'))
+        self.assertEqual(validator.feed(b'\x02\x00\x01\x00\x60'), MidiValidatorResult.BAD_TYPE)
+        self.assertEqual(validator.finish(), MidiValidatorResult.BAD_TYPE)
+
+        # as does a track declared larger than allowed
+        validator = MidiStreamValidator()
+        self.assertEqual(validator.feed(b'MThd\x00\x00\x00\x06\x00\x00\x00\x01\x00\x60'
+            b'MTrk\x00\x10\x00\x00'), MidiValidatorResult.TOO_BIG)
+
+        validator = MidiStreamValidator()
+        validator.feed(b'MThd\x00\x00\x00\x06\x00\x00\x00\x01\x00\x60')
+        self.assertEqual(validator.feed(b'a' * MidiValidator.MAX_FILE_SIZE),
+            MidiValidatorResult.TOO_BIG)
@@ -0,0 +1,65 @@
+from os import environ
+
+from tests.db_testcase import DBTestCase
+
+from outbox import Outbox, OutboxChannel
+from user import UserDiscord, UserEmail
+
+class OutboxTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        Outbox.connect(environ['DATABASE_URL'])
+
+    def tearDown(self):
+        Outbox.disconnect()
+        super().tearDown()
+
+    def test_outbox(self):
+        self.assertEqual(Outbox.get_due_messages(), [])
+        self.assertIsNone(Outbox.get_next_attempt_delay())
+
+        UserEmail(email='foo@bar.com').notify('my content')
+        Outbox.put(to_email='baz@bar.com', subject='my subject', content='other content')
+        message_1, message_2 = Outbox.get_due_messages()
+        self.assertEqual(message_1.to_email, 'foo@bar.com')
+        self.assertEqual(message_1.subject, 'DTMaaS Recording')
+        self.assertEqual(message_1.content, 'my content')
+        self.assertEqual(message_2.to_email, 'baz@bar.com')
+        self.assertEqual(Outbox.get_next_attempt_delay(), 0)
+
+        # sent messages are done, failed ones back off
+        Outbox.mark_sent(message_1)
+        Outbox.mark_failed(message_2, 'try again')
+        self.assertEqual(message_2.attempts, 1)
+        self.assertEqual(Outbox.get_due_messages(), [])
+        delay = Outbox.get_next_attempt_delay()
+        assert delay is not None
+        self.assertAlmostEqual(delay, Outbox.RETRY_BACKOFF, delta=5)
+
+        # permanent failures are never retried
+        Outbox.mark_failed(message_2, 'no such user', permanent=True)
+        self.assertEqual(message_2.attempts, Outbox.MAX_ATTEMPTS)
+        self.assertIsNone(Outbox.get_next_attempt_delay())
+
+    def test_discord(self):
+        UserDiscord(user_id=1, channel_id=2).notify('my content')
+        Outbox.put(to_email='baz@bar.com', subject='my subject', content='other content')
+        message, = Outbox.get_due_messages(OutboxChannel.DISCORD)
+        self.assertEqual(message.channel, OutboxChannel.DISCORD)
+        self.assertEqual((message.discord_channel_id, message.discord_user_id), (2, 1))
+        self.assertEqual(message.content, 'my content')
+        self.assertEqual([message.to_email for message in Outbox.get_due_messages()],
+            ['baz@bar.com'])
+
+        batches = Outbox.fetch_batches(timeout=1, channel=OutboxChannel.DISCORD)
+        self.assertEqual(next(batches), [message])
+        Outbox.mark_sent(message)
+        self.assertEqual(list(batches), [])
+
+    def test_fetch_messages(self):
+        Outbox.put(to_email='foo@bar.com', subject='my subject', content='my content')
+        messages = Outbox.fetch_messages(timeout=1)
+        message = next(messages)
+        self.assertEqual(message.to_email, 'foo@bar.com')
+        Outbox.mark_sent(message)
+        self.assertEqual(list(messages), [])
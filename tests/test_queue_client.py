@@ -1,5 +1,6 @@
-from os import environ, path, unlink
+from os import environ
 from dataclasses import asdict
+from hashlib import sha256
 from uuid import UUID, uuid4
 import io
 
@@ -7,8 +8,10 @@ import mido
 
 from tests.db_testcase import DBTestCase
 
-from queue_client import Queue, QueueItem, StatusEnum
-from synth import SynthRolandSC55mk2
+from queue_client import Queue, QueueItem, StatusEnum, SchedulingPolicy, StageModel, STAGES, \
+    AdmissionResult
+from synth import SynthNull, SynthRolandSC55mk2
+from artifacts import Artifact
 from user import UserEmail, UserDiscord
 
 class QueueTestCase(DBTestCase):
@@ -66,6 +69,75 @@ class QueueTestCase(DBTestCase):
         Queue.enqueue_queue_item(queue_item)
         Queue.increment_queue_item_retries(queue_item)
         self.assertEqual(queue_item.retries, 1)
+        self.assertEqual(Queue.get_live_uuids(), {queue_item.uuid})
+        Queue.update_queue_item_status(queue_item, StatusEnum.FAILED)
+        self.assertEqual(Queue.get_live_uuids(), set())
+        Queue.disconnect()
+
+    def test_add_queue_item_xruns(self):
+        Queue.connect(environ['DATABASE_URL'])
+        queue_item = QueueItem(
+            uuid=uuid4(),
+            status=StatusEnum.NEW,
+            retries=0,
+            user=UserEmail(email='foo@bar.com'),
+            synth=SynthRolandSC55mk2(),
+            midi_file='onestop.mid',
+            midi_length=500
+        )
+        Queue.enqueue_queue_item(queue_item)
+        Queue.add_queue_item_xruns(queue_item, 3, True)
+        Queue.add_queue_item_xruns(queue_item, 1, False)
+        self.assertEqual((queue_item.xruns, queue_item.recaptures), (4, 1))
+        front = Queue.get_front_queue_item(SynthRolandSC55mk2())
+        assert front is not None
+        self.assertEqual((front.xruns, front.recaptures), (4, 1))
+        Queue.disconnect()
+
+    def test_set_queue_item_notified(self):
+        Queue.connect(environ['DATABASE_URL'])
+        queue_item = QueueItem(
+            uuid=uuid4(),
+            status=StatusEnum.NEW,
+            retries=0,
+            user=UserEmail(email='foo@bar.com'),
+            synth=SynthRolandSC55mk2(),
+            midi_file='onestop.mid',
+            midi_length=500
+        )
+        Queue.enqueue_queue_item(queue_item)
+        self.assertEqual(queue_item.notified, 0)
+        Queue.set_queue_item_notified(queue_item, 2)
+        self.assertEqual(queue_item.notified, 2)
+        front = Queue.get_queue_item(queue_item.uuid)
+        assert front is not None
+        self.assertEqual(front.notified, 2)
+        Queue.disconnect()
+
+    def test_set_queue_item_artifact(self):
+        Queue.connect(environ['DATABASE_URL'])
+        queue_item = QueueItem(
+            uuid=uuid4(),
+            status=StatusEnum.NEW,
+            retries=0,
+            user=UserEmail(email='foo@bar.com'),
+            synth=SynthRolandSC55mk2(),
+            midi_file='onestop.mid',
+            midi_length=500
+        )
+        Queue.enqueue_queue_item(queue_item)
+        wav = Artifact(path='/media/a.wav', size=44, sha256='0'*64, samples=0)
+        flac = Artifact(path='/media/a.flac', size=42, sha256='1'*64, samples=0)
+        Queue.set_queue_item_artifact(queue_item, 'wav', wav)
+        Queue.set_queue_item_artifact(queue_item, 'flac', flac)
+        Queue.set_queue_item_artifact(queue_item, 'flac', flac.with_url('https://a/a.flac'))
+        front_item = Queue.get_front_queue_item(SynthRolandSC55mk2())
+        assert front_item is not None
+        self.assertEqual(front_item.artifacts, {
+            'wav': wav,
+            'flac': flac.with_url('https://a/a.flac'),
+        })
+        self.assertEqual(front_item.artifacts, queue_item.artifacts)
         Queue.disconnect()
 
     def test_get_queue_length(self):
@@ -125,6 +197,164 @@ class QueueTestCase(DBTestCase):
 
         Queue.disconnect()
 
+    def test_scheduling_policy(self):
+        Queue.connect(environ['DATABASE_URL'])
+        queue_items_foo = []
+        for midi_length in [300, 300, 300]:
+            queue_item = QueueItem(
+                uuid=uuid4(),
+                status=StatusEnum.NEW,
+                retries=0,
+                user=UserEmail(email='foo@bar.com'),
+                synth=SynthRolandSC55mk2(),
+                midi_file='onestop.mid',
+                midi_length=midi_length
+            )
+            Queue.enqueue_queue_item(queue_item)
+            queue_items_foo.append(queue_item)
+        queue_item_baz = QueueItem(
+            uuid=uuid4(),
+            status=StatusEnum.NEW,
+            retries=0,
+            user=UserEmail(email='baz@bar.com'),
+            synth=SynthRolandSC55mk2(),
+            midi_file='canyon.mid',
+            midi_length=600
+        )
+        Queue.enqueue_queue_item(queue_item_baz)
+        queue_item_urgent = QueueItem(
+            uuid=uuid4(),
+            status=StatusEnum.NEW,
+            retries=0,
+            user=UserEmail(email='qux@bar.com'),
+            synth=SynthRolandSC55mk2(),
+            midi_file='town.mid',
+            midi_length=60,
+            priority=1
+        )
+        Queue.enqueue_queue_item(queue_item_urgent)
+
+        # fifo keeps arrival order behind priority
+        Queue.policy = SchedulingPolicy.FIFO
+        self.assertEqual(Queue.get_front_queue_item(SynthRolandSC55mk2()), queue_item_urgent)
+        self.assertEqual(Queue.get_queue_length(SynthRolandSC55mk2(), queue_item_baz), 29)
+
+        # round robin lets baz in after foo's first item
+        Queue.policy = SchedulingPolicy.ROUND_ROBIN
+        self.assertEqual(Queue.get_queue_length(SynthRolandSC55mk2(), queue_item_baz), 18)
+
+        # fair share lets baz in once foo has queued as much, shorter job first
+        Queue.policy = SchedulingPolicy.FAIR_SHARE
+        self.assertEqual(Queue.get_queue_length(SynthRolandSC55mk2(), queue_item_baz), 24)
+        self.assertEqual(Queue.get_queue_length(SynthRolandSC55mk2(), queue_items_foo[2]), 29)
+
+        # items in progress are never preempted
+        Queue.update_queue_item_status(queue_item_urgent, StatusEnum.DONE)
+        Queue.update_queue_item_status(queue_items_foo[2], StatusEnum.RECORDING)
+        front_item = Queue.get_front_queue_item(SynthRolandSC55mk2())
+        self.assertEqual(front_item.uuid, queue_items_foo[2].uuid)
+        Queue.disconnect()
+
+    def test_stage_model_fit(self):
+        samples = [(60, 65), (120, 125), (300, 305)]
+        sums = [
+            len(samples),
+            sum(x for x, _ in samples),
+            sum(y for _, y in samples),
+            sum(x*x for x, _ in samples),
+            sum(x*y for x, y in samples),
+        ]
+        stage_model = StageModel.fit(*sums)
+        self.assertAlmostEqual(stage_model.intercept, 5)
+        self.assertAlmostEqual(stage_model.slope, 1)
+        self.assertAlmostEqual(stage_model.predict(600), 605)
+
+        stage_model = StageModel.fit(1, 60, 30, 60*60, 60*30)
+        self.assertAlmostEqual(stage_model.predict(120), 60)
+
+    def test_record_stage(self):
+        Queue.connect(environ['DATABASE_URL'])
+        queue_item_1 = QueueItem(
+            uuid=uuid4(),
+            status=StatusEnum.NEW,
+            retries=0,
+            user=UserEmail(email='foo@bar.com'),
+            synth=SynthRolandSC55mk2(),
+            midi_file='onestop.mid',
+            midi_length=600
+        )
+        Queue.enqueue_queue_item(queue_item_1)
+        queue_item_2 = QueueItem(
+            uuid=uuid4(),
+            status=StatusEnum.NEW,
+            retries=0,
+            user=UserEmail(email='foo@bar.com'),
+            synth=SynthRolandSC55mk2(),
+            midi_file='canyon.mid',
+            midi_length=1200
+        )
+        Queue.enqueue_queue_item(queue_item_2)
+        self.assertEqual(Queue.get_queue_length(SynthRolandSC55mk2()), 34)
+
+        for stage in STAGES:
+            queue_item_1.status = stage
+            with Queue.timing_stage(queue_item_1):
+                pass
+        cur = Queue._get_cursor()
+        cur.execute("SELECT stage FROM stage_history WHERE uuid=%s", [str(queue_item_1.uuid)])
+        self.assertEqual(len(cur.fetchall()), len(STAGES))
+
+        # recording at half speed, other stages keep their defaults
+        cur.execute("DELETE FROM stage_model")
+        Queue.stage_models = {}
+        queue_item_1.status = StatusEnum.NEW
+        Queue.record_stage(queue_item_1, StatusEnum.RECORDING, 300)
+        self.assertEqual(Queue.get_queue_length(SynthRolandSC55mk2(), queue_item_1), 7)
+        Queue.record_stage(queue_item_1, StatusEnum.RECORDING, 300)
+        self.assertEqual(Queue.get_queue_length(SynthRolandSC55mk2()), 19)
+        Queue.disconnect()
+
+    def test_get_admission_result(self):
+        Queue.connect(environ['DATABASE_URL'])
+        user = UserEmail(email='foo@bar.com')
+        for _ in range(Queue.RATE_LIMIT_REQUESTS):
+            self.assertEqual(Queue.get_admission_result(user, 60), AdmissionResult.OK)
+        self.assertEqual(Queue.get_admission_result(user, 60), AdmissionResult.TOO_MANY_REQUESTS)
+        self.assertEqual(Queue.get_admission_result(UserEmail(email='baz@bar.com'), 60),
+            AdmissionResult.OK)
+
+        # bucket refills over the window
+        cur = Queue._get_cursor()
+        cur.execute("UPDATE rate_limit SET updated_at = NOW() - INTERVAL '6 minutes'")
+        self.assertEqual(Queue.get_admission_result(user, 60), AdmissionResult.OK)
+        self.assertEqual(Queue.get_admission_result(user, 60), AdmissionResult.TOO_MANY_REQUESTS)
+
+        queue_item = QueueItem(
+            uuid=uuid4(),
+            status=StatusEnum.NEW,
+            retries=0,
+            user=UserEmail(email='qux@bar.com'),
+            synth=SynthRolandSC55mk2(),
+            midi_file='onestop.mid',
+            midi_length=Queue.MAX_QUEUED_LENGTH - 60
+        )
+        Queue.enqueue_queue_item(queue_item)
+        self.assertEqual(Queue.get_admission_result(queue_item.user, 60), AdmissionResult.OK)
+        self.assertEqual(Queue.get_admission_result(queue_item.user, 61),
+            AdmissionResult.TOO_MUCH_QUEUED)
+
+        # admitting and enqueueing together
+        queue_item.uuid = uuid4()
+        self.assertEqual(Queue.admit_queue_item(queue_item),
+            (AdmissionResult.TOO_MUCH_QUEUED, False))
+        self.assertIsNone(Queue.get_queue_item(queue_item.uuid))
+        queue_item.midi_length = 30
+        self.assertEqual(Queue.admit_queue_item(queue_item), (AdmissionResult.OK, False))
+        self.assertEqual(Queue.get_queue_item(queue_item.uuid), queue_item)
+        self.assertEqual(Queue.get_admission_message(AdmissionResult.TOO_MUCH_QUEUED),
+            'Too much MIDI queued >30 min')
+        Queue.disconnect()
+
     def test_queue_item_factory(self):
         stream = io.BytesIO()
         midi = mido.MidiFile(ticks_per_beat=24)
@@ -139,9 +369,101 @@ class QueueTestCase(DBTestCase):
             synth=SynthRolandSC55mk2(),
             midi_file='town.mid',
             midi_data=stream.getvalue(),
-            media_path='/tmp'
         )
         self.assertEquals(queue_item.status, StatusEnum.NEW)
         self.assertEquals(queue_item.midi_length, 60)
-        self.assertTrue(path.exists(queue_item.midi_path('/tmp')))
-        unlink(queue_item.midi_path('/tmp'))
+        self.assertEquals(queue_item.midi_hash, sha256(stream.getvalue()).hexdigest())
+        self.assertEquals(queue_item.midi_data, stream.getvalue())
+
+    def test_midi_blobs(self):
+        Queue.connect(environ['DATABASE_URL'])
+        queue_item_1 = QueueItem.factory(
+            user=UserEmail(email='foo@bar.com'),
+            synth=SynthRolandSC55mk2(),
+            midi_file='town.mid',
+            midi_data=self._midi_data(),
+        )
+        Queue.enqueue_queue_item(queue_item_1)
+        # the same MIDI for another synth is recorded separately
+        queue_item_2 = QueueItem.factory(
+            user=UserEmail(email='baz@bar.com'),
+            synth=SynthNull(),
+            midi_file='town2.mid',
+            midi_data=self._midi_data(),
+        )
+        self.assertFalse(Queue.enqueue_queue_item(queue_item_2))
+
+        cur = Queue._get_cursor()
+        cur.execute("SELECT hash, refcount FROM midi_blob")
+        self.assertEqual(cur.fetchall(), [(queue_item_1.midi_hash, 2)])
+
+        front_item = Queue.get_front_queue_item(SynthRolandSC55mk2())
+        self.assertIsNone(front_item.midi_data)
+        self.assertEqual(Queue.get_midi_data(front_item), self._midi_data())
+
+        Queue.update_queue_item_status(queue_item_1, StatusEnum.DONE)
+        Queue.update_queue_item_status(queue_item_2, StatusEnum.FAILED)
+        cur.execute("SELECT refcount FROM midi_blob")
+        self.assertEqual(cur.fetchone(), (0,))
+
+        # still within the grace period
+        self.assertEqual(Queue.collect_midi_blobs(), 0)
+        cur.execute("UPDATE midi_blob SET updated_at = NOW() - INTERVAL '1 day'")
+        self.assertEqual(Queue.collect_midi_blobs(), 1)
+        Queue.disconnect()
+
+    def test_coalescing(self):
+        Queue.connect(environ['DATABASE_URL'])
+        queue_item_1 = QueueItem.factory(
+            user=UserEmail(email='foo@bar.com'),
+            synth=SynthRolandSC55mk2(),
+            midi_file='town.mid',
+            midi_data=self._midi_data(),
+        )
+        self.assertFalse(Queue.enqueue_queue_item(queue_item_1))
+        queue_item_2 = QueueItem.factory(
+            user=UserDiscord(user_id=1, channel_id=2),
+            synth=SynthRolandSC55mk2(),
+            midi_file='town2.mid',
+            midi_data=self._midi_data(),
+        )
+        uuid_2 = queue_item_2.uuid
+        self.assertTrue(Queue.enqueue_queue_item(queue_item_2))
+        self.assertEqual(queue_item_2.uuid, queue_item_1.uuid)
+        self.assertEqual(Queue.get_queue_item_subscribers(queue_item_1),
+            [(UserDiscord(user_id=1, channel_id=2), 'town2.mid')])
+        self.assertEqual(Queue.get_queue_length(SynthRolandSC55mk2(), queue_item_2),
+            Queue.get_queue_length(SynthRolandSC55mk2(), queue_item_1))
+        # the shared job counts towards the subscriber's queued length
+        self.assertEqual(Queue.get_admission_result(queue_item_2.user, Queue.MAX_QUEUED_LENGTH),
+            AdmissionResult.TOO_MUCH_QUEUED)
+
+        cur = Queue._get_cursor()
+        cur.execute("SELECT COUNT(*) FROM queue")
+        self.assertEqual(cur.fetchone(), (1,))
+        cur.execute("SELECT COUNT(*) FROM queue WHERE uuid=%s", [str(uuid_2)])
+        self.assertEqual(cur.fetchone(), (0,))
+
+        # too late to fan out once notifying
+        Queue.update_queue_item_status(queue_item_1, StatusEnum.NOTIFYING)
+        queue_item_3 = QueueItem.factory(
+            user=UserEmail(email='baz@bar.com'),
+            synth=SynthRolandSC55mk2(),
+            midi_file='town3.mid',
+            midi_data=self._midi_data(),
+        )
+        self.assertFalse(Queue.enqueue_queue_item(queue_item_3))
+        self.assertNotEqual(queue_item_3.uuid, queue_item_1.uuid)
+        self.assertEqual(len(Queue.get_queue_item_subscribers(queue_item_1)), 1)
+        self.assertEqual(Queue.get_queue_item_subscribers(queue_item_3), [])
+        Queue.disconnect()
+
+    def _midi_data(self):
+        stream = io.BytesIO()
+        midi = mido.MidiFile(ticks_per_beat=24)
+        track = mido.MidiTrack()
+        track.append(mido.Message('note_on', note=64, velocity=64, time=0))
+        track.append(mido.Message('note_off', note=64, velocity=64, time=24*2*60))
+        midi.tracks.append(track)
+        midi.save(file=stream)
+        return stream.getvalue()
@@ -0,0 +1,114 @@
+import json
+import os
+import pstats
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from tests.testcase import TestCase
+import tracing
+from tracing import Tracer, bind, item, span, traced
+
+class TracingTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory() # pylint: disable=consider-using-with
+        os.environ['TRACE_DIR'] = self.directory.name
+
+    def tearDown(self):
+        if Tracer.fp is not None:
+            Tracer.fp.close()
+        Tracer.fp = None
+        Tracer.enabled = False
+        Tracer.profile_rate = 0.
+        del os.environ['TRACE_DIR']
+        os.environ.pop('TRACE_PROFILE_RATE', None)
+        self.directory.cleanup()
+        super().tearDown()
+
+    def get_item_events(self):
+        names = [name for name in os.listdir(self.directory.name) if name.endswith('.trace.json')
+            and not name.startswith('dtmaas_')]
+        self.assertEqual(len(names), 1)
+        with open(os.path.join(self.directory.name, names[0]), encoding='utf8') as fp:
+            return json.load(fp)['traceEvents']
+
+    def test_disabled(self):
+        os.environ['TRACE_DIR'] = ''
+        tracing.start('test')
+        self.assertFalse(tracing.is_enabled())
+        with item(uuid4()), span('stage'):
+            pass
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_item(self):
+        @traced()
+        def my_function():
+            raise ValueError()
+
+        tracing.start('test')
+        uuid = uuid4()
+        with item(uuid):
+            with span('recording', 'stage', synth='nullsynth'):
+                with self.assertRaises(ValueError):
+                    my_function()
+        events = self.get_item_events()
+        self.assertEqual([event['name'] for event in events],
+            ['TracingTestCase.test_item.<locals>.my_function', 'recording', 'item'])
+        function, stage, root = events
+        self.assertEqual(function['cat'], 'tests.test_tracing')
+        self.assertEqual(function['args']['error'], 'ValueError()')
+        self.assertEqual(function['args']['parent_id'], stage['args']['span_id'])
+        self.assertEqual(stage['args']['parent_id'], root['args']['span_id'])
+        self.assertEqual(stage['args']['synth'], 'nullsynth')
+        self.assertIsNone(root['args']['parent_id'])
+        for event in events:
+            self.assertEqual(event['ph'], 'X')
+            self.assertEqual(event['args']['uuid'], str(uuid))
+            self.assertTrue(event['args']['span_id'].startswith(f'{uuid}.'))
+        self.assertLessEqual(root['ts'], stage['ts'])
+        self.assertGreaterEqual(root['dur'], stage['dur'])
+
+    def test_bind(self):
+        @traced()
+        def my_function():
+            return 1
+
+        tracing.start('test')
+        uuid = uuid4()
+        with item(uuid):
+            with span('encoding'), ThreadPoolExecutor(1) as executor:
+                self.assertEqual(executor.submit(bind(my_function)).result(), 1)
+                executor.submit(my_function).result()
+        events = self.get_item_events()
+        self.assertEqual([event['name'] for event in events],
+            ['TracingTestCase.test_bind.<locals>.my_function', 'encoding', 'item'])
+        function, stage, _ = events
+        self.assertNotEqual(function['tid'], stage['tid'])
+        self.assertEqual(function['args']['uuid'], str(uuid))
+        self.assertEqual(function['args']['parent_id'], stage['args']['span_id'])
+
+    def test_process_trace(self):
+        tracing.start('test')
+        with span('send'):
+            pass
+        assert Tracer.fp is not None
+        Tracer.fp.flush()
+        path = os.path.join(self.directory.name, f'dtmaas_test.{os.getpid()}.trace.json')
+        with open(path, encoding='utf8') as fp:
+            events = json.loads(fp.read().rstrip(',\n') + ']')
+        self.assertEqual([event['name'] for event in events], ['send'])
+        self.assertIsNone(events[0]['args']['uuid'])
+
+    def test_profile(self):
+        os.environ['TRACE_PROFILE_RATE'] = '1'
+        tracing.start('test')
+        uuid = uuid4()
+        with item(uuid):
+            sum(range(1000))
+        names = [name for name in os.listdir(self.directory.name) if name.endswith('.prof')]
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].startswith(str(uuid)))
+        stats = pstats.Stats(os.path.join(self.directory.name, names[0]))
+        self.assertTrue(any(function[2] == '<built-in method builtins.sum>'
+            for function in stats.stats)) # type: ignore
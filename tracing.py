@@ -0,0 +1,182 @@
+"""Nested timing spans per queue item in the Chrome trace event format, with
+sampled cProfile dumps
+
+Tracing is only on once `start` found TRACE_DIR set, until then a traced call
+is a single attribute check. Spans within `item` are written to
+`<uuid>.<started>.trace.json` when the item is done, others as they end to
+`dtmaas_<job>.<pid>.trace.json`; both open in Perfetto or chrome://tracing.
+"""
+import cProfile
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, TextIO, TypeVar
+from uuid import UUID
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+class Tracer:
+    """Where spans go, and the span stack of each thread"""
+    enabled = False
+    directory = ''
+    profile_rate = 0.
+    lock = threading.Lock()
+    fp: Optional[TextIO] = None
+    counter = 0
+    local = threading.local()
+
+def is_enabled() -> bool:
+    """Check whether spans are recorded"""
+    return Tracer.enabled
+
+def _get_stack() -> List[str]:
+    """Return the ids of the open spans of this thread"""
+    if not hasattr(Tracer.local, 'stack'):
+        Tracer.local.stack = []
+        Tracer.local.uuid = None
+        Tracer.local.events = None
+    return Tracer.local.stack
+
+def _next_span_id() -> str:
+    """Return a span id prefixed by the current item's uuid or the pid"""
+    with Tracer.lock:
+        Tracer.counter += 1
+        counter = Tracer.counter
+    prefix = Tracer.local.uuid or os.getpid()
+    return f'{prefix}.{counter}'
+
+def _emit(event: Dict[str, Any]):
+    """Keep the event with the current item, or write it to the process trace"""
+    if Tracer.local.events is not None:
+        Tracer.local.events.append(event)
+        return
+    with Tracer.lock:
+        if Tracer.fp is not None:
+            # the closing bracket is optional in the JSON array format
+            Tracer.fp.write(f'{json.dumps(event)},\n')
+            Tracer.fp.flush()
+
+@contextmanager
+def span(name: str, category: str = 'dtmaas', **args) -> Iterator[None]:
+    """Record the block as a span nested in the enclosing one, even if it raises"""
+    if not Tracer.enabled:
+        yield
+        return
+    stack = _get_stack()
+    span_id = _next_span_id()
+    event: Dict[str, Any] = {
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'pid': os.getpid(),
+        'tid': threading.get_ident(),
+        'args': {
+            **{key: str(value) for key, value in args.items()},
+            'span_id': span_id,
+            'parent_id': stack[-1] if stack else None,
+            'uuid': Tracer.local.uuid,
+        },
+    }
+    stack.append(span_id)
+    started = time.time_ns()
+    try:
+        yield
+    except BaseException as e:
+        event['args']['error'] = repr(e)
+        raise
+    finally:
+        stack.pop()
+        event['ts'] = started // 1000
+        event['dur'] = (time.time_ns() - started) // 1000
+        _emit(event)
+
+def traced(name: Optional[str] = None, category: Optional[str] = None) -> Callable[[F], F]:
+    """Decorate a function to record its calls as spans, named by its qualified
+    name and categorized by its module unless given"""
+    def decorator(func: F) -> F:
+        span_name = name or func.__qualname__
+        span_category = category or func.__module__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not Tracer.enabled:
+                return func(*args, **kwargs)
+            with span(span_name, span_category):
+                return func(*args, **kwargs)
+        return wrapper # type: ignore
+    return decorator
+
+def bind(func: F) -> F:
+    """Wrap `func` to run on another thread with the current span as its
+    parent, keeping its spans with the current item"""
+    if not Tracer.enabled:
+        return func
+    stack = _get_stack()
+    parent = stack[-1:]
+    uuid, events = Tracer.local.uuid, Tracer.local.events
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _get_stack()
+        saved = Tracer.local.stack, Tracer.local.uuid, Tracer.local.events
+        Tracer.local.stack, Tracer.local.uuid, Tracer.local.events = list(parent), uuid, events
+        try:
+            return func(*args, **kwargs)
+        finally:
+            Tracer.local.stack, Tracer.local.uuid, Tracer.local.events = saved
+    return wrapper # type: ignore
+
+@contextmanager
+def item(uuid: UUID) -> Iterator[None]:
+    """Trace the block as the processing of a queue item, profiling it at
+    TRACE_PROFILE_RATE"""
+    if not Tracer.enabled:
+        yield
+        return
+    _get_stack()
+    Tracer.local.uuid = str(uuid)
+    Tracer.local.events = []
+    path = os.path.join(Tracer.directory, f'{uuid}.{time.time_ns() // 1000}')
+    profile = cProfile.Profile() if random.random() < Tracer.profile_rate else None
+    try:
+        if profile:
+            profile.enable()
+        with span('item', 'item'):
+            yield
+    finally:
+        if profile:
+            profile.disable()
+        events = Tracer.local.events
+        Tracer.local.uuid = None
+        Tracer.local.events = None
+        try:
+            with open(f'{path}.trace.json', 'w', encoding='utf8') as fp:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+            if profile:
+                profile.dump_stats(f'{path}.prof')
+        except OSError:
+            logging.exception('Could not write trace to "%s"', path)
+
+def start(job: str):
+    """Start tracing if TRACE_DIR is set, profiling a TRACE_PROFILE_RATE share
+    of the items"""
+    directory = os.environ.get('TRACE_DIR')
+    if not directory:
+        return
+    path = os.path.join(directory, f'dtmaas_{job}.{os.getpid()}.trace.json')
+    try:
+        os.makedirs(directory, exist_ok=True)
+        Tracer.fp = open(path, 'w', encoding='utf8') # pylint: disable=consider-using-with
+    except OSError:
+        logging.exception('Could not write trace to "%s"', path)
+        return
+    Tracer.fp.write('[\n')
+    Tracer.directory = directory
+    Tracer.profile_rate = float(os.environ.get('TRACE_PROFILE_RATE', '0'))
+    Tracer.enabled = True
+    logging.info('Writing traces to "%s"', directory)
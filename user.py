@@ -1,7 +1,7 @@
 """Classes representing users"""
 from abc import ABC, abstractmethod
 
-from email_client import EmailClient
+from outbox import Outbox
 
 class User(ABC):
     """Abstract class representing a user"""
@@ -18,8 +18,7 @@ class UserEmail(User):
         return self.email == other.email
 
     def notify(self, content: str):
-        email = EmailClient()
-        email.send(
+        Outbox.put(
             to_email=self.email,
             subject='DTMaaS Recording',
             content=content
@@ -35,7 +34,11 @@ class UserDiscord(User):
         return self.user_id == other.user_id and self.channel_id == other.channel_id
 
     def notify(self, content: str):
-        pass
+        Outbox.put_discord(
+            channel_id=self.channel_id,
+            user_id=self.user_id,
+            content=content
+        )
 
 class UserSerializer:
     """Serialization for a User"""
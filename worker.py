@@ -1,104 +1,297 @@
 """Script that does the main work of processing MIDIs"""
 import logging
 import atexit
-from os import environ, unlink
+from os import environ
 from os.path import basename
 import sys
+from typing import List, Tuple
 
 from dotenv import load_dotenv
+import psycopg2
 import sdnotify # type: ignore
 
-from queue_client import Queue, QueueItem, StatusEnum
+import metrics
+import tracing
+from outbox import Outbox
+from queue_client import Queue, QueueItem, StatusEnum, SchedulingPolicy
 from synth import Synth
-from midi_processor import MidiProcessor
+from user import User
+from midi_processor import MidiProcessor, CapturePriority
 from azure_client import AzureClient
+from artifacts import Artifact
+from media_manager import MediaManager
+from heartbeat import Heartbeat, ProgressReader, file_growth_probe, subprocess_probe
 
 load_dotenv()
 
 MAX_RETRIES = 3
+MAX_RECAPTURES = 2
+CAPTURE_PRIORITY = CapturePriority.from_environ()
+RENDITIONS = environ.get('RENDITIONS', 'flac').split(',')
+BLOB_ACCOUNT = 'dtmaas'
+BLOB_CONTAINER = 'recordings'
 
 def exit_handler(queue_item: QueueItem):
     """Increment retry count on unexpected exit"""
     logging.warning('Unexpected exit, incrementing retries...')
     Queue.increment_queue_item_retries(queue_item)
 
-def process_queue_item(queue_item: QueueItem):
+def is_artifact_valid(queue_item: QueueItem, name: str) -> bool:
+    """Check an earlier attempt left the named stage output intact"""
+    artifact = queue_item.artifacts.get(name)
+    if artifact is None:
+        return False
+    if not artifact.is_valid():
+        logging.warning('Artifact "%s" at "%s" is missing or damaged', name, artifact.path)
+        return False
+    return True
+
+def needs_encoding(queue_item: QueueItem, rendition: str) -> bool:
+    """Check whether a rendition has neither been uploaded nor is intact locally"""
+    artifact = queue_item.artifacts.get(rendition)
+    return artifact is None or (artifact.url is None
+        and not is_artifact_valid(queue_item, rendition))
+
+def rewind_queue_item(queue_item: QueueItem):
+    """Move the queue item back to the earliest stage whose input is unusable"""
+    # RENDITIONS may have changed since the preview was uploaded
+    if queue_item.status == StatusEnum.NOTIFYING and not any(
+            rendition in queue_item.artifacts and queue_item.artifacts[rendition].url
+            for rendition in RENDITIONS):
+        Queue.update_queue_item_status(queue_item, StatusEnum.UPLOADING)
+    if queue_item.status == StatusEnum.UPLOADING \
+            and any(needs_encoding(queue_item, rendition) for rendition in RENDITIONS):
+        Queue.update_queue_item_status(queue_item, StatusEnum.ENCODING)
+    if queue_item.status == StatusEnum.ENCODING and not is_artifact_valid(queue_item, 'wav'):
+        Queue.update_queue_item_status(queue_item, StatusEnum.RECORDING)
+
+def get_preview_rendition(queue_item: QueueItem, uploaded: bool = False) -> str:
+    """Return the smallest rendition encoded, or `uploaded`, so far, which is
+    uploaded before notifying"""
+    renditions = [rendition for rendition in RENDITIONS if rendition in queue_item.artifacts
+        and (queue_item.artifacts[rendition].url or not uploaded)]
+    return min(renditions, key=lambda rendition: queue_item.artifacts[rendition].size)
+
+def get_azure_client() -> AzureClient:
+    """Return a client for the blob storage"""
+    return AzureClient(
+        tenant_id=environ['AZURE_TENANT_ID'],
+        client_id=environ['AZURE_CLIENT_ID'],
+        client_secret=environ['AZURE_CLIENT_SECRET'],
+        resource='https://storage.azure.com/'
+    )
+
+def get_notification(queue_item: QueueItem, midi_file: str) -> str:
+    """Return the notification for a user who sent the recorded MIDI as `midi_file`"""
+    azure = get_azure_client()
+    preview = get_preview_rendition(queue_item, uploaded=True)
+    url = azure.get_blob_sas_url(BLOB_ACCOUNT, BLOB_CONTAINER,
+        basename(queue_item.artifacts[preview].path))
+    content = f'Your MIDI file "{midi_file}" was recorded on a ' \
+        f'{queue_item.synth.get_name()} and uploaded here:\r\n{url}\r\n'
+    # only renditions already encoded are promised, see `publish_renditions`
+    followups = [rendition for rendition in get_promised_renditions(queue_item)
+        if rendition != preview]
+    for rendition in followups:
+        url = azure.get_blob_sas_url(BLOB_ACCOUNT, BLOB_CONTAINER,
+            basename(queue_item.artifacts[rendition].path))
+        content += f'A {rendition.upper()} version will follow shortly here:' \
+            f'\r\n{url}\r\n'
+    content += 'These links will expire after 24 hours.' if followups \
+        else 'This link will expire after 24 hours.'
+    return content
+
+def get_promised_renditions(queue_item: QueueItem) -> List[str]:
+    """Return the renditions the notification links to"""
+    return [rendition for rendition in RENDITIONS if rendition in queue_item.artifacts]
+
+def get_subscribers(queue_item: QueueItem) -> List[Tuple[User, str]]:
+    """Return every user waiting for the recording, with the name of the MIDI
+    file each sent"""
+    return [(queue_item.user, queue_item.midi_file)] \
+        + Queue.get_queue_item_subscribers(queue_item)
+
+def notify_subscriber(user: User, midi_file: str, content: str):
+    """Notify `user`, logging rather than raising if only their notification
+    cannot be sent, so it does not hold up the others"""
+    try:
+        user.notify(content)
+    except Exception as e: # pylint: disable=broad-exception-caught
+        if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            raise
+        logging.exception('Could not notify the user of MIDI file "%s"', midi_file)
+
+def record_queue_item(queue_item: QueueItem, wav_path: str, heartbeat: Heartbeat) -> bool:
+    """Record the queue item, unless the capture had xruns and is to be
+    recorded again, in which case False is returned"""
+    profile = queue_item.synth.get_capture_profile()
+    probe = file_growth_probe(wav_path, queue_item.midi_length * profile.get_bytes_per_second())
+    with Queue.timing_stage(queue_item), heartbeat.stage('Recording', probe):
+        xruns = MidiProcessor.record(queue_item.synth, Queue.get_midi_data(queue_item),
+            wav_path, CAPTURE_PRIORITY)
+    recapture = xruns > 0 and queue_item.recaptures < MAX_RECAPTURES
+    Queue.add_queue_item_xruns(queue_item, xruns, recapture)
+    if recapture:
+        logging.warning('Recording had %d xruns, recording again...', xruns)
+        return False
+    if xruns:
+        logging.warning('Recording had %d xruns, keeping it after %d recaptures',
+            xruns, queue_item.recaptures)
+    Queue.set_queue_item_artifact(queue_item, 'wav', Artifact.from_file(wav_path))
+    return True
+
+@tracing.traced(category='worker')
+def encode_renditions(queue_item: QueueItem, renditions: List[str], heartbeat: Heartbeat):
+    """Encode the recording to `renditions` in parallel and record them"""
+    wav = queue_item.artifacts['wav']
+    output_paths = [f'{wav.path[:-4]}.{rendition}' for rendition in renditions]
+    with heartbeat.stage('Encoding', subprocess_probe(output_paths)):
+        MidiProcessor.encode_renditions(wav.path, output_paths,
+            queue_item.synth.get_capture_profile())
+    for rendition, output_path in zip(renditions, output_paths):
+        artifact = Artifact.from_file(output_path)
+        if rendition == 'flac' and artifact.samples != wav.samples:
+            raise RuntimeError("Encoded FLAC length does not match WAV")
+        Queue.set_queue_item_artifact(queue_item, rendition, artifact)
+
+@tracing.traced(category='worker')
+def upload_rendition(queue_item: QueueItem, rendition: str, heartbeat: Heartbeat):
+    """Upload a rendition unless an earlier attempt already did"""
+    artifact = queue_item.artifacts[rendition]
+    if artifact.url:
+        logging.info('Reusing uploaded file "%s"...', artifact.path)
+        return
+    logging.info('Uploading file "%s"...', artifact.path)
+    azure = get_azure_client()
+    with open(artifact.path, 'rb') as fp:
+        reader = ProgressReader(fp, artifact.size)
+        with heartbeat.stage(f'Uploading {rendition}', reader.probe):
+            url = azure.req_blob_upload(
+                blob_account=BLOB_ACCOUNT,
+                container=BLOB_CONTAINER,
+                blob=basename(artifact.path),
+                data=reader # type: ignore
+            )
+    Queue.set_queue_item_artifact(queue_item, rendition, artifact.with_url(url))
+
+@tracing.traced(category='worker')
+def publish_renditions(queue_item: QueueItem, heartbeat: Heartbeat):
+    """Upload the renditions that were not uploaded before notifying, telling
+    the users about any they were promised but that cannot be made"""
+    promised = get_promised_renditions(queue_item)
+    lost = []
+    for rendition in RENDITIONS:
+        if needs_encoding(queue_item, rendition):
+            # the user was already notified, so make do with what is left
+            if not is_artifact_valid(queue_item, 'wav'):
+                logging.warning('Cannot publish %s, recording is gone', rendition)
+                if rendition in promised:
+                    lost.append(rendition)
+                continue
+            encode_renditions(queue_item, [rendition], heartbeat)
+        upload_rendition(queue_item, rendition, heartbeat)
+    if lost:
+        versions = ' and '.join(rendition.upper() for rendition in lost)
+        for user, midi_file in get_subscribers(queue_item):
+            notify_subscriber(user, midi_file, f'Sorry but the {versions} version of your '
+                f'MIDI file "{midi_file}" could not be made after all, so its link will not work.')
+
+def process_queue_item(queue_item: QueueItem, media: MediaManager, heartbeat: Heartbeat):
     """Process the queue item or mark as failed after too many retries"""
     if queue_item.retries >= MAX_RETRIES:
         logging.error('Maximum retries exceeded, marking as failed...')
         Queue.update_queue_item_status(queue_item, StatusEnum.FAILED)
+        media.release(queue_item.uuid)
         return
     atexit.register(exit_handler, queue_item=queue_item)
     assert queue_item.status not in (StatusEnum.DONE, StatusEnum.FAILED)
-    midi_path = queue_item.midi_path(environ['MEDIA_PATH'])
-    wav_path = f'{midi_path[:-4]}.wav'
-    flac_path = f'{wav_path[:-4]}.flac'
+    profile = queue_item.synth.get_capture_profile()
+    media_path = media.reserve(queue_item.uuid, queue_item.midi_length, profile)
+    wav_path = f'{media_path}/{queue_item.uuid}.wav'
 
     if queue_item.status == StatusEnum.NEW:
         Queue.update_queue_item_status(queue_item, StatusEnum.RECORDING)
 
+    rewind_queue_item(queue_item)
+
     if queue_item.status == StatusEnum.RECORDING:
-        logging.info('Recording MIDI file "%s"...', midi_path)
-        MidiProcessor.record(queue_item.synth, midi_path, wav_path)
+        if is_artifact_valid(queue_item, 'wav'):
+            logging.info('Reusing recorded WAV file "%s"...', wav_path)
+        else:
+            logging.info('Recording MIDI file "%s"...', queue_item.midi_file)
+            if not record_queue_item(queue_item, wav_path, heartbeat):
+                # the item stays in front of the queue, so it is fetched again
+                atexit.unregister(exit_handler)
+                media.release(queue_item.uuid)
+                return
         Queue.update_queue_item_status(queue_item, StatusEnum.ENCODING)
 
     if queue_item.status == StatusEnum.ENCODING:
-        logging.info('Encoding WAV file "%s"...', wav_path)
-        MidiProcessor.encode(wav_path, flac_path)
+        renditions = [rendition for rendition in RENDITIONS
+            if needs_encoding(queue_item, rendition)]
+        logging.info('Encoding WAV file "%s" to %s...', wav_path, renditions)
+        with Queue.timing_stage(queue_item):
+            encode_renditions(queue_item, renditions, heartbeat)
         Queue.update_queue_item_status(queue_item, StatusEnum.UPLOADING)
 
     if queue_item.status == StatusEnum.UPLOADING:
-        logging.info('Uploading FLAC file "%s"...', flac_path)
-        azure = AzureClient(
-            tenant_id=environ['AZURE_TENANT_ID'],
-            client_id=environ['AZURE_CLIENT_ID'],
-            client_secret=environ['AZURE_CLIENT_SECRET'],
-            resource='https://storage.azure.com/'
-        )
-        with open(flac_path, 'rb') as fp:
-            url = azure.req_blob_upload(
-                blob_account='dtmaas',
-                container='recordings',
-                blob=basename(flac_path),
-                data=fp
-            )
+        with Queue.timing_stage(queue_item):
+            upload_rendition(queue_item, get_preview_rendition(queue_item), heartbeat)
         Queue.update_queue_item_status(queue_item, StatusEnum.NOTIFYING)
 
     if queue_item.status == StatusEnum.NOTIFYING:
-        logging.info('Sending notification...')
-        content = f'Your MIDI file "{queue_item.midi_file}" was recorded on a ' \
-            f'{queue_item.synth.get_name()} and uploaded here:' \
-            f'\r\n{url}\r\nThis link will expire after 24 hours.'
-        queue_item.user.notify(content)
+        subscribers = get_subscribers(queue_item)
+        logging.info('Sending notification to %d of %d users...',
+            len(subscribers) - queue_item.notified, len(subscribers))
+        with Queue.timing_stage(queue_item), heartbeat.stage('Notifying'):
+            # a retry carries on after the users already notified
+            for index in range(queue_item.notified, len(subscribers)):
+                user, midi_file = subscribers[index]
+                notify_subscriber(user, midi_file, get_notification(queue_item, midi_file))
+                Queue.set_queue_item_notified(queue_item, index + 1)
+        Queue.update_queue_item_status(queue_item, StatusEnum.PUBLISHING)
+
+    if queue_item.status == StatusEnum.PUBLISHING:
+        with Queue.timing_stage(queue_item):
+            publish_renditions(queue_item, heartbeat)
         Queue.update_queue_item_status(queue_item, StatusEnum.DONE)
     logging.info('Completed! Cleaning up...')
     atexit.unregister(exit_handler)
-    # NOTE: these steps can fail without retry
-    unlink(midi_path)
-    unlink(wav_path)
-    unlink(flac_path)
+    media.release(queue_item.uuid)
 
 def main():
     """Main program"""
     logging.basicConfig(level=logging.INFO)
     logging.info('Started.')
+    metrics.start(f'worker_{sys.argv[1]}')
+    tracing.start(f'worker_{sys.argv[1]}')
     system_notifier = sdnotify.SystemdNotifier()
 
     logging.info('Connecting to queue...')
-    Queue.connect(environ['DATABASE_URL'])
+    Queue.connect(environ['DATABASE_URL'],
+        SchedulingPolicy(environ.get('QUEUE_POLICY', 'fair_share')))
+    Outbox.connect(environ['DATABASE_URL'])
 
     synth = Synth.from_id(sys.argv[1])
+    media = MediaManager.from_environ()
+    logging.info('Swept %d orphaned media files', media.sweep(Queue.get_live_uuids()))
 
+    heartbeat = Heartbeat(system_notifier)
+    heartbeat.start()
     system_notifier.notify('READY=1')
+    # wake up often enough while waiting to keep the heartbeat going
+    fetch_timeout = int(heartbeat.stall_timeout / 3)
     while True:
+        heartbeat.alive()
         logging.info('Fetching queue items...')
-        for queue_item in Queue.fetch_queue_items(synth):
+        for queue_item in Queue.fetch_queue_items(synth, timeout=fetch_timeout):
+            heartbeat.alive()
             logging.info('Received queue item: %s', queue_item)
-            logging.info('Watchdog pulse...')
-            system_notifier.notify('WATCHDOG=1')
-            process_queue_item(queue_item)
-        logging.info('Watchdog pulse...')
-        system_notifier.notify('WATCHDOG=1')
+            with tracing.item(queue_item.uuid):
+                process_queue_item(queue_item, media, heartbeat)
+            heartbeat.alive()
+            logging.info('Collected %d unreferenced MIDI blobs', Queue.collect_midi_blobs())
+            logging.info('Swept %d orphaned media files', media.sweep(Queue.get_live_uuids()))
     logging.info('Done.')
 
 if __name__ == "__main__":